@@ -0,0 +1,41 @@
+"""This file screens generated responses for abstentions and reports the abstention
+rate and the patterns that fired, per output file (e.g. per length setting)."""
+import argparse
+import json
+
+from tools import ABSTAIN_PATTERN_PATH, AbstainDetector, jsonlines_iter
+
+def screen_file(detector: AbstainDetector, path: str, field: str = 'all_output') -> dict:
+    """Screens the `field` of every record in `path` and returns the detector stats."""
+    detector.reset()
+    generations = (record.get(field) or "" for record in jsonlines_iter(path))
+    detector.detect_many(generations)
+    return detector.stats()
+
+def main(args):
+    detector = AbstainDetector.from_file(args.patterns, args.family)
+    report = {}
+    for path in args.input_paths:
+        stats = report[path] = screen_file(detector, path, args.field)
+        patterns = ", ".join(f"{name}={count}" for name, count in stats["patterns"].items())
+        print(f"{path}: {stats['abstained']}/{stats['screened']} abstained ({stats['rate']:.1%}) {patterns}")
+
+    if args.output_path:
+        with open(args.output_path, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Report abstention rates of generated responses")
+    parser.add_argument('--input_paths', type=str, nargs='+', required=True,
+                        help="Output JSONL files to screen, e.g. one per length setting")
+    parser.add_argument('--field', type=str, default='all_output',
+                        help="Field of each record that holds the raw response")
+    parser.add_argument('--patterns', type=str, default=ABSTAIN_PATTERN_PATH,
+                        help="JSON file of abstention patterns per model family")
+    parser.add_argument('--family', type=str, default=None,
+                        help="Model family whose patterns extend the defaults, e.g. 'llama'")
+    parser.add_argument('--output_path', type=str, default=None,
+                        help="Optional path to write the report as JSON")
+
+    args = parser.parse_args()
+    main(args)
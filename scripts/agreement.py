@@ -0,0 +1,171 @@
+"""This file computes inter-annotator agreement and factual precision over the human annotations."""
+import argparse
+import itertools
+import json
+
+import numpy as np
+
+from annotations import AnnotationStore, MISSING
+
+################################################################################
+#                                  AGREEMENT                                   #
+################################################################################
+# All statistics take statement weights `w` of shape (B, N): one row per
+# (re)sample, holding how often each of the N statements was drawn. The full
+# sample is simply `np.ones((1, N))`, and B bootstrap resamples run as one batch.
+
+def category_counts(labels: np.ndarray, n_categories: int) -> np.ndarray:
+    """Counts how many annotators chose each category, statements x categories."""
+    return (labels[:, :, None] == np.arange(n_categories)).sum(axis=1)
+
+def fleiss_kappa(labels: np.ndarray, n_categories: int, weights: np.ndarray = None) -> np.ndarray:
+    """Fleiss' kappa of statements labelled by every annotator."""
+    n_items, n_raters = labels.shape
+    if weights is None:
+        weights = np.ones((1, n_items))
+    counts = category_counts(labels, n_categories)
+    agreement = ((counts ** 2).sum(axis=1) - n_raters) / (n_raters * (n_raters - 1))
+    total = weights.sum(axis=1)
+    p_bar = weights @ agreement / total
+    p_j = weights @ counts / (total[:, None] * n_raters)
+    p_e = (p_j ** 2).sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (p_bar - p_e) / (1 - p_e)
+
+def cohen_kappa(a: np.ndarray, b: np.ndarray, n_categories: int, weights: np.ndarray = None) -> np.ndarray:
+    """Cohen's kappa between two annotators."""
+    if weights is None:
+        weights = np.ones((1, len(a)))
+    cells = (a * n_categories + b)[:, None] == np.arange(n_categories ** 2)
+    confusion = (weights @ cells).reshape(-1, n_categories, n_categories)
+    confusion /= confusion.sum(axis=(1, 2), keepdims=True)
+    p_o = np.trace(confusion, axis1=1, axis2=2)
+    p_e = (confusion.sum(axis=2) * confusion.sum(axis=1)).sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (p_o - p_e) / (1 - p_e)
+
+def majority_labels(labels: np.ndarray, n_categories: int) -> np.ndarray:
+    """The most frequent label of each statement, or `MISSING` on a tie."""
+    counts = category_counts(labels, n_categories)
+    top = counts.argmax(axis=1)
+    tied = (counts == counts.max(axis=1, keepdims=True)).sum(axis=1) > 1
+    return np.where(tied, MISSING, top)
+
+def group_ratio(values: np.ndarray, groups: np.ndarray, n_groups: int) -> np.ndarray:
+    """Mean of `values` within each group, e.g. the supported ratio of each topic."""
+    totals = np.bincount(groups, minlength=n_groups)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.bincount(groups, weights=values, minlength=n_groups) / totals
+
+################################################################################
+#                                  BOOTSTRAP                                   #
+################################################################################
+
+def bootstrap_weights(n_items: int, n_resamples: int, groups: np.ndarray = None,
+                      rng: np.random.Generator = None) -> np.ndarray:
+    """Draws resampling weights for all resamples at once.
+
+    Without `groups`, statements are resampled with replacement. With `groups`
+    (e.g. topic ids), whole groups are resampled, which keeps the correlation of
+    statements from the same response.
+    """
+    rng = rng or np.random.default_rng()
+    if groups is None:
+        return rng.multinomial(n_items, np.full(n_items, 1 / n_items), size=n_resamples).astype(float)
+    n_groups = groups.max() + 1
+    group_weights = rng.multinomial(n_groups, np.full(n_groups, 1 / n_groups), size=n_resamples)
+    return group_weights[:, groups].astype(float)
+
+def bootstrap_ci(statistic, n_items: int, n_resamples: int = 2000, alpha: float = 0.05,
+                 groups: np.ndarray = None, seed: int = 0, chunk_size: int = 500):
+    """Percentile confidence interval of a weighted `statistic(weights)`.
+
+    Resamples are evaluated in chunks of `chunk_size` to bound memory.
+    """
+    rng = np.random.default_rng(seed)
+    values = []
+    for start in range(0, n_resamples, chunk_size):
+        size = min(chunk_size, n_resamples - start)
+        values.append(statistic(bootstrap_weights(n_items, size, groups, rng)))
+    values = np.concatenate(values)
+    values = values[np.isfinite(values)]
+    return float(np.quantile(values, alpha / 2)), float(np.quantile(values, 1 - alpha / 2))
+
+################################################################################
+#                                   REPORT                                     #
+################################################################################
+
+def agreement_report(store: AnnotationStore, n_resamples: int = 2000, alpha: float = 0.05,
+                     cluster_by_topic: bool = False, seed: int = 0) -> dict:
+    """Computes agreement and factual precision of all annotators in one pass."""
+    complete = store.annotated.all(axis=1)
+    labels = store.labels[complete]
+    topic_ids = store.topic_ids[complete]
+    n_items, n_categories = len(labels), len(store.label_names)
+    supported_code = store.label_names.index('supported')
+    groups = topic_ids if cluster_by_topic else None
+
+    def with_ci(statistic):
+        value = float(statistic(np.ones((1, n_items)))[0])
+        low, high = bootstrap_ci(statistic, n_items, n_resamples, alpha, groups, seed)
+        return {"value": value, "ci": [low, high]}
+
+    majority = majority_labels(labels, n_categories)
+    majority_supported = (majority == supported_code).astype(float)
+    report = {
+        "annotators": store.annotators,
+        "n_statements": int(n_items),
+        "fleiss_kappa": with_ci(lambda w: fleiss_kappa(labels, n_categories, w)),
+        "cohen_kappa": {},
+        "supported_ratio": {},
+        "majority_supported_ratio": with_ci(lambda w: w @ majority_supported / w.sum(axis=1)),
+        "topic_supported_ratio": {},
+    }
+    for i, j in itertools.combinations(range(len(store.annotators)), 2):
+        pair = f'{store.annotators[i]}-{store.annotators[j]}'
+        report["cohen_kappa"][pair] = with_ci(
+            lambda w, i=i, j=j: cohen_kappa(labels[:, i], labels[:, j], n_categories, w))
+    for j, annotator in enumerate(store.annotators):
+        supported = (labels[:, j] == supported_code).astype(float)
+        report["supported_ratio"][annotator] = with_ci(lambda w, s=supported: w @ s / w.sum(axis=1))
+
+    ratios = group_ratio(majority_supported, topic_ids, len(store.topics))
+    for topic_id, topic in enumerate(store.topics):
+        if np.isfinite(ratios[topic_id]):
+            report["topic_supported_ratio"][topic] = float(ratios[topic_id])
+    return report
+
+def main(args):
+    store = AnnotationStore.load(args.annotation_paths)
+    report = agreement_report(store, args.n_resamples, args.alpha, args.cluster_by_topic, args.seed)
+
+    print(f"Statements annotated by all {len(store.annotators)} annotators: {report['n_statements']}")
+    fleiss = report["fleiss_kappa"]
+    print(f"Fleiss' kappa: {fleiss['value']:.3f} [{fleiss['ci'][0]:.3f}, {fleiss['ci'][1]:.3f}]")
+    for pair, kappa in report["cohen_kappa"].items():
+        print(f"Cohen's kappa {pair}: {kappa['value']:.3f} [{kappa['ci'][0]:.3f}, {kappa['ci'][1]:.3f}]")
+    for annotator, ratio in report["supported_ratio"].items():
+        print(f"Supported ratio {annotator}: {ratio['value']:.3f} [{ratio['ci'][0]:.3f}, {ratio['ci'][1]:.3f}]")
+    ratio = report["majority_supported_ratio"]
+    print(f"Supported ratio (majority): {ratio['value']:.3f} [{ratio['ci'][0]:.3f}, {ratio['ci'][1]:.3f}]")
+
+    if args.output_path:
+        with open(args.output_path, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compute inter-annotator agreement and factual precision")
+    parser.add_argument('--annotation_paths', type=str, nargs='+', default=None,
+                        help="Annotation files (default: data/human_annotations/human_annotation_*.jsonl)")
+    parser.add_argument('--n_resamples', type=int, default=2000,
+                        help="Number of bootstrap resamples")
+    parser.add_argument('--alpha', type=float, default=0.05,
+                        help="Significance level of the confidence intervals")
+    parser.add_argument('--cluster_by_topic', action='store_true',
+                        help="Resample whole topics instead of single statements")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output_path', type=str, default=None,
+                        help="Optional path to write the full report as JSON")
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,111 @@
+"""This file provides a compact, columnar store for the human annotation files."""
+import glob
+import os
+
+import numpy as np
+
+from tools import jsonlines_iter
+
+_DEFAULT_ANNOTATION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                       '..', 'data', 'human_annotations')
+MISSING = -1
+
+class AnnotationStore:
+    """Statements of all annotators, joined on (`index`, `topic`, `statement`).
+
+    Every annotation file repeats the full response for each statement. Here each
+    distinct response is kept once and referenced by id, and the `human_decision`
+    of annotator `j` for statement `i` is `labels[i, j]` (`MISSING` if the annotator
+    skipped it). Label codes index `label_names`, which always starts with
+    `unsupported` (0) and `supported` (1).
+    """
+
+    def __init__(self, annotators: list):
+        self.annotators = annotators
+        self.label_names = ['unsupported', 'supported']
+        self.topics = []
+        self.responses = []
+        self.statements = []
+        self.comments = {}
+        self._label_codes = {name: code for code, name in enumerate(self.label_names)}
+        self._topic_ids = {}
+        self._response_ids = {}
+        self._rows = {}
+        self._index, self._topic, self._response, self._labels = [], [], [], []
+
+    @classmethod
+    def load(cls, paths: list = None):
+        """Reads the annotation files in one streaming pass each.
+
+        `paths` defaults to every `human_annotation_*.jsonl` in the data directory.
+        """
+        if paths is None:
+            paths = sorted(glob.glob(os.path.join(_DEFAULT_ANNOTATION_DIR, 'human_annotation_*.jsonl')))
+        store = cls([os.path.splitext(os.path.basename(p))[0] for p in paths])
+        for annotator, path in enumerate(paths):
+            for record in jsonlines_iter(path):
+                store._add(annotator, record)
+        store._freeze()
+        return store
+
+    def _intern(self, table: dict, values: list, value) -> int:
+        if value not in table:
+            table[value] = len(values)
+            values.append(value)
+        return table[value]
+
+    def _add(self, annotator: int, record: dict):
+        key = (record['index'], record['topic'], record['statement'])
+        row = self._rows.get(key)
+        if row is None:
+            row = self._rows[key] = len(self.statements)
+            self.statements.append(record['statement'])
+            self._index.append(record['index'])
+            self._topic.append(self._intern(self._topic_ids, self.topics, record['topic']))
+            self._response.append(self._intern(self._response_ids, self.responses, record['response']))
+            self._labels.append([MISSING] * len(self.annotators))
+        self._labels[row][annotator] = self._intern(self._label_codes, self.label_names,
+                                                    record['human_decision'])
+        if record.get('comment'):
+            self.comments[(row, annotator)] = record['comment']
+
+    def _freeze(self):
+        self.index = np.asarray(self._index, dtype=np.int64)
+        self.topic_ids = np.asarray(self._topic, dtype=np.int32)
+        self.response_ids = np.asarray(self._response, dtype=np.int32)
+        self.labels = np.asarray(self._labels, dtype=np.int8).reshape(-1, len(self.annotators))
+        del self._index, self._topic, self._response, self._labels
+
+    def __len__(self) -> int:
+        return len(self.statements)
+
+    @property
+    def supported(self) -> np.ndarray:
+        """Boolean matrix of `supported` decisions, statements x annotators."""
+        return self.labels == self._label_codes['supported']
+
+    @property
+    def annotated(self) -> np.ndarray:
+        return self.labels != MISSING
+
+    def rows(self, topic: str) -> np.ndarray:
+        """Row numbers of the statements about `topic`."""
+        topic_id = self._topic_ids.get(topic)
+        if topic_id is None:
+            return np.empty(0, dtype=np.int64)
+        return np.flatnonzero(self.topic_ids == topic_id)
+
+    def response(self, row: int) -> str:
+        return self.responses[self.response_ids[row]]
+
+    def record(self, row: int, annotator: int) -> dict:
+        """Rebuilds the original annotation record of one annotator."""
+        label = self.labels[row, annotator]
+        return {
+            "topic": self.topics[self.topic_ids[row]],
+            "statement": self.statements[row],
+            "response": self.response(row),
+            "human_decision": self.label_names[label] if label != MISSING else None,
+            "comment": self.comments.get((row, annotator), ""),
+            "index": int(self.index[row]),
+        }
@@ -0,0 +1,216 @@
+"""This file provides the model backends behind the `ChatClient` interface.
+
+Every generator script talks to its model through `client.complete(...)`, so a
+backend only has to override `ChatClient._request`:
+- `openai`: any OpenAI-compatible HTTP endpoint (`ChatClient`, with `--base_url`),
+- `local`: a model loaded in this process, with requests micro-batched so that
+  one forward pass serves many topics (`LocalClient`),
+- `fake`: deterministic synthetic responses for tests (`FakeClient`).
+"""
+import asyncio
+import hashlib
+import itertools
+import logging
+import random
+import re
+import time
+
+from engine import ChatClient
+from rate_limit import RateLimiter
+from cache import ResponseCache
+from telemetry import Telemetry
+from coalesce import RequestCoalescer
+
+################################################################################
+#                             SYNTHETIC RESPONSES                              #
+################################################################################
+_HEADER_PATTERN = re.compile(r'^###\s*(.+?)\s*###\s*$', re.MULTILINE)
+_LENGTH_PATTERN = re.compile(r'around (\d+) words')
+_DEFAULT_WORDS = 150
+_WORDS = ("born", "career", "family", "award", "city", "university", "studied", "worked",
+          "known", "released", "married", "early", "life", "later", "became", "founded",
+          "published", "team", "season", "album", "film", "role", "country", "history")
+
+def _words(n: int, rng: random.Random) -> str:
+    return " ".join(rng.choice(_WORDS) for _ in range(n))
+
+def synthesize_response(messages: list, rng: random.Random) -> str:
+    """Builds a response with the sections and lengths requested in the system prompt."""
+    system_prompt = next((m['content'] for m in messages if m['role'] == 'system'), '')
+    titles = list(dict.fromkeys(_HEADER_PATTERN.findall(system_prompt)))
+    lengths = [int(n) for n in _LENGTH_PATTERN.findall(system_prompt)] or [_DEFAULT_WORDS]
+    if not titles:
+        return _words(lengths[0], rng)
+    sections = []
+    for title, length in zip(titles, itertools.chain(lengths, itertools.repeat(lengths[-1]))):
+        sections.append(f"### {title} ###\n{_words(length, rng)}")
+    return "\n\n".join(sections)
+
+def synthetic_usage(messages: list, content: str) -> dict:
+    prompt_tokens = sum(len(m.get('content') or '') for m in messages) // 4
+    completion_tokens = round(len(content.split()) * 4 / 3)
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens}
+
+################################################################################
+#                                FAKE BACKEND                                  #
+################################################################################
+
+class FakeClient(ChatClient):
+    """Answers every request with a synthetic response seeded by the request itself.
+
+    The same messages always get the same response, in the `### topic ###` format
+    and with the lengths the system prompt asks for. Samples after the first are
+    seeded with their position as well.
+    """
+
+    def __init__(self, cache: ResponseCache = None, telemetry: Telemetry = None,
+                 coalescer: RequestCoalescer = None):
+        super().__init__(None, RateLimiter(), cache, telemetry, coalescer, endpoint='fake')
+
+    @classmethod
+    def from_args(cls, args):
+        cache = ResponseCache.from_args(args)
+        return cls(cache, Telemetry.from_args(args), RequestCoalescer.from_args(args, cache))
+
+    async def _request(self, messages, model, temperature, estimated_tokens, attempt, call, n=1):
+        choices = []
+        for sample in range(n):
+            request = (model, messages, temperature) if sample == 0 else (model, messages, temperature, sample)
+            seed = hashlib.sha256(repr(request).encode('utf-8')).digest()
+            choices.append(synthesize_response(messages, random.Random(seed)))
+        call.record_usage(synthetic_usage(messages, " ".join(choices)), 'stop')
+        return choices
+
+################################################################################
+#                                LOCAL BACKEND                                 #
+################################################################################
+
+class VLLMEngine:
+    """Batched chat generation with vLLM (also runs on CPU builds)."""
+
+    def __init__(self, model: str, max_tokens: int = 2048):
+        try:
+            from vllm import LLM, SamplingParams
+        except ImportError:
+            raise ImportError('vllm is required for --local_engine vllm: pip install vllm')
+        self.llm = LLM(model=model)
+        self.sampling_params = SamplingParams
+        self.max_tokens = max_tokens
+
+    def generate_batch(self, conversations: list, temperature: float, n: int = 1) -> list:
+        params = self.sampling_params(temperature=temperature, max_tokens=self.max_tokens, n=n)
+        results = []
+        for output in self.llm.chat(conversations, params, use_tqdm=False):
+            usage = {"prompt_tokens": len(output.prompt_token_ids),
+                     "completion_tokens": sum(len(completion.token_ids) for completion in output.outputs)}
+            results.append(([completion.text for completion in output.outputs], usage,
+                            output.outputs[0].finish_reason))
+        return results
+
+class LlamaCppEngine:
+    """Chat generation with llama.cpp; a batch is answered one conversation (and sample) at a time."""
+
+    def __init__(self, model: str, max_tokens: int = 2048, n_ctx: int = 8192):
+        try:
+            from llama_cpp import Llama
+        except ImportError:
+            raise ImportError('llama-cpp-python is required for --local_engine llama_cpp: pip install llama-cpp-python')
+        self.llm = Llama(model_path=model, n_ctx=n_ctx, verbose=False)
+        self.max_tokens = max_tokens
+
+    def generate_batch(self, conversations: list, temperature: float, n: int = 1) -> list:
+        results = []
+        for messages in conversations:
+            texts, usage, finish_reason = [], {"prompt_tokens": 0, "completion_tokens": 0}, None
+            for _ in range(n):
+                completion = self.llm.create_chat_completion(messages, temperature=temperature,
+                                                             max_tokens=self.max_tokens)
+                choice = completion['choices'][0]
+                texts.append(choice['message']['content'])
+                usage["prompt_tokens"] = completion['usage']['prompt_tokens']
+                usage["completion_tokens"] += completion['usage']['completion_tokens']
+                finish_reason = finish_reason or choice.get('finish_reason')
+            results.append((texts, usage, finish_reason))
+        return results
+
+class LocalClient(ChatClient):
+    """Serves requests from a model loaded in this process.
+
+    Requests are collected for at most `batch_wait` seconds, or until `batch_size`
+    are waiting, and requests with the same temperature and number of samples are generated in one call
+    of `engine.generate_batch`. Generation runs in a worker thread, one batch at a
+    time, and new requests keep queueing meanwhile, so batches fill up by themselves
+    under load. The engine serves a single model, whatever `model` is requested.
+    """
+
+    def __init__(self, engine, cache: ResponseCache = None, telemetry: Telemetry = None,
+                 coalescer: RequestCoalescer = None, batch_size: int = 32, batch_wait: float = 0.05,
+                 endpoint: str = 'local'):
+        super().__init__(None, RateLimiter(), cache, telemetry, coalescer, endpoint)
+        self.engine = engine
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.waiting = []
+        self.flush_timer = None
+        self.running = None
+
+    @classmethod
+    def from_args(cls, args):
+        engines = {"vllm": VLLMEngine, "llama_cpp": LlamaCppEngine}
+        engine = engines[args.local_engine](args.local_model or args.model)
+        cache = ResponseCache.from_args(args)
+        return cls(engine, cache, Telemetry.from_args(args), RequestCoalescer.from_args(args, cache),
+                   args.local_batch_size, args.local_batch_wait,
+                   endpoint=f'local:{args.local_engine}:{args.local_model or args.model}')
+
+    async def _request(self, messages, model, temperature, estimated_tokens, attempt, call, n=1):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.waiting.append((messages, (temperature, n), future))
+        if len(self.waiting) >= self.batch_size:
+            self._flush()
+        elif self.flush_timer is None:
+            self.flush_timer = loop.call_later(self.batch_wait, self._flush)
+        choices, usage, finish_reason, call.latency = await future
+        call.record_usage(usage, finish_reason)
+        return choices
+
+    def _flush(self):
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+        # requests arriving during a batch are picked up as soon as it finishes
+        if not self.waiting or self.running is not None:
+            return
+        requests, self.waiting = self.waiting[:self.batch_size], self.waiting[self.batch_size:]
+        self.running = asyncio.ensure_future(self._generate(requests))
+
+    async def _generate(self, requests: list):
+        try:
+            by_sampling = {}
+            for request in requests:
+                by_sampling.setdefault(request[1], []).append(request)
+            for (temperature, n), group in by_sampling.items():
+                conversations = [messages for messages, _, _ in group]
+                try:
+                    generation_started = time.perf_counter()
+                    results = await asyncio.get_running_loop().run_in_executor(
+                        None, self.engine.generate_batch, conversations, temperature, n)
+                    # every request of the batch waited for the whole generation
+                    elapsed = time.perf_counter() - generation_started
+                    results = [result + (elapsed,) for result in results]
+                except Exception as e:
+                    logging.error(f"Local batch of {len(group)} requests failed: {e}")
+                    results = [e] * len(group)
+                for (_, _, future), result in zip(group, results):
+                    if future.done():
+                        continue
+                    if isinstance(result, Exception):
+                        future.set_exception(result)
+                    else:
+                        future.set_result(result)
+        finally:
+            self.running = None
+            if self.waiting:
+                self._flush()
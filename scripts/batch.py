@@ -0,0 +1,145 @@
+"""This file provides the OpenAI Batch API mode of the generator scripts."""
+import asyncio
+import json
+import logging
+import os
+from datetime import datetime
+
+from engine import ChatClient
+
+_BATCH_ENDPOINT = '/v1/chat/completions'
+_FINAL_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+
+def render_batch_request(custom_id: str, messages: list, model: str, temperature: float, n: int = 1) -> dict:
+    """Renders one chat request as a line of a Batch API input file."""
+    body = {"model": model, "messages": messages, "temperature": temperature}
+    if n > 1:
+        body["n"] = n
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": _BATCH_ENDPOINT,
+        "body": body,
+    }
+
+class BatchClient(ChatClient):
+    """A ChatClient that collects requests and submits them as Batch API jobs.
+
+    The first attempt of every request is queued. Once no new request has arrived
+    for `idle_seconds`, or `batch_size` requests are waiting, they are written to a
+    JSONL file, uploaded and submitted as one job, which is polled until it ends.
+    Each result is routed back to the request that produced it through its
+    `custom_id`. Requests that fail inside the batch, or whose response is rejected
+    by the script's parser, are retried through the regular chat endpoint.
+    """
+
+    def __init__(self, client, limiter=None, cache=None, batch_dir='output/batches',
+                 batch_size=50000, poll_interval=30, idle_seconds=1.0, telemetry=None, coalescer=None,
+                 endpoint=None):
+        super().__init__(client, limiter, cache, telemetry, coalescer, endpoint)
+        self.batch_dir = batch_dir
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.idle_seconds = idle_seconds
+        self.waiting = {}
+        self.jobs = []
+        self.flush_timer = None
+        self.next_id = 0
+
+    @classmethod
+    def from_args(cls, args):
+        chat_client = ChatClient.from_args(args)
+        return cls(chat_client.client, chat_client.limiter, chat_client.cache, args.batch_dir,
+                   args.batch_size, args.batch_poll_interval, telemetry=chat_client.telemetry,
+                   coalescer=chat_client.coalescer, endpoint=chat_client.endpoint)
+
+    async def _request(self, messages, model, temperature, estimated_tokens, attempt, call, n=1):
+        if attempt > 0:
+            return await super()._request(messages, model, temperature, estimated_tokens, attempt, call, n)
+
+        custom_id = f'request-{self.next_id}'
+        self.next_id += 1
+        future = asyncio.get_running_loop().create_future()
+        self.waiting[custom_id] = (render_batch_request(custom_id, messages, model, temperature, n), future)
+
+        if len(self.waiting) >= self.batch_size:
+            self._submit_waiting()
+        else:
+            # submit once the workers stop adding requests
+            if self.flush_timer is not None:
+                self.flush_timer.cancel()
+            self.flush_timer = asyncio.get_running_loop().call_later(self.idle_seconds, self._submit_waiting)
+        body = await future
+        choices = body['choices']
+        call.record_usage(body.get('usage'), choices[0].get('finish_reason'))
+        # the time spent in a batch job says nothing about the latency of one request
+        call.latency = None
+        return [choice['message']['content'] for choice in choices]
+
+    def _submit_waiting(self):
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+        if not self.waiting:
+            return
+        requests, self.waiting = self.waiting, {}
+        self.jobs.append(asyncio.ensure_future(self._run_job(requests)))
+
+    async def _run_job(self, requests: dict):
+        try:
+            results = await self._submit_and_wait(requests)
+        except Exception as e:
+            results = {}
+            logging.error(f"Batch job failed: {e}")
+        for custom_id, (_, future) in requests.items():
+            if future.done():
+                continue
+            if custom_id in results and 'choices' in results[custom_id]:
+                future.set_result(results[custom_id])
+            else:
+                error = results.get(custom_id, 'no result returned by the batch job')
+                future.set_exception(RuntimeError(f'Batch request {custom_id} failed: {error}'))
+
+    async def _submit_and_wait(self, requests: dict) -> dict:
+        """Submits one batch job and returns the completion body or error of each request."""
+        os.makedirs(self.batch_dir, exist_ok=True)
+        input_path = os.path.join(self.batch_dir, f'batch_{datetime.now().strftime("%m_%d_%H_%M_%S")}_{len(self.jobs)}.jsonl')
+        with open(input_path, 'w') as f:
+            for body, _ in requests.values():
+                f.write(json.dumps(body) + '\n')
+
+        with open(input_path, 'rb') as f:
+            input_file = await self.client.files.create(file=f, purpose='batch')
+        job = await self.client.batches.create(input_file_id=input_file.id, endpoint=_BATCH_ENDPOINT,
+                                               completion_window='24h')
+        logging.info(f"Submitted batch {job.id} with {len(requests)} requests from {input_path}")
+
+        while job.status not in _FINAL_STATUSES:
+            await asyncio.sleep(self.poll_interval)
+            job = await self.client.batches.retrieve(job.id)
+            logging.info(f"Batch {job.id}: {job.status} {job.request_counts}")
+
+        results = {}
+        for file_id in (job.output_file_id, job.error_file_id):
+            if file_id is None:
+                continue
+            content = await self.client.files.content(file_id)
+            for line in content.text.splitlines():
+                if line.strip():
+                    custom_id, result = parse_batch_result(json.loads(line))
+                    results[custom_id] = result
+        return results
+
+    async def close(self):
+        self._submit_waiting()
+        if self.jobs:
+            await asyncio.gather(*self.jobs, return_exceptions=True)
+        await super().close()
+
+def parse_batch_result(line: dict):
+    """Returns the custom_id of a Batch API output line and its completion body, or its error."""
+    response = line.get('response')
+    if line.get('error') is None and response is not None and response.get('status_code') == 200:
+        return line['custom_id'], response['body']
+    error = line.get('error') or (response or {}).get('body', {}).get('error')
+    return line['custom_id'], {'error': error}
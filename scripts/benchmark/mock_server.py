@@ -0,0 +1,277 @@
+"""This file provides a local stand-in for the OpenAI API, used to benchmark the
+generator scripts offline.
+
+It answers `/v1/chat/completions` with synthetic responses of the requested length,
+in the `### topic ###` format whenever the system prompt asks for it, after a
+latency drawn from a configurable distribution. A share of the requests can be
+failed with 429 or 500 errors. The files and batches endpoints are emulated as
+well, so `--batch` runs can be benchmarked too; batch jobs complete immediately.
+"""
+import argparse
+import email.parser
+import email.policy
+import hashlib
+import json
+import logging
+import math
+import os
+import random
+import re
+import sys
+import threading
+import time
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from backends import synthesize_response, synthetic_usage
+
+LATENCY_DISTRIBUTIONS = ('constant', 'uniform', 'exponential', 'lognormal')
+
+@dataclass
+class MockConfig:
+    """Behaviour of the mock server.
+
+    The latency of a request is `per_token_latency` per completion token plus a
+    draw from `latency_dist` with the given mean (and `latency_sigma` for the
+    lognormal distribution). `rate_429` and `rate_500` are the probabilities of
+    failing a request with that status.
+    """
+    latency_dist: str = 'lognormal'
+    latency_mean: float = 0.2
+    latency_sigma: float = 0.5
+    per_token_latency: float = 0.0
+    rate_429: float = 0.0
+    rate_500: float = 0.0
+    retry_after_ms: int = 100
+    abstain_rate: float = 0.0
+    seed: int = 0
+
+    def sample_latency(self, rng: random.Random) -> float:
+        if self.latency_dist == 'constant':
+            return self.latency_mean
+        if self.latency_dist == 'uniform':
+            return rng.uniform(0, 2 * self.latency_mean)
+        if self.latency_dist == 'exponential':
+            return rng.expovariate(1 / self.latency_mean) if self.latency_mean > 0 else 0.0
+        if self.latency_dist == 'lognormal':
+            # mu is chosen so that the distribution has the requested mean
+            if self.latency_mean <= 0:
+                return 0.0
+            mu = math.log(self.latency_mean) - self.latency_sigma ** 2 / 2
+            return rng.lognormvariate(mu, self.latency_sigma)
+        raise ValueError(f'Unknown latency distribution {self.latency_dist!r}')
+
+################################################################################
+#                             SYNTHETIC RESPONSES                              #
+################################################################################
+
+def completion_body(request: dict, contents: list) -> dict:
+    """A chat completion with one choice per content; usage counts the prompt once."""
+    usage = synthetic_usage(request.get('messages', []), " ".join(contents))
+    return {
+        "id": f"chatcmpl-{hashlib.sha1(contents[0].encode()).hexdigest()[:12]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": request.get('model', 'mock'),
+        "choices": [{"index": i, "message": {"role": "assistant", "content": content},
+                     "finish_reason": "stop"} for i, content in enumerate(contents)],
+        "usage": usage,
+    }
+
+################################################################################
+#                                    SERVER                                    #
+################################################################################
+
+class MockOpenAIServer(ThreadingHTTPServer):
+    """A threaded HTTP server holding the mock configuration, uploaded files and batches."""
+    daemon_threads = True
+    # the default backlog of 5 drops connections when many workers connect at once
+    request_queue_size = 128
+
+    def __init__(self, address, config: MockConfig = None):
+        super().__init__(address, _Handler)
+        self.config = config or MockConfig()
+        self.rng = random.Random(self.config.seed)
+        self.lock = threading.Lock()
+        self.files = {}
+        self.batches = {}
+        self.counts = {"requests": 0, "429": 0, "500": 0}
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/v1'
+
+    def draw(self):
+        """Returns the injected error status (or None), the latency and a random generator for one request."""
+        with self.lock:
+            self.counts["requests"] += 1
+            roll = self.rng.random()
+            latency = self.config.sample_latency(self.rng)
+            status = None
+            if roll < self.config.rate_429:
+                status = 429
+            elif roll < self.config.rate_429 + self.config.rate_500:
+                status = 500
+            if status is not None:
+                self.counts[str(status)] += 1
+            seed = self.rng.getrandbits(32)
+        return status, latency, random.Random(seed)
+
+    def complete(self, request: dict, rng: random.Random) -> dict:
+        contents = []
+        for _ in range(request.get('n') or 1):
+            if rng.random() < self.config.abstain_rate:
+                contents.append("I'm sorry, I could not find any information about this person.")
+            else:
+                contents.append(synthesize_response(request.get('messages', []), rng))
+        return completion_body(request, contents)
+
+    def add_file(self, data: bytes, purpose: str, filename: str = 'upload.jsonl') -> dict:
+        with self.lock:
+            file_id = f'file-{len(self.files)}'
+            self.files[file_id] = data
+        return {"id": file_id, "object": "file", "bytes": len(data), "created_at": int(time.time()),
+                "filename": filename, "purpose": purpose, "status": "processed"}
+
+    def run_batch(self, request: dict) -> dict:
+        """Answers every line of the input file at once and returns the completed batch."""
+        output = []
+        for line in self.files[request['input_file_id']].decode('utf-8').splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            _, _, rng = self.draw()
+            body = self.complete(item['body'], rng)
+            output.append(json.dumps({"id": f"batch_req_{len(output)}", "custom_id": item['custom_id'],
+                                      "response": {"status_code": 200, "body": body}, "error": None}))
+        output_file = self.add_file(("\n".join(output) + "\n").encode('utf-8'), 'batch_output')
+        with self.lock:
+            batch_id = f'batch-{len(self.batches)}'
+            self.batches[batch_id] = {
+                "id": batch_id, "object": "batch", "endpoint": request.get('endpoint'),
+                "input_file_id": request['input_file_id'], "completion_window": request.get('completion_window'),
+                "status": "completed", "created_at": int(time.time()),
+                "output_file_id": output_file['id'], "error_file_id": None,
+                "request_counts": {"total": len(output), "completed": len(output), "failed": 0},
+            }
+        return self.batches[batch_id]
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, which Nagle's algorithm would delay
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, payload: dict, headers: dict = None):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _error(self, status: int, message: str, headers: dict = None):
+        self._send_json(status, {"error": {"message": message, "type": "mock_error", "code": str(status)}}, headers)
+
+    def _body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def do_POST(self):
+        server = self.server
+        if self.path.endswith('/chat/completions'):
+            request = json.loads(self._body())
+            status, latency, rng = server.draw()
+            if status == 429:
+                time.sleep(latency / 10)
+                return self._error(429, 'Rate limit reached (injected)',
+                                   {'retry-after-ms': str(server.config.retry_after_ms)})
+            if status == 500:
+                time.sleep(latency)
+                return self._error(500, 'Internal server error (injected)')
+            body = server.complete(request, rng)
+            time.sleep(latency + server.config.per_token_latency * body['usage']['completion_tokens'])
+            return self._send_json(200, body)
+
+        if self.path.endswith('/files'):
+            # multipart/form-data with a `purpose` field and a `file` part
+            raw = b'Content-Type: ' + self.headers['Content-Type'].encode() + b'\r\n\r\n' + self._body()
+            message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(raw)
+            fields, data, filename = {}, b'', 'upload.jsonl'
+            for part in message.iter_parts():
+                name = part.get_param('name', header='content-disposition')
+                if name == 'file':
+                    data = part.get_payload(decode=True)
+                    filename = part.get_filename() or filename
+                else:
+                    fields[name] = part.get_content().strip()
+            return self._send_json(200, server.add_file(data, fields.get('purpose', 'batch'), filename))
+
+        if self.path.endswith('/batches'):
+            return self._send_json(200, server.run_batch(json.loads(self._body())))
+
+        self._error(404, f'Unknown endpoint {self.path}')
+
+    def do_GET(self):
+        server = self.server
+        match = re.search(r'/files/([^/]+)/content$', self.path)
+        if match and match.group(1) in server.files:
+            data = server.files[match.group(1)]
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        match = re.search(r'/batches/([^/]+)$', self.path)
+        if match and match.group(1) in server.batches:
+            return self._send_json(200, server.batches[match.group(1)])
+        self._error(404, f'Unknown endpoint {self.path}')
+
+def start_server(config: MockConfig = None, host: str = '127.0.0.1', port: int = 0) -> MockOpenAIServer:
+    """Starts the mock server in a background thread and returns it; port 0 picks a free port."""
+    server = MockOpenAIServer((host, port), config)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def add_mock_args(parser):
+    """Adds the arguments that configure the mock server."""
+    parser.add_argument('--latency_dist', type=str, default='lognormal', choices=LATENCY_DISTRIBUTIONS,
+                        help="Distribution of the base latency of a request")
+    parser.add_argument('--latency_mean', type=float, default=0.2,
+                        help="Mean base latency in seconds")
+    parser.add_argument('--latency_sigma', type=float, default=0.5,
+                        help="Shape of the lognormal latency distribution")
+    parser.add_argument('--per_token_latency', type=float, default=0.0,
+                        help="Extra latency per completion token in seconds")
+    parser.add_argument('--rate_429', type=float, default=0.0,
+                        help="Share of requests failed with 429 Too Many Requests")
+    parser.add_argument('--rate_500', type=float, default=0.0,
+                        help="Share of requests failed with 500 Internal Server Error")
+    parser.add_argument('--retry_after_ms', type=int, default=100,
+                        help="retry-after-ms header sent with injected 429 errors")
+    parser.add_argument('--abstain_rate', type=float, default=0.0,
+                        help="Share of requests answered with an abstention")
+    parser.add_argument('--seed', type=int, default=0)
+    return parser
+
+def mock_config(args) -> MockConfig:
+    return MockConfig(args.latency_dist, args.latency_mean, args.latency_sigma, args.per_token_latency,
+                      args.rate_429, args.rate_500, args.retry_after_ms, args.abstain_rate, args.seed)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Run a local mock of the OpenAI API")
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    add_mock_args(parser)
+
+    args = parser.parse_args()
+    server = MockOpenAIServer((args.host, args.port), mock_config(args))
+    logging.info(f"Mock OpenAI API listening on {server.base_url}")
+    server.serve_forever()
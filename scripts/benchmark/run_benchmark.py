@@ -0,0 +1,137 @@
+"""This file benchmarks the generator scripts offline against the mock OpenAI server.
+
+Every scenario runs one script as a subprocess pointed at the mock server through
+`--base_url`, and is measured by tasks/s, the p50/p95 request latency, and the
+retry overhead (the share of time spent in failed attempts and backoff). The
+results can be compared with a baseline report to catch performance regressions.
+"""
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from mock_server import start_server, add_mock_args, mock_config
+
+_SCRIPTS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# script -> extra arguments of the benchmarked setting
+SCENARIOS = {
+    "length_bias": ["--length", "300"],
+    "long_context": ["--topic1", "personal life", "--topic2", "career",
+                     "--context_length", "200", "--evaluation_length", "200"],
+    "facts_exhaustion": ["--setting", "multiple", "--topic1", "early life", "--topic2", "career",
+                         "--topic1_length", "200", "--topic2_length", "200"],
+}
+
+def _percentile(values: list, q: float):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+def run_scenario(name: str, base_url: str, args, work_dir: str) -> dict:
+    """Runs one script against the mock server and returns its measurements."""
+    output_dir = os.path.join(work_dir, name)
+    metrics_path = os.path.join(work_dir, f'{name}_metrics.json')
+    command = [sys.executable, f'{name}.py', '--api_key', 'mock', '--base_url', base_url,
+               '--output_dir', output_dir, '--start', '0', '--end', str(args.tasks),
+               '--concurrency', str(args.concurrency), '--cache-mode', 'off',
+               '--metrics_path', metrics_path, *SCENARIOS[name]]
+    if args.batch:
+        command += ['--batch', '--batch_dir', os.path.join(work_dir, 'batches'), '--batch_poll_interval', '0.1']
+
+    started = time.perf_counter()
+    subprocess.run(command, cwd=_SCRIPTS_DIR, check=True,
+                   stdout=subprocess.DEVNULL, stderr=None if args.verbose else subprocess.DEVNULL)
+    elapsed = time.perf_counter() - started
+
+    records = []
+    for fname in os.listdir(output_dir):
+        if fname.endswith('.jsonl'):
+            with open(os.path.join(output_dir, fname)) as f:
+                records += [json.loads(line) for line in f if line.strip()]
+    telemetry = [record['telemetry'] for record in records if record.get('telemetry')]
+    # responses of Batch API jobs have no request latency
+    timed = [t for t in telemetry if t['latency'] is not None]
+    latencies = [t['latency'] for t in timed]
+    total_latency = sum(t['total_latency'] for t in timed)
+    return {
+        "tasks": len(records),
+        "seconds": elapsed,
+        "tasks_per_s": len(records) / elapsed if elapsed else None,
+        "latency_p50": _percentile(latencies, 0.50),
+        "latency_p95": _percentile(latencies, 0.95),
+        "latency_p99": _percentile(latencies, 0.99),
+        "retries": sum(t['retries'] for t in telemetry),
+        "retry_overhead": (total_latency - sum(latencies)) / total_latency if total_latency else 0.0,
+    }
+
+def compare(report: dict, baseline: dict, max_regression: float) -> list:
+    """Returns the scenarios whose tasks/s dropped by more than `max_regression` against `baseline`."""
+    regressions = []
+    for name, result in report["scenarios"].items():
+        reference = baseline.get("scenarios", {}).get(name)
+        if reference is None or not reference.get("tasks_per_s"):
+            continue
+        change = result["tasks_per_s"] / reference["tasks_per_s"] - 1
+        if change < -max_regression:
+            regressions.append(f"{name}: {result['tasks_per_s']:.2f} tasks/s is {-change:.0%} below the baseline "
+                               f"({reference['tasks_per_s']:.2f} tasks/s)")
+    return regressions
+
+def main(args):
+    server = start_server(mock_config(args))
+    logging.info(f"Mock OpenAI API listening on {server.base_url}")
+    report = {"config": vars(args), "scenarios": {}}
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            for name in args.scripts:
+                result = report["scenarios"][name] = run_scenario(name, server.base_url, args, work_dir)
+                p50, p95 = (f"{result[key]:.3f}s" if result[key] is not None else "-"
+                            for key in ('latency_p50', 'latency_p95'))
+                print(f"{name}: {result['tasks']} tasks in {result['seconds']:.2f}s "
+                      f"({result['tasks_per_s']:.2f} tasks/s), latency p50 {p50} p95 {p95}, "
+                      f"{result['retries']} retries ({result['retry_overhead']:.1%} of request time)")
+    finally:
+        server.shutdown()
+    report["server"] = dict(server.counts)
+
+    if args.output_path:
+        with open(args.output_path, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.max_regression)
+        for regression in regressions:
+            logging.error(regression)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Benchmark the generator scripts against a local mock OpenAI API")
+    parser.add_argument('--scripts', type=str, nargs='+', default=list(SCENARIOS), choices=list(SCENARIOS),
+                        help="Scripts to benchmark")
+    parser.add_argument('--tasks', type=int, default=100,
+                        help="Number of tasks per script")
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help="Concurrency passed to the scripts")
+    parser.add_argument('--batch', action='store_true',
+                        help="Run the scripts in Batch API mode")
+    parser.add_argument('--output_path', type=str, default=None,
+                        help="Optional path to write the report as JSON")
+    parser.add_argument('--baseline', type=str, default=None,
+                        help="Report of an earlier run; exit with an error if tasks/s regressed")
+    parser.add_argument('--max_regression', type=float, default=0.2,
+                        help="Tolerated drop in tasks/s against the baseline")
+    parser.add_argument('--verbose', action='store_true',
+                        help="Show the output of the scripts")
+    add_mock_args(parser)
+
+    args = parser.parse_args()
+    main(args)
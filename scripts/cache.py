@@ -0,0 +1,217 @@
+"""This file provides a persistent response cache shared by the generator scripts."""
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+CACHE_MODES = ["read", "write", "readwrite", "off"]
+
+def request_key(model: str, messages: list, **params) -> str:
+    """Hashes a request so that identical prompts and sampling parameters share one entry."""
+    payload = json.dumps({"model": model, "messages": messages, "params": params},
+                         sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+class ResponseCache:
+    """A SQLite-backed cache of chat responses keyed on `request_key`.
+
+    `mode` controls whether the cache is read, written, both, or bypassed. Entries
+    older than `max_age_days` are dropped, and once more than `max_entries` are
+    stored the least recently used ones are evicted.
+    """
+
+    _EVICT_EVERY = 100
+
+    def __init__(self, path: str, mode: str = "readwrite", max_entries: int = None,
+                 max_age_days: float = None):
+        if mode not in CACHE_MODES:
+            raise ValueError(f'Unknown cache mode: {mode}')
+        self.path = path
+        self.mode = mode
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.conn = None
+        if mode == "off":
+            return
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY,
+            model TEXT,
+            response TEXT,
+            created REAL,
+            accessed REAL)''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        self.conn.commit()
+        self.evict()
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(args.cache_path, args.cache_mode, args.cache_max_entries, args.cache_max_age_days)
+
+    @property
+    def readable(self) -> bool:
+        return self.mode in ("read", "readwrite")
+
+    @property
+    def writable(self) -> bool:
+        return self.mode in ("write", "readwrite")
+
+    def get(self, key: str):
+        """Returns the cached response for `key`, or None."""
+        if not self.readable:
+            return None
+        row = self.conn.execute('SELECT response, created FROM responses WHERE key = ?', (key,)).fetchone()
+        if row is None or self._expired(row[1]):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.conn.execute('UPDATE responses SET accessed = ? WHERE key = ?', (time.time(), key))
+        self.conn.commit()
+        return row[0]
+
+    def put(self, key: str, model: str, response: str):
+        if not self.writable or response is None:
+            return
+        now = time.time()
+        self.conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)',
+                          (key, model, response, now, now))
+        self.conn.commit()
+        self.writes += 1
+        if self.writes % self._EVICT_EVERY == 0:
+            self.evict()
+
+    def evict(self):
+        """Drops expired entries, then the least recently used ones above `max_entries`."""
+        if self.conn is None:
+            return
+        if self.max_age_days is not None:
+            self.conn.execute('DELETE FROM responses WHERE created < ?',
+                              (time.time() - self.max_age_days * 86400,))
+        if self.max_entries is not None:
+            self.conn.execute('''DELETE FROM responses WHERE key IN (
+                SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?)''',
+                              (self.max_entries,))
+        self.conn.commit()
+
+    def _expired(self, created: float) -> bool:
+        return self.max_age_days is not None and created < time.time() - self.max_age_days * 86400
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "writes": self.writes,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+################################################################################
+#                                 CLAIM CACHE                                  #
+################################################################################
+
+def normalize_claim(claim: str) -> str:
+    """Folds case, whitespace and the final period, so trivially different claims share a verdict."""
+    return ' '.join(claim.split()).rstrip('.').casefold()
+
+def claim_key(topic: str, claim: str, verifier: str) -> str:
+    payload = json.dumps([topic, normalize_claim(claim), verifier], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+class ClaimCache:
+    """A SQLite-backed cache of claim verdicts keyed on `claim_key`.
+
+    Verdicts are stored per (topic, claim, verifier model), so a claim about a
+    topic is verified once, whichever response or length setting it came from.
+    `mode` works as for `ResponseCache`.
+    """
+
+    def __init__(self, path: str, mode: str = "readwrite"):
+        if mode not in CACHE_MODES:
+            raise ValueError(f'Unknown cache mode: {mode}')
+        self.path = path
+        self.mode = mode
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.conn = None
+        if mode == "off":
+            return
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS claims (
+            key TEXT PRIMARY KEY,
+            topic TEXT,
+            claim TEXT,
+            verifier TEXT,
+            supported INTEGER,
+            created REAL)''')
+        self.conn.commit()
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(args.claim_cache_path, args.claim_cache_mode)
+
+    @property
+    def readable(self) -> bool:
+        return self.mode in ("read", "readwrite")
+
+    @property
+    def writable(self) -> bool:
+        return self.mode in ("write", "readwrite")
+
+    def get_many(self, keys: list) -> dict:
+        """Returns the cached verdicts of `keys` as {key: supported}."""
+        if not self.readable:
+            return {}
+        found = {}
+        keys = list(dict.fromkeys(keys))
+        # stay below SQLite's limit on bound parameters
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            rows = self.conn.execute(
+                f'SELECT key, supported FROM claims WHERE key IN ({",".join("?" * len(chunk))})', chunk)
+            found.update((key, bool(supported)) for key, supported in rows)
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, topic: str, verifier: str, verdicts: dict):
+        """Stores {claim: supported} for one topic and verifier in one transaction."""
+        if not self.writable or not verdicts:
+            return
+        now = time.time()
+        self.conn.executemany('INSERT OR REPLACE INTO claims VALUES (?, ?, ?, ?, ?, ?)', [
+            (claim_key(topic, claim, verifier), topic, claim, verifier, int(supported), now)
+            for claim, supported in verdicts.items()])
+        self.conn.commit()
+        self.writes += len(verdicts)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "writes": self.writes,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
@@ -0,0 +1,192 @@
+"""This file provides checkpointed output files so that interrupted runs can be resumed."""
+import hashlib
+import json
+import logging
+import os
+
+from tools import JsonlinesWriter, json_loads
+
+# output fields of the generator scripts that hold generated text
+LENGTH_FIELDS = ["topic1_output", "topic2_output", "output"]
+
+# arguments that change how a run is executed, but not what it produces
+_NON_EXPERIMENT_ARGS = {
+    'api_key', 'output_dir', 'start', 'end', 'resume', 'reformat_model',
+    'concurrency', 'max_in_flight', 'rpm', 'tpm',
+    'batch', 'batch_dir', 'batch_size', 'batch_poll_interval',
+    'cache_mode', 'cache_path', 'cache_max_entries', 'cache_max_age_days',
+    'metrics_path', 'prometheus_path', 'otel',
+    'coalesce', 'coalesce_lease',
+    'local_batch_size', 'local_batch_wait',
+    'split_processes', 'flip_workers', 'continue_workers',
+    'num_shards', 'shard_id', 'queue_path', 'queue_lease',
+}
+# arguments that select where responses come from; see `backend_params`
+_BACKEND_ARGS = {'backend', 'base_url', 'local_engine', 'local_model'}
+
+def backend_params(args) -> dict:
+    """Returns the arguments that tell the responses of another backend or endpoint apart.
+
+    Runs against the OpenAI API return none, so they keep the run ID they had before.
+    """
+    backend = getattr(args, 'backend', 'openai')
+    if backend == 'local':
+        return {'backend': backend, 'local_engine': args.local_engine, 'local_model': args.local_model or args.model}
+    if backend != 'openai':
+        return {'backend': backend}
+    if getattr(args, 'base_url', None) is not None:
+        return {'base_url': args.base_url}
+    return {}
+
+def experiment_params(args) -> dict:
+    """Returns the arguments of `args` that define the experiment."""
+    params = {k: v for k, v in vars(args).items() if k not in _NON_EXPERIMENT_ARGS | _BACKEND_ARGS}
+    params.update(backend_params(args))
+    return dict(sorted(params.items()))
+
+def run_id(params: dict) -> str:
+    """Derives a short deterministic ID from the experiment parameters."""
+    payload = json.dumps(params, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:10]
+
+class RunWriter:
+    """Writes the records of one run in fsync'd batches, together with a manifest.
+
+    The manifest (`<output>.manifest`) starts with the run parameters, followed by
+    one line per flushed batch holding the completed `index` values and the size of
+    the output file after the batch. On resume, anything written after the last
+    committed batch is truncated, so records are never duplicated. `on_flush` is
+    called with the `index` values of every batch once it is committed.
+    """
+
+    def __init__(self, output_path: str, params: dict, resume: bool = False, flush_every: int = 20,
+                 on_flush=None):
+        self.output_path = output_path
+        self.manifest_path = output_path + '.manifest'
+        self.params = params
+        self.flush_every = flush_every
+        self.on_flush = on_flush
+        self.completed = set()
+        self.buffer = []
+
+        if resume and os.path.exists(self.manifest_path):
+            self._load_manifest()
+        elif os.path.exists(self.output_path) and os.path.getsize(self.output_path) > 0:
+            raise FileExistsError(f'{self.output_path} already exists. '
+                                  f'Use --resume to continue it, or remove it to start over.')
+        else:
+            with open(self.manifest_path, 'w') as f:
+                f.write(json.dumps({'run_id': run_id(params), 'params': params}) + '\n')
+            open(self.output_path, 'w').close()
+        # the writer only flushes when told to, so each flush is one manifest batch
+        self.writer = JsonlinesWriter(self.output_path, 'a', buffer_size=float('inf'), fsync=True)
+
+    def _load_manifest(self):
+        with open(self.manifest_path, 'r') as f:
+            lines = f.read().split('\n')
+        header = json.loads(lines[0])
+        if header['params'] != self.params:
+            raise ValueError(f'{self.manifest_path} was written with different parameters: {header["params"]}')
+
+        offset = 0
+        # the last line is either empty or a batch that was cut off mid-write
+        for line in lines[1:-1]:
+            batch = json.loads(line)
+            self.completed.update(batch['indices'])
+            offset = batch['offset']
+        with open(self.output_path, 'a+') as f:
+            f.truncate(offset)
+        with open(self.manifest_path, 'r+') as f:
+            f.seek(len('\n'.join(lines[:-1]).encode('utf-8')) + 1)
+            f.truncate()
+        logging.info(f"Resuming {self.output_path}: {len(self.completed)} tasks already completed.")
+
+    def pending(self, tasks):
+        """Lazily filters out the tasks whose `index` is already in the manifest."""
+        return (task for task in tasks if task['index'] not in self.completed)
+
+    def write(self, record: dict):
+        self.buffer.append(record)
+        if len(self.buffer) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        self.writer.write_many(self.buffer)
+        self.writer.flush()
+        offset = self.writer.tell()
+        indices = [record['index'] for record in self.buffer]
+        # the batch only counts as done once the manifest line is on disk
+        with open(self.manifest_path, 'a') as f:
+            f.write(json.dumps({'indices': indices, 'offset': offset}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.completed.update(indices)
+        self.buffer = []
+        if self.on_flush is not None:
+            self.on_flush(indices)
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def read_run_params(output_path: str):
+    """Returns the parameters recorded in the manifest of an output file, or None."""
+    manifest_path = output_path + '.manifest'
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, 'r') as f:
+        return json.loads(f.readline())['params']
+
+def requested_lengths(params: dict) -> dict:
+    """Returns the requested number of words of each output field of a run."""
+    if "context_length" in params:
+        return {"topic1_output": params["context_length"], "output": params["evaluation_length"]}
+    if params.get("setting") == "single":
+        return {"output": params["topic1_length"]}
+    if params.get("setting") == "multiple":
+        return {"topic1_output": params["topic1_length"], "topic2_output": params["topic2_length"],
+                "output": params["topic1_length"] + params["topic2_length"]}
+    if "length" in params:
+        return {"output": params["length"]}
+    return {}
+
+def committed_records(output_path: str):
+    """Yields the records of an output file up to the last batch committed in its manifest."""
+    offset = 0
+    with open(output_path + '.manifest', 'r') as f:
+        lines = f.read().split('\n')
+    for line in lines[1:]:
+        try:
+            offset = json.loads(line)['offset']
+        except ValueError:
+            # an empty line, or a batch that was cut off mid-write
+            break
+    with open(output_path, 'rb') as f:
+        data = f.read(offset)
+    for line in data.splitlines():
+        if line.strip():
+            yield json_loads(line)
+
+def rewrite_run(output_path: str, params: dict, records):
+    """Replaces the records of a finished run, e.g. after regenerating some of them.
+
+    `records` may be read lazily from `output_path` itself: the new file and its
+    manifest are written next to it and only moved into place once complete.
+    """
+    tmp_path = output_path + '.rewrite'
+    for path in (tmp_path, tmp_path + '.manifest'):
+        if os.path.exists(path):
+            os.remove(path)
+    with RunWriter(tmp_path, params, flush_every=float('inf')) as writer:
+        for record in records:
+            writer.write(record)
+    os.replace(tmp_path, output_path)
+    os.replace(tmp_path + '.manifest', output_path + '.manifest')
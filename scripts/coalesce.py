@@ -0,0 +1,127 @@
+"""This file coalesces identical in-flight requests, so that overlapping experiments
+(e.g. `long_context.py` and `facts_exhaustion.py --setting multiple` with the same
+topics and lengths) pay for each completion only once."""
+import asyncio
+import logging
+import os
+import time
+import uuid
+
+COALESCE_MODES = ["off", "process", "shared"]
+
+class RequestCoalescer:
+    """Lets one caller per request key generate the response and fans it out.
+
+    Within a process, callers with the same key wait on the future of the first
+    one. In `shared` mode the first caller also takes a lease on the key in the
+    SQLite response cache, and other processes holding the same key poll the cache
+    for its response instead of sending their own request. Only responses stored
+    after the caller joined are taken, so an expired or stale entry of the cache is
+    never returned in place of the one being generated. The leader renews its lease
+    while it waits (e.g. on a batch job); a lease that is not renewed expires after
+    `lease_seconds`, so a crashed process only delays the others.
+    """
+
+    def __init__(self, cache=None, mode: str = "process", lease_seconds: float = 300,
+                 poll_interval: float = 1.0):
+        if mode not in COALESCE_MODES:
+            raise ValueError(f'Unknown coalesce mode: {mode}')
+        self.mode = mode
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.owner = f'{os.getpid()}-{uuid.uuid4().hex[:8]}'
+        self.inflight = {}
+        self.renewals = {}
+        self.coalesced = 0
+        self.shared = 0
+        self.conn = None
+        if mode == "shared":
+            if cache is None or cache.conn is None or not cache.writable:
+                logging.warning("Shared coalescing needs a writable response cache; coalescing in-process only.")
+            else:
+                self.conn = cache.conn
+                self.conn.execute('''CREATE TABLE IF NOT EXISTS inflight (
+                    key TEXT PRIMARY KEY,
+                    owner TEXT,
+                    expires REAL)''')
+                self.conn.commit()
+
+    @classmethod
+    def from_args(cls, args, cache=None):
+        return cls(cache, args.coalesce, args.coalesce_lease)
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != "off"
+
+    async def join(self, key: str):
+        """Returns the response of an identical request made by someone else, or
+        None once the caller is the one that has to make it.
+
+        A caller that gets None must call `release` when it is done, and `publish`
+        before that if it got a response.
+        """
+        while True:
+            future = self.inflight.get(key)
+            if future is None:
+                break
+            response = await asyncio.shield(future)
+            if response is not None:
+                self.coalesced += 1
+                return response
+            # the request failed for the other caller, so try to make it ourselves
+
+        self.inflight[key] = asyncio.get_running_loop().create_future()
+        if self.conn is None:
+            return None
+        joined = time.time()
+        while not self._acquire_lease(key):
+            await asyncio.sleep(self.poll_interval)
+            response = self._lookup(key, joined)
+            if response is not None:
+                self.shared += 1
+                self._settle(key, response)
+                return response
+        self.renewals[key] = asyncio.create_task(self._renew_lease(key))
+        return None
+
+    def publish(self, key: str, response: str):
+        self._settle(key, response)
+
+    def release(self, key: str):
+        """Ends the lead on `key`; callers still waiting retry on their own."""
+        self._settle(key, None)
+        renewal = self.renewals.pop(key, None)
+        if renewal is not None:
+            renewal.cancel()
+        if self.conn is not None:
+            self.conn.execute('DELETE FROM inflight WHERE key = ? AND owner = ?', (key, self.owner))
+            self.conn.commit()
+
+    def _settle(self, key: str, response):
+        future = self.inflight.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(response)
+
+    def _acquire_lease(self, key: str) -> bool:
+        now = time.time()
+        cursor = self.conn.execute('''INSERT INTO inflight VALUES (?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET owner = excluded.owner, expires = excluded.expires
+            WHERE inflight.expires < ?''', (key, self.owner, now + self.lease_seconds, now))
+        self.conn.commit()
+        return cursor.rowcount == 1
+
+    async def _renew_lease(self, key: str):
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            self.conn.execute('UPDATE inflight SET expires = ? WHERE key = ? AND owner = ?',
+                              (time.time() + self.lease_seconds, key, self.owner))
+            self.conn.commit()
+
+    def _lookup(self, key: str, since: float):
+        row = self.conn.execute('SELECT response FROM responses WHERE key = ? AND created >= ?',
+                                (key, since)).fetchone()
+        return row[0] if row is not None else None
+
+    def stats(self) -> dict:
+        return {"coalesced": self.coalesced, "shared": self.shared}
@@ -0,0 +1,419 @@
+"""This file provides a shared asyncio engine for running generation tasks concurrently."""
+import asyncio
+import json
+import logging
+import time
+
+from openai import AsyncOpenAI
+from tqdm import tqdm
+
+from rate_limit import RateLimiter, estimate_tokens, is_transient, is_rate_limit, backoff_delay
+from cache import ResponseCache, request_key, CACHE_MODES
+from telemetry import Telemetry, RequestStats, record_call
+from coalesce import RequestCoalescer, COALESCE_MODES
+from tools import parse_hash_blocks, PARSE_MALFORMED
+
+################################################################################
+#                                 CHAT CLIENT                                  #
+################################################################################
+
+class ChatClient:
+    """Sends chat completion requests for the generator scripts.
+
+    All requests of a run share one connection pool, one rate limiter and one
+    response cache. Failed requests are retried with jittered exponential backoff,
+    but only when the error is transient. Identical requests in flight at the same
+    time are sent once through `coalescer`. The latency, usage and retries of every
+    call are reported to `telemetry`. `endpoint` names where responses come from
+    when it is not the OpenAI API; it is part of every cache key, so responses of
+    other backends or endpoints are never served in place of real ones.
+    """
+
+    def __init__(self, client: AsyncOpenAI, limiter: RateLimiter = None,
+                 cache: ResponseCache = None, telemetry: Telemetry = None,
+                 coalescer: RequestCoalescer = None, endpoint: str = None):
+        self.client = client
+        self.endpoint = endpoint
+        self.limiter = limiter or RateLimiter()
+        self.cache = cache
+        self.telemetry = telemetry or Telemetry()
+        self.coalescer = coalescer
+
+    @classmethod
+    def from_args(cls, args):
+        # retries are handled here, so the SDK must not retry on its own
+        client = AsyncOpenAI(api_key=args.api_key, base_url=args.base_url, max_retries=0)
+        cache = ResponseCache.from_args(args)
+        return cls(client, RateLimiter(args.rpm, args.tpm), cache, Telemetry.from_args(args),
+                   RequestCoalescer.from_args(args, cache), endpoint=args.base_url)
+
+    async def complete(self, messages, model, temperature, expected_words=None,
+                       parse=None, label=None, max_retries=5, n=1):
+        """Returns the response text, or `parse(response)` when `parse` is given.
+
+        `expected_words` is the requested output length, used to estimate the tokens
+        of the request. `parse` runs inside the retry loop, so a response it rejects
+        is generated again. Responses are looked up in the cache first and only
+        stored once `parse` accepted them, which is also when callers waiting on an
+        identical request get the response. With `n` > 1, `n` samples are requested
+        in one call and returned (and cached) together as a list.
+        """
+        params = {"temperature": temperature}
+        if n > 1:
+            params["n"] = n
+        if self.endpoint is not None:
+            params["endpoint"] = self.endpoint
+        key = request_key(model, messages, **params)
+        if self.cache is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                try:
+                    result = _parse_choices(_decode_choices(cached, n), parse, n)
+                    self._observe(RequestStats(model, cached=True))
+                    return result
+                except Exception as e:
+                    print(f"Cached response for topic '{label}' rejected, regenerating: {e}")
+
+        leading = False
+        if self.coalescer is not None and self.coalescer.enabled:
+            shared = await self.coalescer.join(key)
+            if shared is None:
+                leading = True
+            else:
+                try:
+                    result = _parse_choices(_decode_choices(shared, n), parse, n)
+                    self._observe(RequestStats(model, coalesced=True))
+                    return result
+                except Exception as e:
+                    print(f"Coalesced response for topic '{label}' rejected, regenerating: {e}")
+
+        try:
+            return await self._generate_response(key, messages, model, temperature, expected_words,
+                                                 parse, label, max_retries, leading, n)
+        finally:
+            if leading:
+                self.coalescer.release(key)
+
+    async def _generate_response(self, key, messages, model, temperature, expected_words, parse, label,
+                                 max_retries, leading, n=1):
+        """Requests, parses and caches a response, retrying transient failures."""
+        estimated = estimate_tokens(messages, expected_words, n)
+        call = RequestStats(model)
+        started = time.perf_counter()
+        for attempt in range(max_retries):
+            try:
+                choices = await self._request(messages, model, temperature, estimated, attempt, call, n)
+                result = _parse_choices(choices, parse, n)
+                response = choices[0] if n == 1 else json.dumps(choices, ensure_ascii=False)
+                if self.cache is not None:
+                    self.cache.put(key, model, response)
+                if leading:
+                    self.coalescer.publish(key, response)
+                call.total_latency = time.perf_counter() - started
+                call.retries = attempt
+                self._observe(call)
+                return result
+
+            except Exception as e:
+                print(f"Attempt {attempt + 1}/{max_retries} failed: {e}")
+                if not is_transient(e) or attempt == max_retries - 1:
+                    call.total_latency = time.perf_counter() - started
+                    call.retries, call.failed = attempt, True
+                    self._observe(call)
+                if not is_transient(e):
+                    raise RuntimeError(f"Permanent error for topic '{label}': {e}") from e
+                if attempt == max_retries - 1:
+                    raise RuntimeError(f"Max retries exceeded for topic '{label}': {e}") from e
+                delay = backoff_delay(attempt, e)
+                if is_rate_limit(e):
+                    self.limiter.pause(delay)
+                await asyncio.sleep(delay)
+
+    async def _request(self, messages, model, temperature, estimated_tokens, attempt, call, n=1):
+        """Sends one request within the rate limits and returns the texts of its `n` choices.
+
+        The usage and finish reason of the completion are stored in `call`, and the
+        time spent in the HTTP calls, without the rate limiter, in `call.latency`.
+        """
+        choices, usage, finish_reason = [], {"prompt_tokens": 0, "completion_tokens": 0}, None
+        call.latency = 0.0
+        reserved = 0
+        # endpoints that ignore `n` return a single choice, so the missing ones are requested again
+        while len(choices) < n:
+            missing = n - len(choices)
+            # every HTTP call counts against the request budget, and its share of the estimated tokens
+            reservation = estimated_tokens * missing // n
+            await self.limiter.acquire(reservation)
+            reserved += reservation
+            request_started = time.perf_counter()
+            completion = await self.client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                **({"n": missing} if missing > 1 else {}),
+            )
+            call.latency += time.perf_counter() - request_started
+            if completion.usage is not None:
+                usage["prompt_tokens"] += completion.usage.prompt_tokens or 0
+                usage["completion_tokens"] += completion.usage.completion_tokens or 0
+            finish_reason = finish_reason or completion.choices[0].finish_reason
+            choices += [choice.message.content for choice in completion.choices][:missing]
+        if usage["prompt_tokens"] or usage["completion_tokens"]:
+            self.limiter.settle(reserved, usage["prompt_tokens"] + usage["completion_tokens"])
+        call.record_usage(usage, finish_reason)
+        return choices
+
+    def _observe(self, call: RequestStats):
+        self.telemetry.observe(call)
+        record_call(call)
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.close()
+        self.telemetry.close()
+        if self.coalescer is not None:
+            logging.info(f"Coalesced requests: {self.coalescer.stats()}")
+        if self.cache is not None:
+            logging.info(f"Response cache: {self.cache.stats()}")
+            self.cache.close()
+
+def _decode_choices(stored: str, n: int) -> list:
+    """Returns the choices of a response stored by the cache or a coalescer."""
+    return [stored] if n == 1 else json.loads(stored)
+
+def _parse_choices(choices: list, parse, n: int):
+    if parse is not None:
+        choices = [parse(choice) for choice in choices]
+    return choices[0] if n == 1 else choices
+
+################################################################################
+#                             SECTIONED RESPONSES                              #
+################################################################################
+_SECTIONS_PLACEHOLDER = '[SECTIONS]'
+
+REFORMAT_PROMPT = f"""
+You are a helpful assistant. You will be given a text that should be split into sections, but its format is broken. \
+Rewrite it into the following format:
+{_SECTIONS_PLACEHOLDER}
+Keep the wording of the text exactly as it is. Return ONLY the reformatted text, and nothing else.
+""".strip()
+
+async def _reformat_hash_blocks(client, response, model, number_of_blocks, titles, label, max_retries):
+    """Parses a response, sending it back once to `model` to be reformatted if it is malformed.
+
+    Returns the text the parse was made from (the reformatted one once it parses) and the parse.
+    """
+    result = parse_hash_blocks(response, number_of_blocks, titles)
+    if result.status != PARSE_MALFORMED:
+        return response, result
+
+    sections = "\n\n".join(f"### {title} ###\n<text about {title}>" for title in titles)
+    reformat_messages = [
+        {"role": "system", "content": REFORMAT_PROMPT.replace(_SECTIONS_PLACEHOLDER, sections)},
+        {"role": "user", "content": response}
+    ]
+    reformatted = await client.complete(reformat_messages, model, 0,
+                                        expected_words=len(response.split()), label=label,
+                                        max_retries=max_retries)
+    result = parse_hash_blocks(reformatted, number_of_blocks, titles)
+    if result.status == PARSE_MALFORMED:
+        return response, result
+    result.repair = 'reformat'
+    return reformatted, result
+
+async def complete_hash_blocks(client, messages, model, temperature, number_of_blocks, titles=None,
+                               expected_words=None, label=None, max_retries=5, reformat_model=None, n=1):
+    """Requests a response made of hash blocks and returns it with its `SectionParse`.
+
+    A malformed response is first repaired locally, then sent back once to
+    `reformat_model` (default: `model`) to be reformatted, and only regenerated in
+    full if both fail; the text returned is always the one the parse was made from.
+    With `n` > 1, the lists of the `n` samples and their parses
+    are returned; samples are not regenerated, since that would draw them again
+    from the same request, so a sample may stay `PARSE_MALFORMED`.
+    """
+    responses = await client.complete(messages, model, temperature, expected_words=expected_words,
+                                      label=label, max_retries=max_retries, n=n)
+    if n > 1:
+        results = await asyncio.gather(*[
+            _reformat_hash_blocks(client, response, reformat_model or model, number_of_blocks, titles,
+                                  label, max_retries)
+            for response in responses])
+        return [response for response, _ in results], [result for _, result in results]
+
+    response, result = await _reformat_hash_blocks(client, responses, reformat_model or model,
+                                                   number_of_blocks, titles, label, max_retries)
+    if result.status != PARSE_MALFORMED:
+        return response, result
+
+    def parse_strict(response):
+        result = parse_hash_blocks(response, number_of_blocks, titles)
+        if result.status == PARSE_MALFORMED:
+            raise ValueError(f'Expected {number_of_blocks} hash blocks, found: {result.blocks}')
+        result.repair = 'regenerate'
+        return response, result
+
+    return await client.complete(messages, model, temperature, expected_words=expected_words,
+                                 parse=parse_strict, label=label, max_retries=max_retries)
+
+def build_client(args) -> ChatClient:
+    """Returns the client for the backend and request mode selected in `args`."""
+    if args.backend != 'openai':
+        if args.batch:
+            raise ValueError('--batch is only supported by the openai backend')
+        from backends import LocalClient, FakeClient
+        return {"local": LocalClient, "fake": FakeClient}[args.backend].from_args(args)
+    if args.api_key is None:
+        raise ValueError('--api_key is required with --backend openai')
+    if args.batch:
+        from batch import BatchClient
+        return BatchClient.from_args(args)
+    return ChatClient.from_args(args)
+
+################################################################################
+#                              CONCURRENT RUNNER                               #
+################################################################################
+
+async def run_tasks(worker, tasks, concurrency=8, max_in_flight=None, callback=None, desc=None, total=None):
+    """Run the async `worker` over `tasks` with at most `concurrency` calls at a time.
+
+    At most `max_in_flight` tasks (default: twice the concurrency) are held between
+    being read from `tasks` and being handed to `callback`, so memory stays bounded
+    even when one slow request holds back the ones queued after it.
+    Results are passed to `callback` in the original task order, which keeps the
+    output files identical to a serial run. `total` sizes the progress bar of lazy
+    `tasks` that have no length.
+    """
+    if concurrency < 1:
+        raise ValueError(f'Concurrency must be at least 1, got {concurrency}')
+    max_in_flight = max(max_in_flight or 2 * concurrency, concurrency)
+
+    queue = asyncio.Queue()
+    window = asyncio.Semaphore(max_in_flight)
+    finished = {}
+    next_pos = 0
+    if total is None and hasattr(tasks, '__len__'):
+        total = len(tasks)
+    progress = tqdm(total=total, desc=desc)
+
+    def flush():
+        # hand over results in task order and free their slots in the window
+        nonlocal next_pos
+        while next_pos in finished:
+            result = finished.pop(next_pos)
+            if callback is not None:
+                callback(result)
+            next_pos += 1
+            window.release()
+
+    async def produce():
+        for pos, task in enumerate(tasks):
+            await window.acquire()
+            await queue.put((pos, task))
+        for _ in range(concurrency):
+            await queue.put(None)
+
+    async def consume():
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            pos, task = item
+            finished[pos] = await worker(task)
+            progress.update(1)
+            flush()
+
+    producer = asyncio.create_task(produce())
+    consumers = [asyncio.create_task(consume()) for _ in range(concurrency)]
+    try:
+        await asyncio.gather(producer, *consumers)
+    finally:
+        for t in [producer, *consumers]:
+            t.cancel()
+        progress.close()
+    return next_pos
+
+def run_generation(client, worker, tasks, args, callback=None, total=None):
+    """Runs `worker` over `tasks` with the engine settings in `args`, then closes `client`.
+
+    `total` is the expected number of `tasks`, for the progress bar.
+    """
+    concurrency, max_in_flight = args.concurrency, args.max_in_flight
+    if args.batch:
+        tasks = list(tasks)
+        # every request has to be waiting before the batch can be submitted
+        concurrency = max_in_flight = max(len(tasks), 1)
+
+    async def _run():
+        try:
+            return await run_tasks(worker, tasks, concurrency=concurrency,
+                                   max_in_flight=max_in_flight, callback=callback, total=total)
+        finally:
+            await client.close()
+    return asyncio.run(_run())
+
+################################################################################
+#                               ARGUMENT PARSING                               #
+################################################################################
+
+def check_samples(args):
+    """Rejects a `--samples` count below 1, and warns when the samples cannot differ."""
+    if args.samples < 1:
+        raise ValueError(f'--samples must be at least 1, got {args.samples}')
+    if args.samples > 1 and args.temperature == 0:
+        logging.warning(f"--samples {args.samples} with --temperature 0: the samples will be (nearly) identical")
+
+def add_engine_args(parser):
+    """Adds the arguments shared by all generator scripts that use the engine."""
+    parser.add_argument('--backend', type=str, default='openai', choices=['openai', 'local', 'fake'],
+                        help="Where requests are sent: an OpenAI-compatible API, a model in this process, or fake responses")
+    parser.add_argument('--base_url', type=str, default=None,
+                        help="Base URL of an OpenAI-compatible API (default: the OpenAI API)")
+    parser.add_argument('--local_engine', type=str, default='vllm', choices=['vllm', 'llama_cpp'],
+                        help="Inference engine of the local backend")
+    parser.add_argument('--local_model', type=str, default=None,
+                        help="Model name or path loaded by the local backend (default: --model)")
+    parser.add_argument('--local_batch_size', type=int, default=32,
+                        help="Maximum number of requests the local backend generates in one batch")
+    parser.add_argument('--local_batch_wait', type=float, default=0.05,
+                        help="Seconds the local backend waits for a batch to fill up")
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help="Maximum number of requests sent to the API at the same time")
+    parser.add_argument('--max_in_flight', type=int, default=None,
+                        help="Maximum number of tasks buffered ahead of the output file (default: 2 x concurrency)")
+    parser.add_argument('--rpm', type=float, default=None,
+                        help="Requests-per-minute budget (default: unlimited)")
+    parser.add_argument('--tpm', type=float, default=None,
+                        help="Tokens-per-minute budget, estimated from the prompt and the requested length (default: unlimited)")
+    parser.add_argument('--reformat_model', type=str, default=None,
+                        help="Model that reformats malformed sectioned responses (default: the generation model)")
+    parser.add_argument('--resume', action='store_true',
+                        help="Continue the run with the same parameters, skipping completed tasks")
+    parser.add_argument('--batch', action='store_true',
+                        help="Submit all requests through the OpenAI Batch API instead of one by one")
+    parser.add_argument('--batch_dir', type=str, default='output/batches',
+                        help="Where the rendered Batch API input files are kept")
+    parser.add_argument('--batch_size', type=int, default=50000,
+                        help="Maximum number of requests per batch job")
+    parser.add_argument('--batch_poll_interval', type=float, default=30,
+                        help="Seconds between two status checks of a batch job")
+    parser.add_argument('--cache-mode', '--cache_mode', dest='cache_mode', type=str,
+                        default='readwrite', choices=CACHE_MODES,
+                        help="How the local response cache is used")
+    parser.add_argument('--cache_path', type=str, default='output/cache/responses.sqlite',
+                        help="Path to the SQLite response cache")
+    parser.add_argument('--cache_max_entries', type=int, default=None,
+                        help="Evict the least recently used responses above this many entries")
+    parser.add_argument('--cache_max_age_days', type=float, default=None,
+                        help="Evict responses older than this many days")
+    parser.add_argument('--coalesce', type=str, default='shared', choices=COALESCE_MODES,
+                        help="Send identical in-flight requests once: within this process, or also across processes sharing --cache_path")
+    parser.add_argument('--coalesce_lease', type=float, default=300,
+                        help="Seconds after which another process takes over a shared request that was not answered")
+    parser.add_argument('--metrics_path', type=str, default=None,
+                        help="Write the run-level telemetry summary to this JSON file")
+    parser.add_argument('--prometheus_path', type=str, default=None,
+                        help="Keep the run metrics in this Prometheus text file, e.g. for node_exporter's textfile collector")
+    parser.add_argument('--otel', action='store_true',
+                        help="Also report the run metrics through OpenTelemetry (requires opentelemetry-api)")
+    return parser
@@ -0,0 +1,254 @@
+"""This file runs the autocorrelation analysis of the error-propagation study.
+
+Every response is split into sentences, and every sentence is labelled supported
+or unsupported by verifying it as one claim with the `fact_scorer.py` verifier
+(records that already carry `--labels_field` are not verified again). The labels
+of all responses are then packed into padded (responses x sentences) arrays, and
+for every lag k up to `--max_lag` the following are computed in one vectorized
+pass:
+- the lag-k autocorrelation of the error indicator (1 = unsupported), pooled over
+  responses and averaged per response,
+- P(error at t + k | error at t) and P(error at t + k | supported at t),
+- a permutation p-value, shuffling the sentences within each response,
+- a bootstrap confidence interval, resampling whole topics.
+"""
+import argparse
+import asyncio
+import glob
+import json
+import logging
+import os
+import sys
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools import *
+from engine import build_client, add_engine_args
+from cache import ClaimCache
+from agreement import bootstrap_weights
+from fact_scorer import ClaimVerifier, add_verifier_args
+from split_first_sentence import split_sentences_many
+
+################################################################################
+#                                    LABELS                                    #
+################################################################################
+
+async def label_sentences(records: list, args):
+    """Verifies the `sentences` of every record and stores the verdicts in `args.labels_field`."""
+    client = build_client(args)
+    cache = ClaimCache.from_args(args)
+    verifier = ClaimVerifier.from_args(client, cache, args)
+    try:
+        claims_by_topic = {}
+        for record in records:
+            claims_by_topic.setdefault(record['topic'], []).extend(record['sentences'])
+        await verifier.verify_all(claims_by_topic, args)
+    finally:
+        await client.close()
+        logging.info(f"Claim cache: {cache.stats()}, {verifier.calls} verifier calls")
+        cache.close()
+    for record in records:
+        record[args.labels_field] = verifier.verdicts(record['topic'], record['sentences'])
+
+def pad_labels(labels: list) -> tuple:
+    """Packs per-response sentence labels (True = supported, None = unknown) into arrays.
+
+    Returns `errors` (1.0 where a sentence is unsupported), `valid` (False for
+    padding and unknown labels) and `in_response` (False for padding only), all of
+    shape (responses, longest response).
+    """
+    lengths = np.fromiter((len(sequence) for sequence in labels), dtype=np.int64, count=len(labels))
+    width = int(lengths.max()) if len(labels) else 0
+    in_response = np.arange(width) < lengths[:, None]
+    values = np.full((len(labels), width), np.nan)
+    values[in_response] = [np.nan if label is None else float(not label) for sequence in labels for label in sequence]
+    valid = ~np.isnan(values)
+    return np.nan_to_num(values), valid, in_response
+
+################################################################################
+#                               AUTOCORRELATION                                #
+################################################################################
+
+def lagged_sums(a: np.ndarray, b: np.ndarray, max_lag: int) -> np.ndarray:
+    """Returns sum_t a[..., t] * b[..., t + k] for k = 1..max_lag, shape (..., max_lag)."""
+    padding = np.zeros(b.shape[:-1] + (max_lag,), dtype=b.dtype)
+    windows = sliding_window_view(np.concatenate([b, padding], axis=-1), max_lag + 1, axis=-1)
+    return np.einsum('...t,...tk->...k', a, windows[..., 1:])
+
+def centered(errors: np.ndarray, valid: np.ndarray) -> tuple:
+    """Centers every response on its own error rate; returns the values and their sum of squares."""
+    counts = valid.sum(axis=-1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = np.where(counts > 0, (errors * valid).sum(axis=-1, keepdims=True) / counts, 0)
+    values = (errors - means) * valid
+    return values, (values ** 2).sum(axis=-1)
+
+def permutation_null(values: np.ndarray, in_response: np.ndarray, max_lag: int, n_permutations: int,
+                     rng: np.random.Generator, chunk_size: int = 50) -> np.ndarray:
+    """Lag products pooled over responses, for `n_permutations` shuffles of the sentences
+    within each response; shape (n_permutations, max_lag)."""
+    null = []
+    for start in range(0, n_permutations, chunk_size):
+        size = min(chunk_size, n_permutations - start)
+        # padding sorts last, so only the sentences of each response are shuffled
+        keys = np.where(in_response, rng.random((size,) + values.shape), np.inf)
+        shuffled = np.take_along_axis(np.broadcast_to(values, keys.shape), keys.argsort(axis=-1), axis=-1)
+        null.append(lagged_sums(shuffled, shuffled, max_lag).sum(axis=1))
+    return np.concatenate(null)
+
+def autocorrelation_report(labels: list, topics: list, max_lag: int = 5, n_permutations: int = 1000,
+                           n_resamples: int = 2000, alpha: float = 0.05, alternative: str = 'greater',
+                           seed: int = 0, chunk_size: int = 500) -> dict:
+    """Computes the lag-1..`max_lag` statistics of all responses at once."""
+    rng = np.random.default_rng(seed)
+    errors, valid, in_response = pad_labels(labels)
+    values, squares = centered(errors, valid)
+    products = lagged_sums(values, values, max_lag)
+    pooled = products.sum(axis=0) / squares.sum()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        per_response = products / squares[:, None]
+
+    valid_float = valid.astype(float)
+    pairs = lagged_sums(valid_float, valid_float, max_lag).sum(axis=0)
+    error_first = errors * valid
+    supported_first = (1 - errors) * valid
+    with np.errstate(divide='ignore', invalid='ignore'):
+        after_error = lagged_sums(error_first, error_first, max_lag).sum(axis=0) / \
+            lagged_sums(error_first, valid_float, max_lag).sum(axis=0)
+        after_supported = lagged_sums(supported_first, error_first, max_lag).sum(axis=0) / \
+            lagged_sums(supported_first, valid_float, max_lag).sum(axis=0)
+
+    null = permutation_null(values, in_response, max_lag, n_permutations, rng) / squares.sum()
+    if alternative == 'greater':
+        exceed = null >= pooled
+    else:
+        center = null.mean(axis=0)
+        exceed = np.abs(null - center) >= np.abs(pooled - center)
+    p_values = (1 + exceed.sum(axis=0)) / (1 + n_permutations)
+
+    topic_ids = np.unique(np.asarray(topics), return_inverse=True)[1]
+    resampled = []
+    for start in range(0, n_resamples, chunk_size):
+        weights = bootstrap_weights(len(labels), min(chunk_size, n_resamples - start), topic_ids, rng)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            resampled.append((weights @ products) / (weights @ squares)[:, None])
+    resampled = np.concatenate(resampled)
+    low = np.nanquantile(resampled, alpha / 2, axis=0)
+    high = np.nanquantile(resampled, 1 - alpha / 2, axis=0)
+
+    report = {
+        "responses": len(labels),
+        "sentences": int(valid.sum()),
+        "error_rate": float(errors[valid].mean()) if valid.any() else None,
+        "lags": {},
+    }
+    for k in range(max_lag):
+        finite = np.isfinite(per_response[:, k])
+        report["lags"][k + 1] = {
+            "pairs": int(pairs[k]),
+            "autocorrelation": float(pooled[k]),
+            "ci": [float(low[k]), float(high[k])],
+            "mean_response_autocorrelation": float(per_response[finite, k].mean()) if finite.any() else None,
+            "null_mean": float(null[:, k].mean()),
+            "p_value": float(p_values[k]),
+            "p_error_after_error": float(after_error[k]),
+            "p_error_after_supported": float(after_supported[k]),
+        }
+    return report
+
+################################################################################
+#                                     MAIN                                     #
+################################################################################
+
+def load_records(args) -> list:
+    """Reads the responses to analyse, with the file they came from in `source`."""
+    paths = sorted({path for pattern in args.input_paths for path in glob.glob(pattern)
+                    if path.endswith('.jsonl')})
+    records = []
+    for path in paths:
+        for record in jsonlines_iter(path):
+            labelled = record.get(args.labels_field) is not None
+            text = record.get(args.field)
+            if labelled or (text and not generic_abstain_detect(text)):
+                record.setdefault('source', path)
+                records.append(record)
+    return records
+
+def main(args):
+    records = load_records(args)
+    unlabelled = [record for record in records if record.get(args.labels_field) is None]
+    if unlabelled:
+        if args.api_key is None and args.backend == 'openai':
+            raise ValueError(f'--api_key is required to label the sentences of {len(unlabelled)} responses')
+        for record, sentences in zip(unlabelled, split_sentences_many([record[args.field] for record in unlabelled],
+                                                                       args.split_processes)):
+            record['sentences'] = sentences
+        asyncio.run(label_sentences(unlabelled, args))
+        if args.labels_path:
+            with JsonlinesWriter(args.labels_path, 'w') as writer:
+                for record in records:
+                    writer.write({key: record.get(key) for key in
+                                  ('source', 'index', 'topic', 'sentences', args.labels_field)})
+
+    by_source = {}
+    for record in records:
+        if len(record[args.labels_field]) > 1:
+            by_source.setdefault(record['source'], []).append(record)
+    report = {}
+    for source, group in by_source.items():
+        labels = [record[args.labels_field] for record in group]
+        if all(label is None for sequence in labels for label in sequence):
+            # e.g. every verifier call failed
+            logging.warning(f"{source}: none of the sentences has a label, skipping it")
+            continue
+        result = report[source] = autocorrelation_report(
+            labels, [record['topic'] for record in group],
+            args.max_lag, args.n_permutations, args.n_resamples, args.alpha, args.alternative, args.seed)
+        print(f"{source}: {result['responses']} responses, {result['sentences']} sentences, "
+              f"error rate {result['error_rate']:.3f}")
+        for lag, stats in result["lags"].items():
+            print(f"  lag {lag}: r = {stats['autocorrelation']:.3f} [{stats['ci'][0]:.3f}, {stats['ci'][1]:.3f}] "
+                  f"(null {stats['null_mean']:.3f}, p = {stats['p_value']:.4f}), "
+                  f"P(error | error) = {stats['p_error_after_error']:.3f}, "
+                  f"P(error | supported) = {stats['p_error_after_supported']:.3f}")
+
+    if args.output_path:
+        with open(args.output_path, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Sentence-level autocorrelation of factual errors")
+    parser.add_argument('--input_paths', type=str, nargs='+', required=True,
+                        help="Response JSONL files or glob patterns, or a --labels_path file of an earlier run")
+    parser.add_argument('--field', type=str, default='output',
+                        help="Field of each record that holds the response")
+    parser.add_argument('--labels_field', type=str, default='sentence_supported',
+                        help="Field with the supported (true) / unsupported (false) label of each sentence")
+    parser.add_argument('--labels_path', type=str, default=None,
+                        help="Optional path to save the sentences and their labels, to analyse them again without API calls")
+    parser.add_argument('--max_lag', type=int, default=5)
+    parser.add_argument('--n_permutations', type=int, default=1000,
+                        help="Number of within-response shuffles of the permutation test")
+    parser.add_argument('--alternative', type=str, default='greater', choices=['greater', 'two-sided'],
+                        help="Alternative hypothesis of the permutation test")
+    parser.add_argument('--n_resamples', type=int, default=2000,
+                        help="Number of topic bootstrap resamples")
+    parser.add_argument('--alpha', type=float, default=0.05,
+                        help="Significance level of the confidence intervals")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--split_processes', type=int, default=None,
+                        help="Number of processes that split the responses into sentences")
+    parser.add_argument('--model', type=str, default='gpt-4o',
+                        help="Model that verifies the sentences")
+    parser.add_argument('--output_path', type=str, default=None,
+                        help="Optional path to write the report as JSON")
+    parser.add_argument('--api_key', type=str, default=None,
+                        help="OpenAI API key, needed with the openai backend for responses without labels")
+    add_verifier_args(parser)
+    add_engine_args(parser)
+
+    args = parser.parse_args()
+    main(args)
@@ -1,72 +1,61 @@
 """This file is used to generate responses with model's dafault output length."""
-from openai import OpenAI
-
-from datetime import datetime
-from tqdm import tqdm
 import argparse
 import os
 import logging
-import time
+from functools import partial
 import sys
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from tools import *
+from engine import build_client, run_generation, add_engine_args
+from checkpoint import experiment_params, run_id
+from shards import ShardedRun, add_shard_args
+from telemetry import instrument
+from prompts import NAIVE_FACTUALITY, build_messages
 
-NAIVE_FACTUALITY_PROMPT = f"""
-You are a helpful assistant. You will be given an entity name. You need to generate a bio for it. Here are the instructions:
-1. Be sure to only include accurate, factual information in the response.
-2. The bio should be comprehensive and detailed.
-3. Do not include any controversial, disputable, or inaccurate factual claims in the response.
-4. Return ONLY the bio, and nothing else.
-""".strip()
+def system_prompt(args, task):
+    return NAIVE_FACTUALITY.render()
     
-def generate_bio(client, task, args, max_retries=5):
+async def generate_bio(client, task, args, max_retries=5):
     """Generate a biography for a given topic."""
     
-    system_prompt = NAIVE_FACTUALITY_PROMPT
     question = f"Tell me about {task['topic']}."
-    messages = [
-        {"role": "system", "content": system_prompt},
-        {"role": "user", "content": question}
-    ]
+    messages = build_messages(system_prompt(args, task), question)
     
-    for attempt in range(max_retries):
-        try:
-            completion = client.chat.completions.create(
-                model=args.model,
-                messages=messages,
-                temperature=args.temperature,
-            )
-            task['input'] = question
-            task['output'] = completion.choices[0].message.content
-            return task
-            
-        except Exception as e:
-            print(f"Attempt {attempt + 1}/{max_retries} failed: {e}")
-            if attempt == max_retries - 1:
-                raise RuntimeError(f"Max retries exceeded for topic '{task['topic']}': {e}")
-            time.sleep(1)
+    task['output'] = await client.complete(messages, args.model, args.temperature,
+                                           label=task['topic'], max_retries=max_retries)
+    task['input'] = question
+    return task
 
-def main(args):
-    
-    dt_string = datetime.now().strftime("%m_%d_%H_%M")
-    client = OpenAI(api_key=args.api_key)
+def prepare_run(args, all_data=None):
+    """Returns the tasks, output path, experiment parameters and worker of a run."""
     
-    all_data = jsonlines_load(args.input_path)
-    tasks = all_data[args.start:args.end]
+    if all_data is None:
+        tasks = jsonlines_iter(args.input_path, args.start, args.end)
+    else:
+        tasks = all_data[args.start:args.end]
     
     # check if output directory exists, if not, create it
     if not os.path.exists(args.output_dir):
         os.makedirs(args.output_dir)
-    output_path = f'{args.output_dir}/{args.model}_default_{dt_string}.jsonl'
+    params = experiment_params(args)
+    output_path = f'{args.output_dir}/{args.model}_default_{run_id(params)}.jsonl'
     
-    for task in tqdm(tasks):
-        result = generate_bio(client, task, args)
-        jsonlines_dump(output_path, result)
+    return tasks, output_path, params, instrument(partial(generate_bio, args=args))
+
+def main(args):
     
-    logging.info(f"All tasks completed. Results saved to {output_path}")
+    tasks, output_path, params, worker = prepare_run(args)
+    client = build_client(args)
     
-if __name__ == '__main__':
+    with ShardedRun(output_path, params, args) as writer:
+        pending = writer.pending(tasks)
+        run_generation(client, partial(worker, client), pending, args, callback=writer.write,
+                       total=writer.remaining(jsonlines_count(args.input_path, args.start, args.end)))
+    
+    logging.info(f"All tasks completed. Results saved to {writer.output_path}")
+    
+def build_parser():
     parser = argparse.ArgumentParser(description="Generate biographies for autocorrelation analysis")
     parser.add_argument('--input_path', type=str, \
         default='../../data/dataset/biography_generation.jsonl',\
@@ -78,8 +67,12 @@ if __name__ == '__main__':
     parser.add_argument('--start', type=int, default=0)
     parser.add_argument('--end', type=int, default=-1)
     parser.add_argument('--temperature', type=float, default=0)
-    parser.add_argument('--api_key', type=str, required=True,
-                        help="OpenAI API key")
-    
-    args = parser.parse_args()
-    main(args)
\ No newline at end of file
+    parser.add_argument('--api_key', type=str, default=None,
+                        help="OpenAI API key, needed with the openai backend")
+    add_engine_args(parser)
+    add_shard_args(parser)
+    return parser
+
+if __name__ == '__main__':
+    args = build_parser().parse_args()
+    main(args)
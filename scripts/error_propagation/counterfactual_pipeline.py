@@ -0,0 +1,201 @@
+"""This file runs the counterfactual analysis end to end:
+split first sentence -> flip factuality -> parse `New bio:` -> continue generation.
+
+Each stage has its own pool of workers and hands every response to the next stage
+as soon as it is done. Each stage also checkpoints its results, so `--resume`
+restarts every response at the first stage it has not finished.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools import *
+from engine import build_client, add_engine_args
+from checkpoint import RunWriter, experiment_params, run_id
+from telemetry import instrument
+from prompt_counterfactual_analysis import FLIP_FACTUALITY_PROMPT, flip_factuality_instruction, \
+    CONTINUE_GEN_PROMPT, continue_gen_instruction, _ORIGINAL_FIRST_SENT, _ALL_SUPPORTED_FACTS, \
+    _TOPIC_PLACEHOLDER, _FIRST_SENTENCE_BIO
+from split_first_sentence import split_sentences, get_punkt_tokenizer
+
+STAGES = ["split", "flip", "continue"]
+
+_FLIP_PATTERN = re.compile(r'New unsupported facts:\s*(.*?)\s*New bio:\s*(.*)', re.DOTALL)
+_NEW_BIO_PATTERN = re.compile(r'New bio:\s*(.*)', re.DOTALL)
+
+def parse_flip_response(response):
+    """Returns the new unsupported facts and the new one-sentence bio of a flip response."""
+    match = _FLIP_PATTERN.search(response)
+    if match:
+        return strip_string(match.group(1)), strip_string(match.group(2))
+    match = _NEW_BIO_PATTERN.search(response)
+    if match:
+        return None, strip_string(match.group(1))
+    raise ValueError(f'No `New bio:` in flip response: {response!r}')
+
+def format_supported_facts(facts):
+    if isinstance(facts, list):
+        return "\n".join(f"- {fact}" for fact in facts)
+    return facts or ""
+
+################################################################################
+#                                    STAGES                                    #
+################################################################################
+
+async def split_stage(record, args, pool):
+    sentences = await asyncio.get_running_loop().run_in_executor(pool, split_sentences, record[args.field] or "")
+    record['first_sentence'] = sentences[0] if sentences else ""
+    return record
+
+async def flip_stage(record, client, args, max_retries=5):
+    instruction = flip_factuality_instruction.replace(_ORIGINAL_FIRST_SENT, record['first_sentence'])\
+        .replace(_ALL_SUPPORTED_FACTS, format_supported_facts(record.get('supported_facts')))
+    messages = [
+        {"role": "system", "content": FLIP_FACTUALITY_PROMPT},
+        {"role": "user", "content": instruction}
+    ]
+
+    def fill_record(response):
+        new_facts, new_bio = parse_flip_response(response)
+        record['flip_output'] = response
+        record['new_unsupported_facts'] = new_facts
+        record['new_first_sentence'] = new_bio
+        return record
+
+    return await client.complete(messages, args.model, args.temperature,
+                                 expected_words=2 * len(record['first_sentence'].split()),
+                                 parse=fill_record, label=record['topic'], max_retries=max_retries)
+
+async def continue_stage(record, client, args, max_retries=5):
+    instruction = continue_gen_instruction.replace(_TOPIC_PLACEHOLDER, record['topic'])\
+        .replace(_FIRST_SENTENCE_BIO, record['new_first_sentence'])
+    messages = [
+        {"role": "system", "content": CONTINUE_GEN_PROMPT},
+        {"role": "user", "content": instruction}
+    ]
+    record['continued_output'] = await client.complete(messages, args.model, args.temperature,
+                                                       label=record['topic'], max_retries=max_retries)
+    return record
+
+async def run_stage(fn, workers, inbox, outbox, writer):
+    """Runs `fn` over the items of `inbox` until every worker received a `None`."""
+    async def work():
+        while True:
+            record = await inbox.get()
+            if record is None:
+                return
+            result = await fn(record)
+            writer.write(result)
+            if outbox is not None:
+                await outbox.put(result)
+    await asyncio.gather(*[work() for _ in range(workers)])
+
+################################################################################
+#                                   PIPELINE                                   #
+################################################################################
+
+def stage_paths(args):
+    params = experiment_params(args)
+    prefix = f'{args.output_dir}/{args.model}_counterfactual_{run_id(params)}'
+    return params, {stage: f'{prefix}_{stage}.jsonl' for stage in STAGES}
+
+def load_stage_records(writer):
+    """Returns the committed records of a stage, keyed by `index`."""
+    writer.flush()
+    return {record['index']: record for record in jsonlines_iter(writer.output_path)}
+
+async def run_pipeline(records, writers, client, args, pool):
+    workers = {"split": args.split_processes, "flip": args.flip_workers, "continue": args.continue_workers}
+    inboxes = {stage: asyncio.Queue(maxsize=4 * workers[stage]) for stage in STAGES}
+    fns = {
+        "split": lambda record: split_stage(record, args, pool),
+        "flip": instrument(lambda record: flip_stage(record, client, args), key='flip_telemetry'),
+        "continue": instrument(lambda record: continue_stage(record, client, args), key='continue_telemetry'),
+    }
+
+    # responses are picked up after the last stage they completed
+    done = {stage: load_stage_records(writers[stage]) for stage in STAGES}
+    start_items = {stage: [] for stage in STAGES}
+    for record in records:
+        index = record['index']
+        if index in done["continue"]:
+            continue
+        elif index in done["flip"]:
+            start_items["continue"].append(done["flip"][index])
+        elif index in done["split"]:
+            start_items["flip"].append(done["split"][index])
+        else:
+            start_items["split"].append(record)
+    logging.info(f"Responses per starting stage: { {s: len(items) for s, items in start_items.items()} }")
+
+    tasks = []
+    for i, stage in enumerate(STAGES):
+        outbox = inboxes[STAGES[i + 1]] if i + 1 < len(STAGES) else None
+        tasks.append(asyncio.create_task(run_stage(fns[stage], workers[stage], inboxes[stage], outbox, writers[stage])))
+
+    async def feed_and_close(i, stage):
+        for item in start_items[stage]:
+            await inboxes[stage].put(item)
+        # a stage is out of input once its own items are queued and the previous stage has finished
+        if i > 0:
+            await tasks[i - 1]
+        for _ in range(workers[stage]):
+            await inboxes[stage].put(None)
+
+    feeders = [asyncio.create_task(feed_and_close(i, stage)) for i, stage in enumerate(STAGES)]
+    try:
+        await asyncio.gather(*tasks, *feeders)
+    finally:
+        for t in tasks + feeders:
+            t.cancel()
+        await client.close()
+
+def main(args):
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+    params, paths = stage_paths(args)
+    records = list(jsonlines_iter(args.input_path, args.start, args.end))
+    client = build_client(args)
+
+    # records are passed on and extended by the next stage, so each one is written immediately
+    writers = {stage: RunWriter(paths[stage], {**params, "stage": stage}, resume=args.resume, flush_every=1)
+               for stage in STAGES}
+    try:
+        with ProcessPoolExecutor(args.split_processes, initializer=get_punkt_tokenizer) as pool:
+            asyncio.run(run_pipeline(records, writers, client, args, pool))
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    logging.info(f"All tasks completed. Results saved to {paths['continue']}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the counterfactual analysis pipeline")
+    parser.add_argument('--input_path', type=str, required=True,
+                        help="JSONL file of generated responses, e.g. from autocorrelation_response_gen.py")
+    parser.add_argument('--output_dir', type=str, \
+        default='../output/counterfactual')
+    parser.add_argument('--field', type=str, default='output',
+                        help="Field of each record that holds the response")
+    parser.add_argument('--model', type=str, default='gpt-4o',
+                        help="OpenAI model to use for flipping and continuing")
+    parser.add_argument('--start', type=int, default=0)
+    parser.add_argument('--end', type=int, default=None)
+    parser.add_argument('--temperature', type=float, default=0)
+    parser.add_argument('--split_processes', type=int, default=2,
+                        help="Number of processes splitting first sentences")
+    parser.add_argument('--flip_workers', type=int, default=8,
+                        help="Number of concurrent flip requests")
+    parser.add_argument('--continue_workers', type=int, default=8,
+                        help="Number of concurrent continuation requests")
+    parser.add_argument('--api_key', type=str, default=None,
+                        help="OpenAI API key, needed with the openai backend")
+    add_engine_args(parser)
+
+    args = parser.parse_args()
+    main(args)
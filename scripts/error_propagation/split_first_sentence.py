@@ -2,42 +2,81 @@
 # === Code from the FActScore repository https://github.com/shmsw25/FActScore/tree/main ===
 
 import re
-from nltk.tokenize import sent_tokenize
-import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+import nltk
 import argparse
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools import jsonlines_iter, JsonlinesWriter
+
+_INITIALS_PATTERN = re.compile(r"[A-Z]\. ?[A-Z]\.")
+_punkt_tokenizer = None
+
+def get_punkt_tokenizer():
+    """Loads the English Punkt model that `nltk.sent_tokenize` uses, once per process."""
+    global _punkt_tokenizer
+    if _punkt_tokenizer is None:
+        try:
+            from nltk.tokenize import PunktTokenizer
+            _punkt_tokenizer = PunktTokenizer("english")
+        except ImportError:
+            # NLTK < 3.8.2 ships the model as a pickle
+            _punkt_tokenizer = nltk.data.load("tokenizers/punkt/english.pickle")
+    return _punkt_tokenizer
 
 def split_sentences(text):
-    sentences = []
+    """Splits a response into sentences, keeping initials such as "J. K." together."""
     initials = detect_initials(text)
-    
-    curr_sentences = sent_tokenize(text)
-    curr_sentences_2 = sent_tokenize(text)
+    curr_sentences = get_punkt_tokenizer().tokenize(text)
+    return fix_sentence_splitter(curr_sentences, initials)
 
-    curr_sentences = fix_sentence_splitter(curr_sentences, initials)
-    curr_sentences_2 = fix_sentence_splitter(curr_sentences_2, initials)
+def split_sentences_many(texts, processes=None, chunksize=64):
+    """Splits many responses, in order, with the same output as `split_sentences`.
 
-    # checking this, just to ensure the crediability of the sentence splitter fixing algorithm
-    assert curr_sentences == curr_sentences_2, (text, curr_sentences, curr_sentences_2)
-
-    sentences += curr_sentences
-    
-    return sentences
+    With `processes` > 1 the texts are split in a process pool, where every worker
+    loads the Punkt model once.
+    """
+    if not processes or processes <= 1:
+        return [split_sentences(text) for text in texts]
+    with ProcessPoolExecutor(processes, initializer=get_punkt_tokenizer) as pool:
+        return list(pool.map(split_sentences, texts, chunksize=chunksize))
 
 def detect_initials(text):
-    pattern = r"[A-Z]\. ?[A-Z]\."
-    match = re.findall(pattern, text)
-    return [m for m in match]
+    return _INITIALS_PATTERN.findall(text)
 
 # === To fix sentence tokenization ===
+def _index_endings(sentences):
+    """Maps each "X." ending to the positions of the sentences that end with it."""
+    endings = {}
+    for i, sent in enumerate(sentences[:-1]):
+        endings.setdefault(sent[-2:], []).append(i)
+    return endings
+
 def fix_sentence_splitter(curr_sentences, initials):
+    curr_sentences = list(curr_sentences)
+    # "\0" never occurs in an initial, so a match in the joined text lies within one sentence
+    joined = "\0".join(curr_sentences)
+    endings = None
+    # initials whose outcome cannot change until the next merge
+    settled = set()
     for initial in initials:
+        if initial in settled:
+            continue
+        settled.add(initial)
         # if not found in any sentence, then use the following logic to merge the sentences
-        if not np.any([initial in sent for sent in curr_sentences]):
+        if initial not in joined:
             alpha1, alpha2 = [t.strip() for t in initial.split(".") if len(t.strip())>0]
-            for i, (sent1, sent2) in enumerate(zip(curr_sentences, curr_sentences[1:])):
-                if sent1.endswith(alpha1 + ".") and sent2.startswith(alpha2 + "."):
+            if endings is None:
+                endings = _index_endings(curr_sentences)
+            for i in endings.get(alpha1 + ".", []):
+                if curr_sentences[i+1].startswith(alpha2 + "."):
                     # merge sentence i and i+1
-                    curr_sentences = curr_sentences[:i] + [curr_sentences[i] + " " + curr_sentences[i+1]] + curr_sentences[i+2:]
+                    curr_sentences[i:i+2] = [curr_sentences[i] + " " + curr_sentences[i+1]]
+                    joined = "\0".join(curr_sentences)
+                    endings = None
+                    settled = set()
                     break
     sentences = []
     combine_with_previous = None
@@ -64,15 +103,36 @@ def fix_sentence_splitter(curr_sentences, initials):
     return sentences
 
 def main(args):
-    # === Test the sentence splitter ===
-    sentences = split_sentences(args.text)
-    first_sentence = sentences[0] if sentences else ""
-    print(f"First sentence: {first_sentence}")
-    print(f"Completed text: {args.text}")
+    if args.input_path is None:
+        # === Test the sentence splitter ===
+        sentences = split_sentences(args.text)
+        first_sentence = sentences[0] if sentences else ""
+        print(f"First sentence: {first_sentence}")
+        print(f"Completed text: {args.text}")
+        return
+
+    # === Split all responses of a generation output file ===
+    records = list(jsonlines_iter(args.input_path))
+    texts = [record[args.field] or "" for record in records]
+    all_sentences = split_sentences_many(texts, processes=args.processes)
+    with JsonlinesWriter(args.output_path, 'w') as writer:
+        for record, sentences in zip(records, all_sentences):
+            record['sentences'] = sentences
+            record['first_sentence'] = sentences[0] if sentences else ""
+            writer.write(record)
+    print(f"Split {len(records)} responses. Results saved to {args.output_path}")
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Split the first sentence from the response")
     parser.add_argument('--text', type=str, \
         default="Hello, this is a test response. It contains multiple sentences. You can replace this with your own text.")    
+    parser.add_argument('--input_path', type=str, default=None,
+                        help="Optional JSONL file of responses to split")
+    parser.add_argument('--output_path', type=str, default=None,
+                        help="Where to write the records with `sentences` and `first_sentence` added")
+    parser.add_argument('--field', type=str, default='output',
+                        help="Field of each record that holds the response")
+    parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                        help="Number of worker processes used for splitting")
     args = parser.parse_args()
-    main(args)
\ No newline at end of file
+    main(args)
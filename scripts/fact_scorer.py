@@ -0,0 +1,421 @@
+"""This file scores the factual precision of generated responses.
+
+Scoring runs in three phases over all input files at once:
+1. every response field (`--fields`) is split into atomic claims, one call each,
+2. the distinct claims of each topic without a cached verdict are verified in
+   batches of `--claims_per_call` claims per call, and the verdicts are stored
+   in the claim cache (`--claim_cache_path`),
+3. every response gets its factual precision: the share of its claims supported.
+Verdicts are keyed on the topic and the claim, so a claim repeated by the
+responses of several length settings (or runs) is verified only once.
+
+With `--index_dir`, the verifier judges the claims against passages of a local
+retrieval index (see `retrieval.py`) instead of its own knowledge: the top
+`--evidence_k` passages of every claim are retrieved in one batch, and each call
+gets the best `--max_evidence` passages for its claims.
+
+With `--calibrate`, the verifier first checks the statements of the human
+annotations. Its agreement with the majority decision, and its true and false
+positive rates, are saved to `--calibration_path`; the rates then correct the
+precision of the scored responses for the errors of the verifier.
+"""
+import argparse
+import asyncio
+import glob
+import json
+import logging
+import os
+import re
+import time
+from collections import Counter
+
+import numpy as np
+
+from tools import *
+from engine import build_client, run_tasks, add_engine_args
+from cache import ClaimCache, claim_key, normalize_claim, CACHE_MODES
+from checkpoint import read_run_params
+from prompts import CLAIM_EXTRACTION, CLAIM_VERIFICATION, CLAIM_VERIFICATION_EVIDENCE, build_messages
+from annotations import AnnotationStore, MISSING
+from agreement import majority_labels, cohen_kappa, group_ratio
+from retrieval import RetrievalIndex, RETRIEVAL_METHODS
+
+SCORE_FIELDS = ["output", "topic1_output", "topic2_output"]
+
+_CLAIM_PATTERN = re.compile(r'^\s*[-*•]\s+(.+?)\s*$', re.MULTILINE)
+_VERDICT_PATTERN = re.compile(r'^\W*(\d+)\s*[:.)-]\s*\W*(supported|unsupported)\b', re.IGNORECASE | re.MULTILINE)
+
+################################################################################
+#                              EXTRACT AND VERIFY                              #
+################################################################################
+
+def parse_claims(response: str) -> list:
+    claims = _CLAIM_PATTERN.findall(response)
+    if not claims:
+        raise ValueError('No claims found in the response')
+    return claims
+
+def parse_verdicts(response: str, n_claims: int) -> list:
+    """Returns whether each of the `n_claims` numbered claims is supported."""
+    verdicts = {}
+    for number, verdict in _VERDICT_PATTERN.findall(response):
+        verdicts.setdefault(int(number), verdict.lower() == 'supported')
+    missing = [i for i in range(1, n_claims + 1) if i not in verdicts]
+    if missing:
+        raise ValueError(f'No verdict for claims {missing}')
+    return [verdicts[i] for i in range(1, n_claims + 1)]
+
+async def extract_claims(client, topic: str, text: str, model: str, max_retries=5) -> list:
+    """Splits one response into atomic claims."""
+    messages = build_messages(CLAIM_EXTRACTION.render(), f"Entity: {topic}\n\nText:\n{text}")
+    return await client.complete(messages, model, 0, expected_words=2 * len(text.split()),
+                                 parse=parse_claims, label=topic, max_retries=max_retries)
+
+async def verify_claims(client, topic: str, claims: list, model: str, max_retries=5, evidence=None) -> list:
+    """Verifies a batch of claims about one topic in a single call; returns one bool per claim.
+
+    With `evidence` (a list of passages), the claims are judged against it.
+    """
+    question = "\n".join(f"{i}. {claim}" for i, claim in enumerate(claims, 1))
+    if evidence is None:
+        messages = build_messages(CLAIM_VERIFICATION.render(TOPIC=topic), question)
+    else:
+        knowledge = "\n\n".join(evidence) or "(no passages found)"
+        messages = build_messages(CLAIM_VERIFICATION_EVIDENCE.render(TOPIC=topic),
+                                  f"Knowledge:\n{knowledge}\n\nClaims:\n{question}")
+    return await client.complete(messages, model, 0, expected_words=2 * len(claims),
+                                 parse=lambda response: parse_verdicts(response, len(claims)),
+                                 label=topic, max_retries=max_retries)
+
+class ClaimVerifier:
+    """Verifies the claims of many responses with as few calls as possible.
+
+    `verify_all` drops duplicate claims per topic and those with a verdict in the
+    claim cache, then verifies the rest in batches of `claims_per_call`. Verdicts
+    are also kept in memory, so scoring works with the claim cache turned off.
+    With a `retriever`, verdicts are cached under the model and the index name.
+    """
+
+    def __init__(self, client, cache: ClaimCache, model: str, claims_per_call: int = 20,
+                 retriever: RetrievalIndex = None, evidence_k: int = 3, max_evidence: int = 10,
+                 method: str = "bm25", workers: int = 1):
+        self.client = client
+        self.cache = cache
+        self.model = model
+        self.claims_per_call = claims_per_call
+        self.retriever = retriever
+        self.evidence_k = evidence_k
+        self.max_evidence = max_evidence
+        self.method = method
+        self.workers = workers
+        self.verifier = model if retriever is None else f'{model}+{retriever.name}'
+        self.known = {}
+        self.calls = 0
+
+    @classmethod
+    def from_args(cls, client, cache: ClaimCache, args):
+        retriever = RetrievalIndex(args.index_dir) if args.index_dir else None
+        return cls(client, cache, args.model, args.claims_per_call, retriever, args.evidence_k,
+                   args.max_evidence, args.retrieval_method, args.retrieval_workers)
+
+    def pending(self, claims_by_topic: dict) -> list:
+        """Returns the (topic, claims) batches of the distinct claims without a verdict."""
+        batches = []
+        for topic, claims in claims_by_topic.items():
+            distinct = {claim_key(topic, claim, self.verifier): claim
+                        for claim in {normalize_claim(c): c for c in claims}.values()}
+            unknown = [key for key in distinct if key not in self.known]
+            self.known.update(self.cache.get_many(unknown))
+            missing = [distinct[key] for key in unknown if key not in self.known]
+            for start in range(0, len(missing), self.claims_per_call):
+                batches.append((topic, missing[start:start + self.claims_per_call]))
+        return batches
+
+    def retrieve(self, batches: list) -> list:
+        """Returns the evidence passages of every batch, retrieving for all claims at once.
+
+        The passages found for the claims of a batch are ranked by their summed
+        scores, and the best `max_evidence` are kept in their order in the index.
+        """
+        queries = [(topic, claim) for topic, claims in batches for claim in claims]
+        hits = self.retriever.search_many([claim for _, claim in queries], [topic for topic, _ in queries],
+                                          self.evidence_k, self.method, self.workers)
+        evidence, position = [], 0
+        for _, claims in batches:
+            scores, texts = Counter(), {}
+            for claim_hits in hits[position:position + len(claims)]:
+                for hit in claim_hits:
+                    scores[hit["passage_id"]] += hit["score"]
+                    texts[hit["passage_id"]] = hit["text"]
+            position += len(claims)
+            best = sorted(passage_id for passage_id, _ in scores.most_common(self.max_evidence))
+            evidence.append([texts[passage_id] for passage_id in best])
+        return evidence
+
+    async def verify_batch(self, batch: tuple):
+        topic, claims, evidence = batch
+        try:
+            verdicts = await verify_claims(self.client, topic, claims, self.model, evidence=evidence)
+        except RuntimeError as e:
+            logging.error(f"Could not verify {len(claims)} claims about '{topic}': {e}")
+            return batch
+        self.calls += 1
+        self.cache.put_many(topic, self.verifier, dict(zip(claims, verdicts)))
+        for claim, supported in zip(claims, verdicts):
+            self.known[claim_key(topic, claim, self.verifier)] = supported
+        return batch
+
+    async def verify_all(self, claims_by_topic: dict, args):
+        batches = self.pending(claims_by_topic)
+        n_claims = sum(len(claims) for _, claims in batches)
+        if self.retriever is not None:
+            started = time.perf_counter()
+            evidence = self.retrieve(batches)
+            logging.info(f"Retrieved evidence for {n_claims} claims in {time.perf_counter() - started:.2f}s")
+        else:
+            evidence = [None] * len(batches)
+        logging.info(f"Verifying {n_claims} new claims in {len(batches)} calls")
+        await _run_phase(self.verify_batch, [(topic, claims, passages) for (topic, claims), passages
+                                             in zip(batches, evidence)], args, desc='verify')
+
+    def verdicts(self, topic: str, claims: list) -> list:
+        """Returns the verdict of each claim, or None where it could not be verified."""
+        return [self.known.get(claim_key(topic, claim, self.verifier)) for claim in claims]
+
+async def _run_phase(worker, tasks: list, args, desc: str):
+    concurrency, max_in_flight = args.concurrency, args.max_in_flight
+    if args.batch:
+        # every request has to be waiting before the batch can be submitted
+        concurrency = max_in_flight = max(len(tasks), 1)
+    await run_tasks(worker, tasks, concurrency=concurrency, max_in_flight=max_in_flight, desc=desc)
+
+################################################################################
+#                                 CALIBRATION                                  #
+################################################################################
+
+def calibrate_precision(precision: float, calibration: dict):
+    """Corrects a precision measured by the verifier with its true and false positive
+    rates (Rogan-Gladen estimator), or returns None without a usable calibration."""
+    if calibration is None or precision is None:
+        return None
+    tpr, fpr = calibration["tpr"], calibration["fpr"]
+    if tpr is None or fpr is None or not np.isfinite([tpr, fpr]).all() or tpr <= fpr:
+        return None
+    return float(np.clip((precision - fpr) / (tpr - fpr), 0, 1))
+
+def _finite_or_none(value) -> float:
+    return float(value) if value is not None and np.isfinite(value) else None
+
+def _mean_or_none(values: np.ndarray) -> float:
+    return float(values.mean()) if len(values) else None
+
+async def calibrate(verifier: ClaimVerifier, store: AnnotationStore, args) -> dict:
+    """Verifies the annotated statements and compares the verdicts with the majority decision.
+
+    Rates that no judged statement supports (e.g. the TPR without any statement the
+    annotators found supported) are None.
+    """
+    claims_by_topic = {topic: [store.statements[row] for row in store.rows(topic)] for topic in store.topics}
+    await verifier.verify_all(claims_by_topic, args)
+
+    supported_code = store.label_names.index('supported')
+    majority = majority_labels(store.labels, len(store.label_names))
+    verdicts = [verifier.verdicts(store.topics[store.topic_ids[row]], [store.statements[row]])[0]
+                for row in range(len(store))]
+    judged = np.array([verdict is not None for verdict in verdicts])
+    keep = (majority != MISSING) & judged
+    human = majority[keep] == supported_code
+    machine = np.array([bool(verdict) for verdict in verdicts])[keep]
+
+    responses = store.response_ids[keep]
+    n_responses = len(store.responses)
+    human_precision = group_ratio(human.astype(float), responses, n_responses)
+    machine_precision = group_ratio(machine.astype(float), responses, n_responses)
+    scored = np.isfinite(human_precision)
+    kappa = cohen_kappa(human.astype(int), machine.astype(int), 2)[0] if keep.any() else None
+    return {
+        "verifier": verifier.verifier,
+        "n_statements": int(keep.sum()),
+        "accuracy": _mean_or_none(human == machine),
+        "cohen_kappa": _finite_or_none(kappa),
+        "tpr": _mean_or_none(machine[human]),
+        "fpr": _mean_or_none(machine[~human]),
+        "human_precision": _mean_or_none(human),
+        "verifier_precision": _mean_or_none(machine),
+        "response_precision_mae": _mean_or_none(np.abs(human_precision - machine_precision)[scored]),
+    }
+
+################################################################################
+#                                   SCORING                                    #
+################################################################################
+
+def collect_responses(paths: list, fields: list) -> list:
+    """Returns the non-empty, non-abstained response fields of all records."""
+    responses = []
+    for path in paths:
+        for record in jsonlines_iter(path):
+            for field in fields:
+                text = record.get(field)
+                if text and not generic_abstain_detect(text):
+                    responses.append({"path": path, "index": record.get("index"), "topic": record["topic"],
+                                      "field": field, "text": text})
+    return responses
+
+async def score_responses(client, verifier: ClaimVerifier, responses: list, args, calibration=None):
+    """Adds the claims, verdicts and precision of each response in place."""
+
+    async def extract(response):
+        try:
+            response["claims"] = await extract_claims(client, response["topic"], response["text"], args.model)
+        except RuntimeError as e:
+            logging.error(f"Could not extract the claims of {response['path']} #{response['index']}: {e}")
+            response["claims"] = None
+        return response
+
+    await _run_phase(extract, responses, args, desc='extract')
+    claims_by_topic = {}
+    for response in responses:
+        claims_by_topic.setdefault(response["topic"], []).extend(response["claims"] or [])
+    await verifier.verify_all(claims_by_topic, args)
+
+    for response in responses:
+        claims = response["claims"] or []
+        verdicts = verifier.verdicts(response["topic"], claims)
+        judged = [supported for supported in verdicts if supported is not None]
+        response["claims"] = claims
+        response["verdicts"] = verdicts
+        response["n_claims"] = len(claims)
+        response["n_supported"] = sum(judged)
+        response["precision"] = sum(judged) / len(judged) if judged else None
+        response["precision_calibrated"] = calibrate_precision(response["precision"], calibration)
+        del response["text"]
+
+def summarize_scores(responses: list) -> dict:
+    """Averages the scores of the responses per output file and field."""
+    groups = {}
+    for response in responses:
+        if response["precision"] is not None:
+            groups.setdefault(response["path"], {}).setdefault(response["field"], []).append(response)
+    report = {}
+    for path, fields in groups.items():
+        report[path] = {"params": read_run_params(path)}
+        for field, group in fields.items():
+            calibrated = [r["precision_calibrated"] for r in group if r["precision_calibrated"] is not None]
+            report[path][field] = {
+                "n": len(group),
+                "precision": float(np.mean([r["precision"] for r in group])),
+                "precision_calibrated": float(np.mean(calibrated)) if calibrated else None,
+                "claims": float(np.mean([r["n_claims"] for r in group])),
+                "supported_claims": float(np.mean([r["n_supported"] for r in group])),
+            }
+    return report
+
+async def run(args):
+    client = build_client(args)
+    cache = ClaimCache.from_args(args)
+    verifier = ClaimVerifier.from_args(client, cache, args)
+    try:
+        calibration = None
+        if args.calibrate:
+            calibration = await calibrate(verifier, AnnotationStore.load(args.annotation_paths), args)
+            rates = {key: f"{calibration[key]:.3f}" if calibration[key] is not None else "-"
+                     for key in ('accuracy', 'cohen_kappa', 'tpr', 'fpr')}
+            print(f"Calibration of {verifier.verifier}: accuracy {rates['accuracy']}, "
+                  f"kappa {rates['cohen_kappa']}, TPR {rates['tpr']}, FPR {rates['fpr']} "
+                  f"(n={calibration['n_statements']})")
+            if calibration['tpr'] is None or calibration['fpr'] is None:
+                logging.warning("The judged statements do not cover both supported and unsupported ones; "
+                                "the calibration is not saved and the precision is not corrected")
+            elif args.calibration_path:
+                if os.path.dirname(args.calibration_path):
+                    os.makedirs(os.path.dirname(args.calibration_path), exist_ok=True)
+                with open(args.calibration_path, 'w') as f:
+                    json.dump(calibration, f, indent=2)
+        elif args.calibration_path and os.path.exists(args.calibration_path):
+            with open(args.calibration_path) as f:
+                calibration = json.load(f)
+            if calibration["verifier"] != verifier.verifier:
+                logging.warning(f"Calibration was done for {calibration['verifier']}, not {verifier.verifier}; ignoring it")
+                calibration = None
+
+        paths = sorted({path for pattern in args.input_paths or [] for path in glob.glob(pattern)
+                        if path.endswith('.jsonl')})
+        if not paths:
+            return
+        responses = collect_responses(paths, args.fields)
+        await score_responses(client, verifier, responses, args, calibration)
+    finally:
+        await client.close()
+        logging.info(f"Claim cache: {cache.stats()}, {verifier.calls} verifier calls")
+        cache.close()
+
+    report = summarize_scores(responses)
+    for path, fields in report.items():
+        print(path)
+        for field, stats in fields.items():
+            if field == "params":
+                continue
+            calibrated = stats["precision_calibrated"]
+            print(f"  {field}: precision {stats['precision']:.3f}"
+                  + (f" (calibrated {calibrated:.3f})" if calibrated is not None else "")
+                  + f", {stats['supported_claims']:.1f}/{stats['claims']:.1f} claims supported (n={stats['n']})")
+
+    if args.output_path:
+        with open(args.output_path, 'w') as f:
+            for response in responses:
+                f.write(json.dumps(response, ensure_ascii=False) + '\n')
+    if args.report_path:
+        with open(args.report_path, 'w') as f:
+            json.dump(report, f, indent=2)
+
+def add_verifier_args(parser):
+    """Adds the arguments of `ClaimVerifier`, shared by the scripts that verify claims."""
+    parser.add_argument('--claims_per_call', type=int, default=20,
+                        help="Number of claims verified in one call")
+    parser.add_argument('--claim_cache_path', type=str, default='output/cache/claims.sqlite',
+                        help="SQLite file with the verdict of every claim checked so far")
+    parser.add_argument('--claim_cache_mode', type=str, default='readwrite', choices=CACHE_MODES,
+                        help="Whether claim verdicts are read from and/or written to the claim cache")
+    parser.add_argument('--index_dir', type=str, default=None,
+                        help="Local retrieval index (built with retrieval.py) to verify the claims against")
+    parser.add_argument('--evidence_k', type=int, default=3,
+                        help="Number of passages retrieved per claim")
+    parser.add_argument('--max_evidence', type=int, default=10,
+                        help="Maximum number of passages given to one verifier call")
+    parser.add_argument('--retrieval_method', type=str, default='bm25', choices=RETRIEVAL_METHODS,
+                        help="Retrieval scoring; dense and hybrid need an index built with --dense_model")
+    parser.add_argument('--retrieval_workers', type=int, default=1,
+                        help="Number of processes that share the retrieval of a batch")
+    return parser
+
+def main(args):
+    if not args.input_paths and not args.calibrate:
+        raise ValueError('Nothing to do: pass --input_paths and/or --calibrate')
+    asyncio.run(run(args))
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Score the factual precision of generated responses")
+    parser.add_argument('--input_paths', type=str, nargs='+', default=None,
+                        help="Output JSONL files or glob patterns, e.g. 'output/length_bias/*.jsonl'")
+    parser.add_argument('--fields', type=str, nargs='+', default=["output"], choices=SCORE_FIELDS,
+                        help="Response fields of each record to score")
+    parser.add_argument('--model', type=str, default='gpt-4o',
+                        help="Model that extracts and verifies the claims")
+    parser.add_argument('--calibrate', action='store_true',
+                        help="Check the verifier against the human annotations first")
+    parser.add_argument('--annotation_paths', type=str, nargs='+', default=None,
+                        help="Annotation files (default: data/human_annotations/human_annotation_*.jsonl)")
+    parser.add_argument('--calibration_path', type=str, default='output/fact_scores/calibration.json',
+                        help="Where --calibrate saves the verifier's error rates, which are then used to correct the precision")
+    parser.add_argument('--output_path', type=str, default=None,
+                        help="Optional path to write the claims, verdicts and precision of every response as JSONL")
+    parser.add_argument('--report_path', type=str, default=None,
+                        help="Optional path to write the precision per output file and field as JSON")
+    parser.add_argument('--api_key', type=str, default=None,
+                        help="OpenAI API key, needed with the openai backend")
+    add_verifier_args(parser)
+    add_engine_args(parser)
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,278 @@
+"""This file measures how closely generated responses follow the requested lengths.
+
+It streams the output files of any number of runs, counts the words of every
+`output`, `topic1_output` and `topic2_output`, and compares them with the lengths
+recorded in the run manifests. Per run (cell) and field it reports the adherence
+ratio (achieved / requested words), its histogram and the share of responses
+within the tolerance band. With `--regenerate`, only the responses outside the
+band are generated again and replaced in their output files.
+"""
+import argparse
+import glob
+import importlib
+import json
+import logging
+from functools import partial
+
+import numpy as np
+
+from tools import *
+from engine import build_client, run_generation, add_engine_args
+from checkpoint import LENGTH_FIELDS, read_run_params, requested_lengths, rewrite_run
+from sweep import SCRIPTS
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+ENGINE_ARGS = set(vars(add_engine_args(argparse.ArgumentParser()).parse_args([])))
+
+def script_name(params: dict):
+    """Returns the `SCRIPTS` entry of the script that produced a run with `params`."""
+    if "context_length" in params:
+        return "long_context"
+    if "setting" in params:
+        return "facts_exhaustion"
+    if "length" in params:
+        return "length_bias"
+    return None
+
+################################################################################
+#                                  COUNTING                                    #
+################################################################################
+
+class LengthTable:
+    """Columnar word (and optionally token) counts of the output fields of many runs.
+
+    Each row is one field of one record: `cells[i]` indexes `paths`, `fields[i]`
+    indexes `LENGTH_FIELDS`, and `words[i]` is compared with `requested[i]`.
+    Abstained or missing sections are skipped.
+    """
+
+    def __init__(self, encoding: str = None):
+        self.paths, self.params = [], []
+        self._cells, self._fields, self._index, self._requested, self._words, self._tokens = [], [], [], [], [], []
+        self.encoder = None
+        if encoding:
+            if tiktoken is None:
+                raise ImportError('tiktoken is required for token counts: pip install tiktoken')
+            self.encoder = tiktoken.get_encoding(encoding)
+
+    def add_run(self, path: str) -> bool:
+        """Streams one output file; returns False if its manifest has no requested lengths."""
+        params = read_run_params(path)
+        lengths = requested_lengths(params) if params else {}
+        if not lengths:
+            logging.warning(f"Skipping {path}: no manifest with requested lengths")
+            return False
+        cell = len(self.paths)
+        self.paths.append(path)
+        self.params.append(params)
+        for record in jsonlines_iter(path):
+            for field, requested in lengths.items():
+                text = record.get(field)
+                if not text:
+                    continue
+                self._cells.append(cell)
+                self._fields.append(LENGTH_FIELDS.index(field))
+                self._index.append(record['index'])
+                self._requested.append(requested)
+                self._words.append(len(text.split()))
+                if self.encoder is not None:
+                    self._tokens.append(len(self.encoder.encode(text)))
+        return True
+
+    def freeze(self):
+        self.cells = np.asarray(self._cells, dtype=np.int32)
+        self.fields = np.asarray(self._fields, dtype=np.int8)
+        self.index = np.asarray(self._index, dtype=np.int64)
+        self.requested = np.asarray(self._requested, dtype=np.float64)
+        self.words = np.asarray(self._words, dtype=np.float64)
+        self.tokens = np.asarray(self._tokens, dtype=np.float64) if self.encoder is not None else None
+        return self
+
+################################################################################
+#                                  ADHERENCE                                   #
+################################################################################
+
+def adherence_report(table: LengthTable, tolerance: float = 0.2, bin_width: float = 0.1,
+                     max_ratio: float = 3.0) -> dict:
+    """Computes the adherence statistics of every (cell, field) group in one pass.
+
+    The histogram counts adherence ratios in bins of `bin_width` from 0 to
+    `max_ratio`; the last bin also holds all larger ratios.
+    """
+    ratio = table.words / table.requested
+    within = np.abs(ratio - 1) <= tolerance
+    n_fields = len(LENGTH_FIELDS)
+    groups = table.cells.astype(np.int64) * n_fields + table.fields
+    n_groups = len(table.paths) * n_fields
+    n_bins = int(round(max_ratio / bin_width))
+
+    counts = np.bincount(groups, minlength=n_groups)
+    mean_words = np.bincount(groups, weights=table.words, minlength=n_groups) / np.maximum(counts, 1)
+    mean_ratio = np.bincount(groups, weights=ratio, minlength=n_groups) / np.maximum(counts, 1)
+    within_share = np.bincount(groups, weights=within, minlength=n_groups) / np.maximum(counts, 1)
+    bins = np.minimum((ratio / bin_width).astype(np.int64), n_bins - 1)
+    histograms = np.bincount(groups * n_bins + bins, minlength=n_groups * n_bins).reshape(n_groups, n_bins)
+    if table.tokens is not None:
+        mean_tokens = np.bincount(groups, weights=table.tokens, minlength=n_groups) / np.maximum(counts, 1)
+
+    # quantiles need the ratios of each group side by side
+    order = np.lexsort((ratio, groups))
+    bounds = np.searchsorted(groups[order], np.arange(n_groups + 1))
+    sorted_ratio = ratio[order]
+
+    report = {}
+    for group in np.flatnonzero(counts):
+        cell, field = divmod(int(group), n_fields)
+        group_ratio = sorted_ratio[bounds[group]:bounds[group + 1]]
+        p5, median, p95 = np.quantile(group_ratio, [0.05, 0.5, 0.95])
+        stats = {
+            "requested": int(requested_lengths(table.params[cell])[LENGTH_FIELDS[field]]),
+            "n": int(counts[group]),
+            "mean_words": float(mean_words[group]),
+            "mean_ratio": float(mean_ratio[group]),
+            "median_ratio": float(median),
+            "ratio_p5": float(p5),
+            "ratio_p95": float(p95),
+            "within_tolerance": float(within_share[group]),
+            "histogram": histograms[group].tolist(),
+        }
+        if table.tokens is not None:
+            stats["mean_tokens"] = float(mean_tokens[group])
+        report.setdefault(table.paths[cell], {})[LENGTH_FIELDS[field]] = stats
+    return report
+
+def outside_band(table: LengthTable, tolerance: float = 0.2) -> dict:
+    """Returns the `index` values of the records with any field outside the band, per output file."""
+    outside = np.abs(table.words / table.requested - 1) > tolerance
+    result = {}
+    for cell in np.unique(table.cells[outside]):
+        indices = np.unique(table.index[outside & (table.cells == cell)])
+        result[table.paths[cell]] = set(indices.tolist())
+    return result
+
+################################################################################
+#                                REGENERATION                                  #
+################################################################################
+
+def within_band(record: dict, lengths: dict, tolerance: float = 0.2) -> bool:
+    """Returns whether every field of `record` in `lengths` is within the tolerance band."""
+    return all(abs(len(record[field].split()) / requested - 1) <= tolerance
+               for field, requested in lengths.items() if record.get(field))
+
+def _check_length(expected_words: int, tolerance: float, parse, response: str):
+    words = len(response.split())
+    if abs(words / expected_words - 1) > tolerance:
+        raise ValueError(f'{words} words, outside +-{tolerance:.0%} of the requested {expected_words}')
+    return parse(response) if parse is not None else response
+
+class LengthCheckedClient:
+    """Wraps a client so that a response outside the tolerance band of its
+    `expected_words` is rejected by `parse`, and thus generated again."""
+
+    def __init__(self, client, tolerance: float = 0.2):
+        self.client, self.tolerance = client, tolerance
+
+    async def complete(self, messages, model, temperature, expected_words=None, parse=None, n=1, **kwargs):
+        if expected_words and n == 1:
+            parse = partial(_check_length, expected_words, self.tolerance, parse)
+        return await self.client.complete(messages, model, temperature, expected_words=expected_words,
+                                          parse=parse, n=n, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+def regenerate(path: str, params: dict, indices: set, args):
+    """Generates the records of `indices` again and replaces the ones now within the band in `path`.
+
+    A record whose regenerated response is still outside the band, or could not
+    be generated, is kept as it was.
+    """
+    module = importlib.import_module(SCRIPTS[script_name(params)])
+    cell_args = module.build_parser().parse_args([])
+    cell_args.api_key = args.api_key
+    for key, value in params.items():
+        setattr(cell_args, key, value)
+    # the engine settings of this run apply, but cached responses would only repeat the old lengths
+    for key in ENGINE_ARGS:
+        setattr(cell_args, key, getattr(args, key))
+    cell_args.cache_mode = 'write' if args.cache_mode in ('write', 'readwrite') else 'off'
+    cell_args.start, cell_args.end = 0, None
+
+    tasks = [record for record in jsonlines_iter(path) if record['index'] in indices]
+    _, _, _, worker = module.prepare_run(cell_args, tasks)
+    client = LengthCheckedClient(build_client(cell_args), args.tolerance)
+    lengths = requested_lengths(params)
+    regenerated = {}
+
+    async def regenerate_task(task):
+        try:
+            # the worker fills in its task, which has to stay intact if the new record is rejected
+            return await worker(client, dict(task))
+        except RuntimeError as e:
+            logging.warning(f"Keeping record {task['index']} of {path}: {e}")
+            return None
+
+    def collect(record):
+        if record is None or not within_band(record, lengths, args.tolerance):
+            return
+        record['length_regenerations'] = record.get('length_regenerations', 0) + 1
+        regenerated[record['index']] = record
+
+    run_generation(client, regenerate_task, tasks, cell_args, callback=collect)
+    records = (regenerated.get(record['index'], record) for record in jsonlines_iter(path))
+    rewrite_run(path, params, records)
+    logging.info(f"Regenerated {len(regenerated)} of {len(tasks)} responses in {path}; "
+                 f"kept the other {len(tasks) - len(regenerated)}")
+
+def main(args):
+    paths = sorted({path for pattern in args.input_paths for path in glob.glob(pattern)
+                    if path.endswith('.jsonl')})
+    table = LengthTable(args.encoding)
+    for path in paths:
+        table.add_run(path)
+    table.freeze()
+    report = adherence_report(table, args.tolerance, args.bin_width)
+
+    for path, fields in report.items():
+        print(path)
+        for field, stats in fields.items():
+            print(f"  {field}: requested {stats['requested']}, mean {stats['mean_words']:.0f} words, "
+                  f"ratio median {stats['median_ratio']:.2f} [p5 {stats['ratio_p5']:.2f}, p95 {stats['ratio_p95']:.2f}], "
+                  f"{stats['within_tolerance']:.1%} within +-{args.tolerance:.0%} (n={stats['n']})")
+
+    if args.output_path:
+        with open(args.output_path, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.regenerate:
+        for path, indices in outside_band(table, args.tolerance).items():
+            params = table.params[table.paths.index(path)]
+            if script_name(params) is None:
+                logging.warning(f"Cannot regenerate {path}: unknown script")
+                continue
+            regenerate(path, params, indices, args)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure achieved vs requested lengths of generated responses")
+    parser.add_argument('--input_paths', type=str, nargs='+', required=True,
+                        help="Output JSONL files or glob patterns, e.g. 'output/long_context/*.jsonl'")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="Tolerance band around the requested length, as a fraction of it")
+    parser.add_argument('--bin_width', type=float, default=0.1,
+                        help="Width of the adherence ratio histogram bins")
+    parser.add_argument('--encoding', type=str, default=None,
+                        help="Also count tokens with this tiktoken encoding, e.g. 'o200k_base'")
+    parser.add_argument('--output_path', type=str, default=None,
+                        help="Optional path to write the report as JSON")
+    parser.add_argument('--regenerate', action='store_true',
+                        help="Generate the responses outside the tolerance band again, in place")
+    parser.add_argument('--api_key', type=str, default=None,
+                        help="OpenAI API key, needed with --regenerate and the openai backend")
+    add_engine_args(parser)
+
+    args = parser.parse_args()
+    main(args)
@@ -1,105 +1,93 @@
 """This file is used to generate responses with varying lengths."""
-from openai import OpenAI
-
-from datetime import datetime
-from tqdm import tqdm
 import argparse
 import os
 import logging
-import time
+from functools import partial
 from tools import *
+from engine import build_client, check_samples, run_generation, add_engine_args
+from checkpoint import experiment_params, run_id
+from shards import ShardedRun, add_shard_args
+from telemetry import instrument
+from prompts import LENGTH_BIOGRAPHY, LENGTH_LONG_FACT, build_messages
 
-_LENGTH_PLACEHOLDER = '[LENGTH]'
-_CAT_PLACEHOLDER = '[CAT]'
-
-LENGTH_BIOGRPHY_PROMPT = f"""
-You are a helpful assistant. You will be given an entity name. You need to generate a bio for it. \
-Here are the instructions:
-1. The bio should be around {_LENGTH_PLACEHOLDER} words.
-2. Be sure to only include accurate, factual information in the response.
-3. The bio should be comprehensive and detailed.
-4. Do not include any controversial, disputable, or inaccurate factual claims in the response.
-5. Return ONLY the bio, and nothing else.
-""".strip()
+def get_task_type(input_path: str) -> str:
+    """Returns the task type of an input file from its name, or None if unknown."""
+    if "biography" in input_path:
+        return "biography"
+    elif "long_fact" in input_path:
+        return "long_fact"
+    return None
 
-LENGTH_LONG_FACT_PROMPT = f"""
-You are a helpful assistant. You will be given an entity related to `{_CAT_PLACEHOLDER}`. You need to provide a description of it. \
-Here are the instructions:
-1. The response should be around {_LENGTH_PLACEHOLDER} words.
-2. Be sure to only include accurate, factual information in the response.
-3. The response should be comprehensive and detailed.
-4. Do not include any controversial, disputable, or inaccurate factual claims in the response.
-5. Return ONLY the information about the entity, and nothing else.
-6. Return the information in paragraph form using plain text, not in markdown or any other format.
-""".strip()
+def system_prompt(args, task):
+    """Renders the system prompt of a task; it only depends on the run settings."""
+    if get_task_type(args.input_path) == "long_fact":
+        return LENGTH_LONG_FACT.render(LENGTH=args.length, CAT=task['cat'])
+    return LENGTH_BIOGRAPHY.render(LENGTH=args.length)
     
-def generate_bio(client, task, task_type, args, max_retries=5):
+async def generate_bio(client, task, task_type, args, max_retries=5):
     """Generate a response for a given topic with a requested output length."""
     
     if task_type == "biography":
-        system_prompt = LENGTH_BIOGRPHY_PROMPT.replace(_LENGTH_PLACEHOLDER, str(args.length))
         question = f"Tell me a bio of {task['topic']}."
         
     elif task_type == "long_fact":
-        system_prompt = LENGTH_LONG_FACT_PROMPT.replace(_LENGTH_PLACEHOLDER, str(args.length))\
-            .replace(_CAT_PLACEHOLDER, task['cat'])
-        
         question = f"Tell me about {task['topic']}."    
     
-    messages = [
-        {"role": "system", "content": system_prompt},
-        {"role": "user", "content": question}
-    ]
+    messages = build_messages(system_prompt(args, task), question)
     
-    for attempt in range(max_retries):
-        try:
-            completion = client.chat.completions.create(
-                model=args.model,
-                messages=messages,
-                temperature=args.temperature,
-            )
-            task['input'] = question
-            task['output'] = completion.choices[0].message.content
-            return task
-            
-        except Exception as e:
-            print(f"Attempt {attempt + 1}/{max_retries} failed: {e}")
-            if attempt == max_retries - 1:
-                raise RuntimeError(f"Max retries exceeded for topic '{task['topic']}': {e}")
-            time.sleep(1)
+    response = await client.complete(messages, args.model, args.temperature,
+                                     expected_words=args.length, label=task['topic'],
+                                     max_retries=max_retries, n=args.samples)
+    if args.samples > 1:
+        task['samples'] = {"output": response}
+        response = response[0]
+    task['output'] = response
+    task['input'] = question
+    return task
 
-def main(args):
-    
-    dt_string = datetime.now().strftime("%m_%d_%H_%M")
-    client = OpenAI(api_key=args.api_key)
+def prepare_run(args, all_data=None):
+    """Returns the tasks, output path, experiment parameters and worker of a run."""
+    check_samples(args)
     
-    all_data = jsonlines_load(args.input_path)
-    tasks = all_data[args.start:args.end]
+    if all_data is None:
+        tasks = jsonlines_iter(args.input_path, args.start, args.end)
+    else:
+        tasks = all_data[args.start:args.end]
     
-    task_type = ""
+    task_type = get_task_type(args.input_path)
     
-    if "biography" in args.input_path:
-        task_type = "biography"
+    if task_type == "biography":
         logging.info(f"Processing biography generation tasks from {args.input_path}")
-    elif "long_fact" in args.input_path:
-        task_type = "long_fact"
+    elif task_type == "long_fact":
         logging.info(f"Processing long fact generation tasks from {args.input_path}")
     else:
         logging.error(f"Unknown task type in {args.input_path}. Please check the input file.")
-        return
+        return None
     
     # check if output directory exists, if not, create it
     if not os.path.exists(args.output_dir):
         os.makedirs(args.output_dir)
-    output_path = f'{args.output_dir}/{args.model}_{task_type}_len{args.length}_{dt_string}.jsonl'
+    params = experiment_params(args)
+    output_path = f'{args.output_dir}/{args.model}_{task_type}_len{args.length}_{run_id(params)}.jsonl'
     
-    for task in tqdm(tasks):
-        result = generate_bio(client, task, task_type, args)
-        jsonlines_dump(output_path, result)
+    return tasks, output_path, params, instrument(partial(generate_bio, task_type=task_type, args=args))
+
+def main(args):
     
-    logging.info(f"All tasks completed. Results saved to {output_path}")
+    run = prepare_run(args)
+    if run is None:
+        return
+    tasks, output_path, params, worker = run
+    client = build_client(args)
     
-if __name__ == '__main__':
+    with ShardedRun(output_path, params, args) as writer:
+        pending = writer.pending(tasks)
+        run_generation(client, partial(worker, client), pending, args, callback=writer.write,
+                       total=writer.remaining(jsonlines_count(args.input_path, args.start, args.end)))
+    
+    logging.info(f"All tasks completed. Results saved to {writer.output_path}")
+    
+def build_parser():
     parser = argparse.ArgumentParser(description="Generate biographies with varying lengths")
     parser.add_argument('--input_path', type=str, \
         default='../data/dataset/biography_generation.jsonl',\
@@ -111,10 +99,16 @@ if __name__ == '__main__':
     parser.add_argument('--start', type=int, default=0)
     parser.add_argument('--end', type=int, default=-1)
     parser.add_argument('--temperature', type=float, default=0)
+    parser.add_argument('--samples', type=int, default=1,
+                        help="Number of responses per task, requested as n choices of a single call")
     parser.add_argument('--length', type=int, default=100, 
                         help="Length of the biography to generate")
-    parser.add_argument('--api_key', type=str, required=True,
-                        help="OpenAI API key")
-    
-    args = parser.parse_args()
+    parser.add_argument('--api_key', type=str, default=None,
+                        help="OpenAI API key, needed with the openai backend")
+    add_engine_args(parser)
+    add_shard_args(parser)
+    return parser
+
+if __name__ == '__main__':
+    args = build_parser().parse_args()
     main(args)
@@ -1,91 +1,67 @@
 """This file is used to generate responses with both context section and evaluation section lengths."""
-from openai import OpenAI
-
-from datetime import datetime
-from tqdm import tqdm
 import argparse
 import os
 import logging
-import time
+from functools import partial
 from tools import *
+from engine import build_client, check_samples, complete_hash_blocks, run_generation, add_engine_args
+from checkpoint import experiment_params, run_id
+from shards import ShardedRun, add_shard_args
+from telemetry import instrument
+from prompts import TWO_TOPICS, build_messages
 
 
-_TOPIC_1_PLACEHOLDER = '[TOPIC1]'
-_TOPIC_2_PLACEHOLDER = '[TOPIC2]'
-_CONTEXT_LENGTH_PLACEHOLDER = '[CONTEXT_LENGTH]'
-_EVALUATION_LENGTH_PLACEHOLDER = '[EVALUATION_LENGTH]'
-
-LONG_CONTEXT_PROMPT = f"""
-You are a helpful assistant. You will be given an entity name and two topics: `{_TOPIC_1_PLACEHOLDER}` \
-and `{_TOPIC_2_PLACEHOLDER}`. 
-You need to generate a bio for the entity that relates to the topics. Here are the instructions: 
-1. Firstly generate a bio relates to "{_TOPIC_1_PLACEHOLDER}" with around {_CONTEXT_LENGTH_PLACEHOLDER} words.
-2. Then generate a bio relates to "{_TOPIC_2_PLACEHOLDER}" with around {_EVALUATION_LENGTH_PLACEHOLDER} words.
-3. The response format should be like:
-### {_TOPIC_1_PLACEHOLDER} ###
-<Bio for {_TOPIC_1_PLACEHOLDER}>
-
-### {_TOPIC_2_PLACEHOLDER} ###
-<Bio for {_TOPIC_2_PLACEHOLDER}>
-4. Be sure to only include accurate, factual information in the response.
-5. The bio should be comprehensive and detailed.
-6. Do not include any controversial, disputable, or inaccurate factual claims in the response.
-7. Return ONLY the bio, and nothing else.
-""".strip()
+def system_prompt(args, task):
+    """Renders the system prompt of a task; it only depends on the run settings."""
+    return TWO_TOPICS.render(TOPIC1=args.topic1, TOPIC2=args.topic2,
+                             TOPIC1_LENGTH=args.context_length, TOPIC2_LENGTH=args.evaluation_length)
 
-def split_evaluation_section(response):
-    if generic_abstain_detect(response):
+def split_evaluation_section(result):
+    """Returns the context and evaluation sections of a parsed response."""
+    if result.status == PARSE_ABSTAINED:
         return None, None
     else:
-        context_response, evaluation_response = extract_hash_block(response, 2)
+        context_response, evaluation_response = result.contents
         return context_response, evaluation_response
 
-def generate_bio(client, task, args, max_retries=5):
-    
-    system_prompt = LONG_CONTEXT_PROMPT.replace(_TOPIC_1_PLACEHOLDER, args.topic1)\
-        .replace(_TOPIC_2_PLACEHOLDER, args.topic2)\
-        .replace(_CONTEXT_LENGTH_PLACEHOLDER, str(args.context_length))\
-        .replace(_EVALUATION_LENGTH_PLACEHOLDER, str(args.evaluation_length))
+async def generate_bio(client, task, args, max_retries=5):
     
     question = f"Tell me a bio of {task['topic']}."
-
-    messages = [
-        {"role": "system", "content": system_prompt},
-        {"role": "user", "content": question}
-    ]
+    messages = build_messages(system_prompt(args, task), question)
     
-    for attempt in range(max_retries):
-        try:
-            completion = client.chat.completions.create(
-                model=args.model,
-                messages=messages,
-                temperature=args.temperature,
-            )
-            task['input'] = question
-            response = completion.choices[0].message.content
-            context_response, evaluation_response = split_evaluation_section(response)
-            task['output'] = evaluation_response
-            task['topic1_output'] = context_response
-            task['all_output'] = response
-            return task
-            
-        except Exception as e:
-            print(f"Attempt {attempt + 1}/{max_retries} failed: {e}")
-            if attempt == max_retries - 1:
-                raise RuntimeError(f"Max retries exceeded for topic '{task['topic']}': {e}")
-            time.sleep(1)
-
-def main(args):
+    response, result = await complete_hash_blocks(
+        client, messages, args.model, args.temperature, 2, titles=[args.topic1, args.topic2],
+        expected_words=args.context_length + args.evaluation_length, label=task['topic'],
+        max_retries=max_retries, reformat_model=args.reformat_model, n=args.samples)
     
-    assert args.context_length > 0, "Context length must be greater than 0"
-    logging.info(f"Generating biographies with context topics '{args.topic1}' with length {args.context_length} \
-        and evaluation topic '{args.topic2}' with length {args.evaluation_length} using model {args.model}.")
+    if args.samples > 1:
+        # one list per field, so the samples of a task are stored side by side
+        sections = [split_evaluation_section(r) if r.status != PARSE_MALFORMED else (None, None)
+                    for r in result]
+        task['samples'] = {
+            "status": [r.status for r in result],
+            "topic1_output": [context for context, _ in sections],
+            "output": [evaluation for _, evaluation in sections],
+        }
+        response, result = response[0], result[0]
     
-    dt_string = datetime.now().strftime("%m_%d_%H_%M")
-    client = OpenAI(api_key=args.api_key)
+    context_response, evaluation_response = \
+        split_evaluation_section(result) if result.status != PARSE_MALFORMED else (None, None)
+    task['input'] = question
+    task['output'] = evaluation_response
+    task['topic1_output'] = context_response
+    task['all_output'] = response
+    task['format_repair'] = result.repair
+    return task
+
+def prepare_run(args, all_data=None):
+    """Returns the tasks, output path, experiment parameters and worker of a run."""
+    check_samples(args)
     
-    all_data = jsonlines_load(args.input_path)
-    tasks = all_data[args.start:args.end]
+    if all_data is None:
+        tasks = jsonlines_iter(args.input_path, args.start, args.end)
+    else:
+        tasks = all_data[args.start:args.end]
     
     # check if output directory exists, if not, create it
     if not os.path.exists(args.output_dir):
@@ -95,15 +71,28 @@ def main(args):
         "career": "cr",
         "personal life": "pr",
     }
-    output_path = f'{args.output_dir}/{args.model}_{map_to_name[args.topic1]}{args.context_length}_{map_to_name[args.topic2]}{args.evaluation_length}_{dt_string}.jsonl'
+    params = experiment_params(args)
+    output_path = f'{args.output_dir}/{args.model}_{map_to_name[args.topic1]}{args.context_length}_{map_to_name[args.topic2]}{args.evaluation_length}_{run_id(params)}.jsonl'
     
-    for task in tqdm(tasks):
-        result = generate_bio(client, task, args)
-        jsonlines_dump(output_path, result)
+    return tasks, output_path, params, instrument(partial(generate_bio, args=args))
+
+def main(args):
     
-    logging.info(f"All tasks completed. Results saved to {output_path}")
+    assert args.context_length > 0, "Context length must be greater than 0"
+    logging.info(f"Generating biographies with context topics '{args.topic1}' with length {args.context_length} \
+        and evaluation topic '{args.topic2}' with length {args.evaluation_length} using model {args.model}.")
     
-if __name__ == '__main__':
+    tasks, output_path, params, worker = prepare_run(args)
+    client = build_client(args)
+    
+    with ShardedRun(output_path, params, args) as writer:
+        pending = writer.pending(tasks)
+        run_generation(client, partial(worker, client), pending, args, callback=writer.write,
+                       total=writer.remaining(jsonlines_count(args.input_path, args.start, args.end)))
+    
+    logging.info(f"All tasks completed. Results saved to {writer.output_path}")
+    
+def build_parser():
     parser = argparse.ArgumentParser(description="Generate biographies for long context experiments")
     parser.add_argument('--input_path', type=str, \
         default='../data/dataset/biography_generation.jsonl',\
@@ -115,6 +104,8 @@ if __name__ == '__main__':
     parser.add_argument('--start', type=int, default=0)
     parser.add_argument('--end', type=int, default=-1)
     parser.add_argument('--temperature', type=float, default=0)
+    parser.add_argument('--samples', type=int, default=1,
+                        help="Number of responses per task, requested as n choices of a single call")
 
     parser.add_argument('--topic1', type=str, default='personal life',
                         help="Topic for context section of biography")
@@ -125,8 +116,12 @@ if __name__ == '__main__':
                         help="Length of the context section")
     parser.add_argument('-el', '--evaluation_length', type=int, default=200, 
                         help="Length of the evaluation section")
-    parser.add_argument('--api_key', type=str, required=True,
-                        help="OpenAI API key")
-    
-    args = parser.parse_args()
+    parser.add_argument('--api_key', type=str, default=None,
+                        help="OpenAI API key, needed with the openai backend")
+    add_engine_args(parser)
+    add_shard_args(parser)
+    return parser
+
+if __name__ == '__main__':
+    args = build_parser().parse_args()
     main(args)
@@ -0,0 +1,174 @@
+"""This file holds the prompt templates of the generator scripts in one registry.
+
+Templates are split at their `[FIELD]` placeholders once, when they are
+registered, and each distinct set of values is rendered only once. Since all
+values of the system prompts are experiment settings (lengths, topics), that
+means one rendering per experiment cell instead of one per task. The system
+prompt always comes first and the per-task question last, so every request of
+a cell starts with the same prefix, which provider-side prompt caching can reuse.
+"""
+import hashlib
+import re
+
+class PromptTemplate:
+    """A prompt with `[FIELD]` placeholders, compiled into literal parts and slots."""
+
+    def __init__(self, name: str, text: str, fields: list):
+        self.name = name
+        self.text = text
+        self.fields = tuple(fields)
+        if self.fields:
+            pattern = re.compile('|'.join(re.escape(f'[{field}]') for field in self.fields))
+            self._literals = pattern.split(text)
+            self._slots = [match.group(0)[1:-1] for match in pattern.finditer(text)]
+        else:
+            self._literals, self._slots = [text], []
+        self._rendered = {}
+
+    def render(self, **values) -> str:
+        """Fills in all fields in one pass; values are converted with `str`."""
+        if set(values) != set(self.fields):
+            raise ValueError(f'Template {self.name} takes the fields {self.fields}, got {sorted(values)}')
+        key = tuple(str(values[field]) for field in self.fields)
+        text = self._rendered.get(key)
+        if text is None:
+            lookup = dict(zip(self.fields, key))
+            parts = [self._literals[0]]
+            for slot, literal in zip(self._slots, self._literals[1:]):
+                parts.append(lookup[slot])
+                parts.append(literal)
+            text = self._rendered[key] = ''.join(parts)
+        return text
+
+    @property
+    def renderings(self) -> int:
+        """Number of distinct texts rendered so far."""
+        return len(self._rendered)
+
+TEMPLATES = {}
+
+def register(name: str, text: str, fields: list = ()) -> PromptTemplate:
+    if name in TEMPLATES:
+        raise ValueError(f'Template {name} is already registered')
+    template = TEMPLATES[name] = PromptTemplate(name, text.strip(), fields)
+    return template
+
+def get_template(name: str) -> PromptTemplate:
+    return TEMPLATES[name]
+
+def build_messages(system_prompt: str, question: str) -> list:
+    """Chat messages with the static system prompt first, as the shared prefix."""
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": question}
+    ]
+
+def prefix_key(system_prompt: str) -> str:
+    return hashlib.sha256(system_prompt.encode('utf-8')).hexdigest()[:16]
+
+def count_prefixes(system_prompts) -> int:
+    """Number of distinct prefixes among the system prompts of a run or a grid."""
+    return len({prefix_key(prompt) for prompt in system_prompts})
+
+################################################################################
+#                                 LENGTH BIAS                                  #
+################################################################################
+
+LENGTH_BIOGRAPHY = register('length_biography', """
+You are a helpful assistant. You will be given an entity name. You need to generate a bio for it. \
+Here are the instructions:
+1. The bio should be around [LENGTH] words.
+2. Be sure to only include accurate, factual information in the response.
+3. The bio should be comprehensive and detailed.
+4. Do not include any controversial, disputable, or inaccurate factual claims in the response.
+5. Return ONLY the bio, and nothing else.
+""", ['LENGTH'])
+
+LENGTH_LONG_FACT = register('length_long_fact', """
+You are a helpful assistant. You will be given an entity related to `[CAT]`. You need to provide a description of it. \
+Here are the instructions:
+1. The response should be around [LENGTH] words.
+2. Be sure to only include accurate, factual information in the response.
+3. The response should be comprehensive and detailed.
+4. Do not include any controversial, disputable, or inaccurate factual claims in the response.
+5. Return ONLY the information about the entity, and nothing else.
+6. Return the information in paragraph form using plain text, not in markdown or any other format.
+""", ['LENGTH', 'CAT'])
+
+################################################################################
+#                        SECTIONED (ONE OR TWO TOPICS)                         #
+################################################################################
+
+SINGLE_TOPIC = register('single_topic', """
+You are a helpful assistant. You will be given an entity name and one topic: `[TOPIC1]`. \
+You need to generate a bio for the entity that relates to the topic. Here are the instructions: 
+1. Generate a bio relates to "[TOPIC1]" with around [LENGTH] words.
+2. The response format should be like:
+### [TOPIC1] ###
+<Bio for [TOPIC1]>
+3. Be sure to only include accurate, factual information in the response.
+4. The bio should be comprehensive and detailed.
+5. Do not include any controversial, disputable, or inaccurate factual claims in the response.
+6. Return ONLY the bio, and nothing else.
+""", ['TOPIC1', 'LENGTH'])
+
+# shared by the long context (context + evaluation section) and the multiple-topic
+# facts exhaustion experiments
+TWO_TOPICS = register('two_topics', """
+You are a helpful assistant. You will be given an entity name and two topics: `[TOPIC1]` \
+and `[TOPIC2]`. 
+You need to generate a bio for the entity that relates to the topics. Here are the instructions: 
+1. Firstly generate a bio relates to "[TOPIC1]" with around [TOPIC1_LENGTH] words.
+2. Then generate a bio relates to "[TOPIC2]" with around [TOPIC2_LENGTH] words.
+3. The response format should be like:
+### [TOPIC1] ###
+<Bio for [TOPIC1]>
+
+### [TOPIC2] ###
+<Bio for [TOPIC2]>
+4. Be sure to only include accurate, factual information in the response.
+5. The bio should be comprehensive and detailed.
+6. Do not include any controversial, disputable, or inaccurate factual claims in the response.
+7. Return ONLY the bio, and nothing else.
+""", ['TOPIC1', 'TOPIC2', 'TOPIC1_LENGTH', 'TOPIC2_LENGTH'])
+
+################################################################################
+#                               DEFAULT LENGTH                                 #
+################################################################################
+
+NAIVE_FACTUALITY = register('naive_factuality', """
+You are a helpful assistant. You will be given an entity name. You need to generate a bio for it. Here are the instructions:
+1. Be sure to only include accurate, factual information in the response.
+2. The bio should be comprehensive and detailed.
+3. Do not include any controversial, disputable, or inaccurate factual claims in the response.
+4. Return ONLY the bio, and nothing else.
+""")
+
+################################################################################
+#                                FACT CHECKING                                 #
+################################################################################
+
+CLAIM_EXTRACTION = register('claim_extraction', """
+You are a helpful assistant. You will be given a text about an entity. You need to break it down into atomic claims. \
+Here are the instructions:
+1. Each claim should state exactly one fact and be understandable on its own, so replace pronouns with the entity name.
+2. Cover every fact of the text, and do not add facts that are not in the text.
+3. Skip statements that are not factual, e.g. opinions or transitions.
+4. Return ONLY the claims, one per line, each starting with "- ".
+""")
+
+CLAIM_VERIFICATION = register('claim_verification', """
+You are a helpful assistant. You will be given a numbered list of claims about `[TOPIC]`. \
+You need to decide for each claim whether it is factually accurate. Here are the instructions:
+1. Answer "supported" if the claim is accurate, and "unsupported" if it is inaccurate or cannot be verified.
+2. Judge each claim on its own, regardless of the other claims in the list.
+3. Return ONLY one line per claim, in the order of the list, formatted as "<number>: supported" or "<number>: unsupported".
+""", ['TOPIC'])
+
+CLAIM_VERIFICATION_EVIDENCE = register('claim_verification_evidence', """
+You are a helpful assistant. You will be given passages about `[TOPIC]` as knowledge, followed by a numbered list of claims about it. \
+You need to decide for each claim whether the knowledge supports it. Here are the instructions:
+1. Answer "supported" if the knowledge supports the claim, and "unsupported" if it contradicts the claim or does not mention it.
+2. Judge each claim on its own, regardless of the other claims in the list.
+3. Return ONLY one line per claim, in the order of the list, formatted as "<number>: supported" or "<number>: unsupported".
+""", ['TOPIC'])
@@ -0,0 +1,155 @@
+"""This file provides the rate limiting and retry policy shared by the generator scripts."""
+import asyncio
+import email.utils
+import random
+import time
+
+import openai
+
+################################################################################
+#                                 TOKEN BUCKET                                 #
+################################################################################
+
+class TokenBucket:
+    """A bucket refilled continuously at `per_minute` units per minute."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until `amount` units are available (after the last refill)."""
+        # a single request larger than the whole budget only waits for a full bucket
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.level) / self.rate)
+
+    def consume(self, amount: float):
+        self.level -= amount
+
+class RateLimiter:
+    """Enforces requests-per-minute and tokens-per-minute budgets across concurrent requests.
+
+    Either budget can be None to leave it unlimited. After a 429 the limiter can be
+    paused, which holds back every waiting request instead of letting them all hit
+    the API and fail again.
+    """
+
+    def __init__(self, rpm: float = None, tpm: float = None):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, estimated_tokens: int = 0):
+        """Waits until one request with `estimated_tokens` tokens fits in both budgets."""
+        # waiters queue on the lock, so requests are admitted in arrival order
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                wait = self.paused_until - now
+                if self.requests is not None:
+                    self.requests.refill(now)
+                    wait = max(wait, self.requests.wait_time(1))
+                if self.tokens is not None:
+                    self.tokens.refill(now)
+                    wait = max(wait, self.tokens.wait_time(estimated_tokens))
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            if self.requests is not None:
+                self.requests.consume(1)
+            if self.tokens is not None:
+                self.tokens.consume(estimated_tokens)
+
+    def settle(self, estimated_tokens: int, used_tokens: int):
+        """Corrects the token budget once the real usage of a request is known."""
+        if self.tokens is not None and used_tokens is not None:
+            self.tokens.consume(used_tokens - estimated_tokens)
+
+    def pause(self, seconds: float):
+        """Holds back all requests for `seconds`, e.g. after the API returned a 429."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+################################################################################
+#                               TOKEN ESTIMATION                               #
+################################################################################
+_CHARS_PER_TOKEN = 4
+_TOKENS_PER_WORD = 4 / 3
+_TOKENS_PER_MESSAGE = 4
+DEFAULT_EXPECTED_WORDS = 500
+
+def estimate_tokens(messages: list, expected_words: int = None, n: int = 1) -> int:
+    """Estimates the total tokens of a request from its prompt and the requested output length.
+
+    With `n` choices the prompt is counted once and the output `n` times.
+    """
+    prompt_tokens = sum(len(m['content']) // _CHARS_PER_TOKEN + _TOKENS_PER_MESSAGE for m in messages)
+    if expected_words is None:
+        expected_words = DEFAULT_EXPECTED_WORDS
+    return int(prompt_tokens + n * expected_words * _TOKENS_PER_WORD)
+
+################################################################################
+#                                 RETRY POLICY                                 #
+################################################################################
+_PERMANENT_ERRORS = (
+    openai.BadRequestError,
+    openai.AuthenticationError,
+    openai.PermissionDeniedError,
+    openai.NotFoundError,
+    openai.UnprocessableEntityError,
+)
+
+def is_rate_limit(error: Exception) -> bool:
+    return isinstance(error, openai.RateLimitError)
+
+def is_transient(error: Exception) -> bool:
+    """Returns whether retrying the same request could succeed.
+
+    Rejected prompts, bad credentials and unknown models fail the same way on every
+    attempt. Anything that is not an API error (e.g. a response in the wrong format)
+    is treated as transient, since a new generation may fix it.
+    """
+    if isinstance(error, _PERMANENT_ERRORS):
+        return False
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in (408, 409, 429) or error.status_code >= 500
+    return True
+
+def retry_after(error: Exception):
+    """Returns the delay in seconds requested by the server, if any."""
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    headers = response.headers
+    if headers.get('retry-after-ms'):
+        try:
+            return float(headers['retry-after-ms']) / 1000
+        except ValueError:
+            pass
+    value = headers.get('retry-after')
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, date.timestamp() - time.time())
+
+def backoff_delay(attempt: int, error: Exception = None, base: float = 1.0, cap: float = 60.0) -> float:
+    """Jittered exponential delay before retry `attempt + 1`, honoring `Retry-After`."""
+    delay = random.uniform(0, min(cap, base * 2 ** attempt))
+    server_delay = retry_after(error) if error is not None else None
+    if server_delay is not None:
+        # never retry earlier than asked, only spread the retries out a little
+        delay = server_delay + random.uniform(0, base)
+    return delay
@@ -0,0 +1,297 @@
+"""This file detects repeated facts inside and across the sections of generated responses.
+
+Every section of a response (`topic1_output` and `topic2_output` or `output`,
+see `response_sections`) is split into units, either sentences or the claims extracted by
+`fact_scorer.py` (`--claims_path`). Each unit gets a MinHash signature of its
+word shingles, and locality-sensitive hashing over bands of the signatures
+finds the candidate pairs within each response, so the work grows linearly with
+the number of units instead of quadratically. Candidates whose estimated Jaccard
+similarity reaches `--threshold` are near-duplicates; a unit that repeats an
+earlier unit of the same response counts as a repeated fact, within its section
+or across sections.
+
+Rates are reported per output file (length setting), and grouped per topic pair
+across files, so the repetition of a sweep can be compared across lengths.
+"""
+import argparse
+import glob
+import json
+import logging
+import os
+import re
+import sys
+
+import numpy as np
+
+from tools import *
+from checkpoint import read_run_params, requested_lengths
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'error_propagation'))
+from split_first_sentence import split_sentences_many
+
+_TOKEN_PATTERN = re.compile(r'\w+')
+# odd multipliers for combining 64-bit values; products wrap around modulo 2**64
+_MIX = np.array([0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9, 0xD6E8FEB86659FD93],
+                dtype=np.uint64)
+
+################################################################################
+#                                   MINHASH                                    #
+################################################################################
+
+class MinHasher:
+    """MinHash signatures of word shingles, computed for many texts at once.
+
+    Token ids come from a vocabulary shared by all texts, shingles of
+    `shingle_size` consecutive tokens are combined into 64-bit values, and each of
+    the `num_perm` hash functions is a multiply-shift hash of those values.
+    """
+
+    def __init__(self, num_perm: int = 128, shingle_size: int = 3, seed: int = 0):
+        rng = np.random.default_rng(seed)
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.a = rng.integers(1, 2 ** 63, num_perm, dtype=np.uint64) | np.uint64(1)
+        self.b = rng.integers(0, 2 ** 63, num_perm, dtype=np.uint64)
+        self.vocab = {}
+
+    def shingles(self, text: str) -> np.ndarray:
+        ids = np.fromiter((self.vocab.setdefault(token, len(self.vocab) + 1)
+                           for token in _TOKEN_PATTERN.findall(text.lower())), dtype=np.uint64)
+        if len(ids) == 0:
+            return ids
+        size = min(self.shingle_size, len(ids))
+        values = np.zeros(len(ids) - size + 1, dtype=np.uint64)
+        for offset in range(size):
+            values = (values + ids[offset:len(ids) - size + 1 + offset]) * _MIX[offset % len(_MIX)]
+        return np.unique(values)
+
+    def signatures(self, texts: list, chunk_size: int = 100000) -> np.ndarray:
+        """Returns the (texts x num_perm) signatures; texts without words get all-max rows."""
+        shingles = [self.shingles(text) for text in texts]
+        signatures = np.full((len(texts), self.num_perm), np.iinfo(np.uint32).max, dtype=np.uint32)
+        start = 0
+        while start < len(shingles):
+            # hash the shingles of as many texts as fit in one chunk
+            end, total = start, 0
+            while end < len(shingles) and (total == 0 or total + len(shingles[end]) <= chunk_size):
+                total += len(shingles[end])
+                end += 1
+            lengths = np.array([len(s) for s in shingles[start:end]])
+            filled = np.flatnonzero(lengths)
+            if len(filled):
+                flat = np.concatenate([shingles[start + i] for i in filled])
+                hashes = ((flat[:, None] * self.a + self.b) >> np.uint64(32)).astype(np.uint32)
+                offsets = np.concatenate([[0], np.cumsum(lengths[filled])[:-1]])
+                signatures[start + filled] = np.minimum.reduceat(hashes, offsets, axis=0)
+            start = end
+        return signatures
+
+def lsh_bands(num_perm: int, threshold: float) -> tuple:
+    """Returns the (bands, rows) whose LSH threshold (1 / bands) ** (1 / rows) is closest to `threshold`."""
+    options = [(num_perm // rows, rows) for rows in range(1, num_perm + 1) if num_perm % rows == 0]
+    return min(options, key=lambda option: abs((1 / option[0]) ** (1 / option[1]) - threshold))
+
+def near_duplicate_pairs(signatures: np.ndarray, scopes: np.ndarray, threshold: float = 0.5) -> np.ndarray:
+    """Returns the pairs (i, j), i < j, of units of the same scope whose estimated Jaccard
+    similarity is at least `threshold`, shape (pairs, 2).
+
+    Candidates are the units sharing a bucket in any LSH band; the scope is part of
+    every bucket key, so units of different responses are never compared. Units
+    without words (all-max signatures) are never candidates.
+    """
+    units = np.flatnonzero((signatures != np.iinfo(np.uint32).max).any(axis=1))
+    signatures, scopes = signatures[units], scopes[units]
+    n_units, num_perm = signatures.shape
+    bands, rows = lsh_bands(num_perm, threshold)
+    scope_keys = scopes.astype(np.uint64) * _MIX[0]
+    candidates = []
+    for band in range(bands):
+        keys = scope_keys.copy()
+        for row in range(rows):
+            keys = (keys ^ signatures[:, band * rows + row].astype(np.uint64)) * _MIX[(row + 1) % len(_MIX)]
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+        sizes = np.diff(np.r_[starts, n_units])
+        for start, size in zip(starts[sizes > 1], sizes[sizes > 1]):
+            members = order[start:start + size]
+            first, second = np.triu_indices(size, k=1)
+            candidates.append(np.stack([members[first], members[second]], axis=1))
+    if not candidates:
+        return np.empty((0, 2), dtype=np.int64)
+    pairs = np.unique(np.sort(np.concatenate(candidates), axis=1), axis=0)
+    pairs = pairs[scopes[pairs[:, 0]] == scopes[pairs[:, 1]]]
+    similarity = (signatures[pairs[:, 0]] == signatures[pairs[:, 1]]).mean(axis=1)
+    return units[pairs[similarity >= threshold]]
+
+################################################################################
+#                                  REPETITION                                  #
+################################################################################
+
+class UnitTable:
+    """The units of all responses, in reading order, with the response and section of each."""
+
+    def __init__(self):
+        self.texts = []
+        self._response, self._section = [], []
+        self.responses = []
+
+    def add_response(self, path: str, record: dict, sections: list):
+        """Adds the units of one response, given as (field, units) pairs in reading order."""
+        response = len(self.responses)
+        self.responses.append((path, record.get('index'), record.get('topic')))
+        for field, units in sections:
+            for unit in units:
+                self.texts.append(unit)
+                self._response.append(response)
+                self._section.append(field)
+
+    def freeze(self):
+        self.response_ids = np.asarray(self._response, dtype=np.int64)
+        self.section_names = sorted(set(self._section))
+        self.section_ids = np.asarray([self.section_names.index(s) for s in self._section], dtype=np.int64)
+        return self
+
+def repeated_units(table: UnitTable, pairs: np.ndarray) -> tuple:
+    """Marks every unit that repeats an earlier unit of its response, within its
+    section (`within`) or from another section (`across`)."""
+    within = np.zeros(len(table.texts), dtype=bool)
+    across = np.zeros(len(table.texts), dtype=bool)
+    same_section = table.section_ids[pairs[:, 0]] == table.section_ids[pairs[:, 1]]
+    within[pairs[same_section, 1]] = True
+    across[pairs[~same_section, 1]] = True
+    return within, across
+
+def repetition_report(table: UnitTable, within: np.ndarray, across: np.ndarray) -> dict:
+    """Aggregates the repeated-fact rates per output file and section."""
+    paths = [path for path, _, _ in table.responses]
+    unit_paths = np.asarray([paths[response] for response in table.response_ids]) if len(table.texts) else np.empty(0)
+    report = {}
+    for path in sorted(set(paths)):
+        in_file = unit_paths == path
+        repeated = within | across
+        stats = report[path] = {
+            "params": read_run_params(path),
+            "responses": paths.count(path),
+            "units": int(in_file.sum()),
+            "repeated_rate": float(repeated[in_file].mean()) if in_file.any() else 0.0,
+            "sections": {},
+        }
+        for section_id, section in enumerate(table.section_names):
+            units = in_file & (table.section_ids == section_id)
+            if units.any():
+                stats["sections"][section] = {
+                    "units": int(units.sum()),
+                    "repeated_within": float(within[units].mean()),
+                    "repeated_from_other_sections": float(across[units].mean()),
+                }
+    return report
+
+def topic_pair_report(report: dict) -> dict:
+    """Regroups the per-file rates by topic pair, keyed by the requested section lengths."""
+    pairs = {}
+    for path, stats in report.items():
+        params = stats["params"] or {}
+        requested = requested_lengths(params)
+        # single-topic runs keep the unused default `topic2` in their parameters
+        keys = ("topic1", "topic2") if len(requested) > 1 else ("topic1",)
+        topics = " | ".join(str(params[key]) for key in keys if params.get(key))
+        if "topic2_output" in requested:
+            requested.pop("output")
+        lengths = ", ".join(f"{field}={length}" for field, length in requested.items())
+        entry = {"path": path, "repeated_rate": stats["repeated_rate"],
+                 **{section: values["repeated_within"] + values["repeated_from_other_sections"]
+                    for section, values in stats["sections"].items()}}
+        pairs.setdefault(topics or "none", {})[lengths or path] = entry
+    return pairs
+
+def response_sections(record: dict) -> list:
+    """Returns the (field, text) sections of a record in reading order.
+
+    Facts exhaustion runs have `topic1_output` and `topic2_output` (their `output`
+    joins both), long context runs `topic1_output` and the evaluated `output`.
+    """
+    if record.get("topic2_output"):
+        fields = ["topic1_output", "topic2_output"]
+    elif record.get("topic1_output") and record.get("output") != record["topic1_output"]:
+        fields = ["topic1_output", "output"]
+    else:
+        fields = ["output"]
+    return [(field, record[field]) for field in fields if record.get(field)]
+
+def load_units(paths: list, unit: str, claims_path: str = None, split_processes: int = None) -> UnitTable:
+    table = UnitTable()
+    if unit == "claim":
+        claims = {}
+        for scored in jsonlines_iter(claims_path):
+            claims[(scored["path"], scored["index"], scored["field"])] = scored["claims"] or []
+        for path in paths:
+            for record in jsonlines_iter(path):
+                table.add_response(path, record, [(field, claims.get((path, record.get("index"), field), []))
+                                                  for field, _ in response_sections(record)])
+        return table.freeze()
+
+    records = [(path, record, response_sections(record)) for path in paths for record in jsonlines_iter(path)]
+    texts = [text for _, _, sections in records for _, text in sections]
+    sentences = iter(split_sentences_many(texts, split_processes))
+    for path, record, sections in records:
+        table.add_response(path, record, [(field, next(sentences)) for field, _ in sections])
+    return table.freeze()
+
+def main(args):
+    paths = sorted({path for pattern in args.input_paths for path in glob.glob(pattern)
+                    if path.endswith('.jsonl')})
+    if args.unit == "claim" and not args.claims_path:
+        raise ValueError('--claims_path (the --output_path of fact_scorer.py) is required with --unit claim')
+    table = load_units(paths, args.unit, args.claims_path, args.split_processes)
+    hasher = MinHasher(args.num_perm, args.shingle_size, args.seed)
+    signatures = hasher.signatures(table.texts)
+    pairs = near_duplicate_pairs(signatures, table.response_ids, args.threshold)
+    logging.info(f"Found {len(pairs)} near-duplicate pairs among {len(table.texts)} {args.unit}s "
+                 f"of {len(table.responses)} responses")
+    within, across = repeated_units(table, pairs)
+    report = repetition_report(table, within, across)
+
+    for path, stats in report.items():
+        sections = ", ".join(f"{section} {values['repeated_within']:.1%} within / "
+                             f"{values['repeated_from_other_sections']:.1%} from other sections"
+                             for section, values in stats["sections"].items())
+        print(f"{path}: {stats['repeated_rate']:.1%} of {stats['units']} {args.unit}s repeated ({sections})")
+
+    if args.output_path:
+        with open(args.output_path, 'w') as f:
+            json.dump({"files": report, "topic_pairs": topic_pair_report(report)}, f, indent=2)
+    if args.pairs_path:
+        with open(args.pairs_path, 'w') as f:
+            for i, j in pairs:
+                path, index, topic = table.responses[table.response_ids[i]]
+                f.write(json.dumps({"path": path, "index": index, "topic": topic,
+                                    "first": {"section": table.section_names[table.section_ids[i]], "text": table.texts[i]},
+                                    "repeat": {"section": table.section_names[table.section_ids[j]], "text": table.texts[j]}},
+                                   ensure_ascii=False) + '\n')
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Measure repeated facts inside and across response sections")
+    parser.add_argument('--input_paths', type=str, nargs='+', required=True,
+                        help="Output JSONL files or glob patterns, e.g. 'output/facts_exhaustion/*.jsonl'")
+    parser.add_argument('--unit', type=str, default='sentence', choices=['sentence', 'claim'],
+                        help="Compare sentences, or the claims extracted by fact_scorer.py")
+    parser.add_argument('--claims_path', type=str, default=None,
+                        help="The --output_path of fact_scorer.py run with --fields topic1_output topic2_output")
+    parser.add_argument('--threshold', type=float, default=0.5,
+                        help="Estimated Jaccard similarity of word shingles above which two units are near-duplicates")
+    parser.add_argument('--num_perm', type=int, default=128,
+                        help="Number of MinHash functions")
+    parser.add_argument('--shingle_size', type=int, default=3,
+                        help="Number of words per shingle")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--split_processes', type=int, default=None,
+                        help="Number of processes that split the responses into sentences")
+    parser.add_argument('--output_path', type=str, default=None,
+                        help="Optional path to write the report (per file and per topic pair) as JSON")
+    parser.add_argument('--pairs_path', type=str, default=None,
+                        help="Optional path to write every near-duplicate pair as JSONL")
+
+    args = parser.parse_args()
+    main(args)
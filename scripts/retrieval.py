@@ -0,0 +1,330 @@
+"""This file builds and queries a local retrieval index for offline claim verification.
+
+The index covers the documents of a Wikipedia-style dump whose titles are topics
+of the datasets, split into passages of `--passage_words` words. It is a
+directory of flat arrays that are memory-mapped on load:
+- BM25 postings in CSR form: for every term, the ids of the passages that contain
+  it (sorted) and their precomputed BM25 weights, so scoring a query only adds up
+  the weights of its terms,
+- the passages, grouped by title, so the passages of one topic are a contiguous
+  range and a topic-restricted search only touches that slice of each posting list,
+- optionally, normalized dense vectors of every passage (`--dense_model`,
+  requires `sentence-transformers`).
+
+`RetrievalIndex.search_many` answers a batch of queries at once, optionally spread
+over several processes that share the memory-mapped arrays.
+
+The dump is read from JSONL (`{"title": ..., "text": ...}` per line, optionally
+compressed) or from a SQLite file with a `documents(title, text)` table, as used
+by FActScore.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from tools import jsonlines_iter
+
+try:
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    SentenceTransformer = None
+
+_DATASET_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'dataset')
+_DEFAULT_DATASETS = [os.path.join(_DATASET_DIR, 'biography_generation.jsonl'),
+                     os.path.join(_DATASET_DIR, 'long_fact_description.jsonl')]
+_TOKEN_PATTERN = re.compile(r'\w+')
+_MARKUP_PATTERN = re.compile(r'</?s>')
+_STOPWORDS = frozenset("""a an and are as at be by for from has he her his in is it its of on or she that the
+their they this to was were which who with""".split())
+INDEX_FORMAT = 1
+RETRIEVAL_METHODS = ["bm25", "dense", "hybrid"]
+
+def tokenize(text: str) -> list:
+    return [token for token in _TOKEN_PATTERN.findall(text.lower()) if token not in _STOPWORDS]
+
+def _title_key(title: str) -> str:
+    return ' '.join(title.split()).casefold()
+
+def dataset_topics(paths: list = None) -> set:
+    """Returns the `topic` of every record of the dataset files."""
+    return {record['topic'] for path in paths or _DEFAULT_DATASETS for record in jsonlines_iter(path)}
+
+def iter_documents(corpus_path: str):
+    """Yields the (title, text) pairs of a JSONL or SQLite dump."""
+    if corpus_path.endswith(('.db', '.sqlite')):
+        conn = sqlite3.connect(corpus_path)
+        try:
+            for title, text in conn.execute('SELECT title, text FROM documents'):
+                yield title, _MARKUP_PATTERN.sub(' ', text)
+        finally:
+            conn.close()
+    else:
+        for record in jsonlines_iter(corpus_path):
+            yield record['title'], record['text']
+
+def split_passages(text: str, passage_words: int) -> list:
+    words = text.split()
+    return [" ".join(words[start:start + passage_words]) for start in range(0, len(words), passage_words)]
+
+################################################################################
+#                                   BUILDING                                   #
+################################################################################
+
+def build_index(corpus_path: str, index_dir: str, topics: set = None, passage_words: int = 100,
+                k1: float = 0.9, b: float = 0.4, dense_model: str = None):
+    """Builds the index of the documents whose title is in `topics` (all if None)."""
+    wanted = {_title_key(topic) for topic in topics} if topics is not None else None
+    documents = {}
+    for title, text in iter_documents(corpus_path):
+        if wanted is None or _title_key(title) in wanted:
+            documents.setdefault(title, []).append(text)
+    titles = sorted(documents)
+    if wanted is not None:
+        logging.info(f"Found {len(titles)} of {len(wanted)} topics in {corpus_path}")
+
+    passages, title_offsets = [], [0]
+    for title in titles:
+        for text in documents[title]:
+            passages += split_passages(text, passage_words)
+        title_offsets.append(len(passages))
+    del documents
+
+    # postings are appended in passage order, so a stable sort by term keeps
+    # the passage ids of every term sorted
+    vocab, terms, docs, tfs, lengths = {}, [], [], [], []
+    for doc, passage in enumerate(passages):
+        tokens = tokenize(passage)
+        lengths.append(len(tokens))
+        for token, tf in Counter(tokens).items():
+            terms.append(vocab.setdefault(token, len(vocab)))
+            docs.append(doc)
+            tfs.append(tf)
+    terms = np.asarray(terms, dtype=np.int32)
+    docs = np.asarray(docs, dtype=np.int32)
+    tfs = np.asarray(tfs, dtype=np.float32)
+    lengths = np.asarray(lengths, dtype=np.float32)
+
+    order = np.argsort(terms, kind='stable')
+    terms, docs, tfs = terms[order], docs[order], tfs[order]
+    df = np.bincount(terms, minlength=len(vocab))
+    n_passages = len(passages)
+    avgdl = float(lengths.mean()) if n_passages else 0.0
+    idf = np.log1p((n_passages - df + 0.5) / (df + 0.5)).astype(np.float32)
+    norm = k1 * (1 - b + b * lengths[docs] / max(avgdl, 1e-9))
+    impacts = idf[terms] * tfs * (k1 + 1) / (tfs + norm)
+
+    os.makedirs(index_dir, exist_ok=True)
+    encoded = [passage.encode('utf-8') for passage in passages]
+    with open(os.path.join(index_dir, 'passages.bin'), 'wb') as f:
+        for data in encoded:
+            f.write(data)
+    np.save(os.path.join(index_dir, 'passage_offsets.npy'),
+            np.concatenate([[0], np.cumsum([len(data) for data in encoded], dtype=np.int64)]))
+    np.save(os.path.join(index_dir, 'title_offsets.npy'), np.asarray(title_offsets, dtype=np.int64))
+    np.save(os.path.join(index_dir, 'term_offsets.npy'),
+            np.concatenate([[0], np.cumsum(df, dtype=np.int64)]))
+    np.save(os.path.join(index_dir, 'postings_docs.npy'), docs)
+    np.save(os.path.join(index_dir, 'postings_impacts.npy'), impacts.astype(np.float32))
+    with open(os.path.join(index_dir, 'vocab.json'), 'w') as f:
+        json.dump(sorted(vocab, key=vocab.get), f, ensure_ascii=False)
+    with open(os.path.join(index_dir, 'titles.json'), 'w') as f:
+        json.dump(titles, f, ensure_ascii=False)
+
+    if dense_model:
+        encoder = _load_encoder(dense_model)
+        vectors = encoder.encode(passages, batch_size=64, normalize_embeddings=True, show_progress_bar=True)
+        np.save(os.path.join(index_dir, 'dense.npy'), np.asarray(vectors, dtype=np.float16))
+
+    fingerprint = hashlib.sha256(json.dumps([corpus_path, titles, passage_words, k1, b]).encode()).hexdigest()[:10]
+    meta = {"format": INDEX_FORMAT, "name": f"{os.path.basename(os.path.normpath(index_dir))}-{fingerprint}",
+            "corpus": corpus_path, "n_titles": len(titles), "n_passages": n_passages, "n_terms": len(vocab),
+            "passage_words": passage_words, "k1": k1, "b": b, "avgdl": avgdl, "dense_model": dense_model}
+    with open(os.path.join(index_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+    logging.info(f"Indexed {n_passages} passages of {len(titles)} titles with {len(vocab)} terms in {index_dir}")
+    return meta
+
+def _load_encoder(model: str):
+    if SentenceTransformer is None:
+        raise ImportError('sentence-transformers is required for dense retrieval: pip install sentence-transformers')
+    return SentenceTransformer(model)
+
+################################################################################
+#                                  SEARCHING                                   #
+################################################################################
+
+class RetrievalIndex:
+    """A read-only, memory-mapped view of an index built by `build_index`."""
+
+    def __init__(self, index_dir: str):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, 'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta["format"] != INDEX_FORMAT:
+            raise ValueError(f'Index {index_dir} has format {self.meta["format"]}, expected {INDEX_FORMAT}')
+        with open(os.path.join(index_dir, 'vocab.json')) as f:
+            self.vocab = {term: term_id for term_id, term in enumerate(json.load(f))}
+        with open(os.path.join(index_dir, 'titles.json')) as f:
+            self.titles = json.load(f)
+        self.title_ids = {_title_key(title): title_id for title_id, title in enumerate(self.titles)}
+
+        def load(name):
+            return np.load(os.path.join(index_dir, name), mmap_mode='r')
+        self.title_offsets = load('title_offsets.npy')
+        self.term_offsets = load('term_offsets.npy')
+        self.postings_docs = load('postings_docs.npy')
+        self.postings_impacts = load('postings_impacts.npy')
+        self.passage_offsets = load('passage_offsets.npy')
+        self.passage_data = np.memmap(os.path.join(index_dir, 'passages.bin'), dtype=np.uint8, mode='r') \
+            if self.passage_offsets[-1] else np.empty(0, dtype=np.uint8)
+        dense_path = os.path.join(index_dir, 'dense.npy')
+        self.dense = np.load(dense_path, mmap_mode='r') if os.path.exists(dense_path) else None
+        self._encoder = None
+
+    @property
+    def name(self) -> str:
+        return self.meta["name"]
+
+    def __len__(self) -> int:
+        return self.meta["n_passages"]
+
+    def passage(self, passage_id: int) -> str:
+        start, end = self.passage_offsets[passage_id], self.passage_offsets[passage_id + 1]
+        return bytes(self.passage_data[start:end]).decode('utf-8')
+
+    def title_of(self, passage_id: int) -> str:
+        return self.titles[int(np.searchsorted(self.title_offsets, passage_id, side='right')) - 1]
+
+    def passage_range(self, topic: str = None) -> tuple:
+        """Returns the passage ids [start, end) of a topic, of all passages if `topic` is None,
+        or an empty range for a topic that is not indexed."""
+        if topic is None:
+            return 0, len(self)
+        title_id = self.title_ids.get(_title_key(topic))
+        if title_id is None:
+            return 0, 0
+        return int(self.title_offsets[title_id]), int(self.title_offsets[title_id + 1])
+
+    def bm25_scores(self, query: str, start: int, end: int) -> np.ndarray:
+        """BM25 scores of the passages [start, end) for `query`."""
+        scores = np.zeros(end - start, dtype=np.float32)
+        for token in set(tokenize(query)):
+            term_id = self.vocab.get(token)
+            if term_id is None:
+                continue
+            first, last = self.term_offsets[term_id], self.term_offsets[term_id + 1]
+            docs = self.postings_docs[first:last]
+            lo, hi = np.searchsorted(docs, [start, end])
+            # a passage appears once per posting list, so plain fancy-index addition is safe
+            scores[docs[lo:hi] - start] += self.postings_impacts[first + lo:first + hi]
+        return scores
+
+    def encode(self, queries: list) -> np.ndarray:
+        if self.dense is None:
+            raise ValueError(f'Index {self.index_dir} has no dense vectors; rebuild it with --dense_model')
+        if self._encoder is None:
+            self._encoder = _load_encoder(self.meta["dense_model"])
+        return np.asarray(self._encoder.encode(queries, normalize_embeddings=True), dtype=np.float32)
+
+    def search(self, query: str, topic: str = None, k: int = 5, method: str = "bm25",
+               query_vector: np.ndarray = None) -> list:
+        """Returns the top-`k` passages for `query`, within the passages of `topic` if given."""
+        start, end = self.passage_range(topic)
+        if end <= start:
+            return []
+        if method == "bm25":
+            scores = self.bm25_scores(query, start, end)
+        else:
+            if query_vector is None:
+                query_vector = self.encode([query])[0]
+            dense_scores = np.asarray(self.dense[start:end], dtype=np.float32) @ query_vector
+            if method == "dense":
+                scores = dense_scores
+            else:
+                scores = _reciprocal_rank_fusion(self.bm25_scores(query, start, end), dense_scores)
+        k = min(k, end - start)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return [{"passage_id": int(start + i), "title": self.title_of(start + i),
+                 "text": self.passage(start + i), "score": float(scores[i])}
+                for i in top if method != "bm25" or scores[i] > 0]
+
+    def search_many(self, queries: list, topics: list = None, k: int = 5, method: str = "bm25",
+                    workers: int = 1) -> list:
+        """Answers a batch of queries, optionally in `workers` processes; returns one list of hits per query."""
+        topics = topics or [None] * len(queries)
+        vectors = self.encode(queries) if method != "bm25" else [None] * len(queries)
+        jobs = list(zip(queries, topics, vectors))
+        if workers <= 1 or len(jobs) < 2 * workers:
+            return [self.search(query, topic, k, method, vector) for query, topic, vector in jobs]
+        chunk = -(-len(jobs) // workers)
+        with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(self.index_dir,)) as pool:
+            parts = pool.map(_search_chunk, [(jobs[i:i + chunk], k, method) for i in range(0, len(jobs), chunk)])
+            return [hits for part in parts for hits in part]
+
+def _reciprocal_rank_fusion(*scores: np.ndarray, constant: int = 60) -> np.ndarray:
+    fused = np.zeros(len(scores[0]), dtype=np.float32)
+    for values in scores:
+        ranks = np.empty(len(values), dtype=np.float32)
+        ranks[np.argsort(-values, kind='stable')] = np.arange(1, len(values) + 1)
+        fused += 1 / (constant + ranks)
+    return fused
+
+# every worker process maps the index once
+_worker_index = None
+
+def _init_worker(index_dir: str):
+    global _worker_index
+    _worker_index = RetrievalIndex(index_dir)
+
+def _search_chunk(job: tuple) -> list:
+    queries, k, method = job
+    return [_worker_index.search(query, topic, k, method, vector) for query, topic, vector in queries]
+
+################################################################################
+#                                     CLI                                      #
+################################################################################
+
+def main(args):
+    if args.corpus_path:
+        topics = None if args.all_titles else dataset_topics(args.dataset_paths)
+        build_index(args.corpus_path, args.index_dir, topics, args.passage_words, args.k1, args.b, args.dense_model)
+    if args.query:
+        index = RetrievalIndex(args.index_dir)
+        for hit in index.search(args.query, args.topic, args.k, args.method):
+            print(f"[{hit['score']:.3f}] {hit['title']} #{hit['passage_id']}: {hit['text'][:200]}")
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Build or query a local retrieval index over a Wikipedia-style dump")
+    parser.add_argument('--index_dir', type=str, default='output/index',
+                        help="Directory of the index")
+    parser.add_argument('--corpus_path', type=str, default=None,
+                        help="Dump to index: JSONL with title and text, or a SQLite file with a documents table")
+    parser.add_argument('--dataset_paths', type=str, nargs='+', default=None,
+                        help="Dataset files whose topics are indexed (default: both files in data/dataset)")
+    parser.add_argument('--all_titles', action='store_true',
+                        help="Index every document of the dump, not only the dataset topics")
+    parser.add_argument('--passage_words', type=int, default=100,
+                        help="Number of words per passage")
+    parser.add_argument('--k1', type=float, default=0.9)
+    parser.add_argument('--b', type=float, default=0.4)
+    parser.add_argument('--dense_model', type=str, default=None,
+                        help="sentence-transformers model to also store dense passage vectors")
+    parser.add_argument('--query', type=str, default=None,
+                        help="Query to search after building, e.g. to check the index")
+    parser.add_argument('--topic', type=str, default=None,
+                        help="Restrict the query to the passages of this topic")
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--method', type=str, default='bm25', choices=RETRIEVAL_METHODS)
+
+    args = parser.parse_args()
+    main(args)
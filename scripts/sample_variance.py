@@ -0,0 +1,150 @@
+"""This file measures the variance of response length and abstention across the
+samples of a task, for runs generated with `--samples K`.
+
+Every output file is streamed once. For each task (topic), the word counts of
+its K samples give a mean and variance per output field, and the share of
+abstained samples gives its abstention rate. Per run and field, Welford
+accumulators then aggregate the per-topic values: the mean within-topic standard
+deviation (how much resampling alone moves the length), the spread of the topic
+means, and the abstention rate with the share of topics that abstain only in
+some of their samples.
+"""
+import argparse
+import glob
+import json
+import math
+
+from tools import ABSTAIN_PATTERN_PATH, AbstainDetector, jsonlines_iter, PARSE_ABSTAINED
+from checkpoint import LENGTH_FIELDS, read_run_params
+
+class Welford:
+    """Running mean and variance of a stream of values, in one pass."""
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, value: float):
+        self.n += 1
+        delta = value - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (value - self.mean)
+
+    @property
+    def variance(self) -> float:
+        """Sample variance; 0 for fewer than two values."""
+        return self.m2 / (self.n - 1) if self.n > 1 else 0.0
+
+    @property
+    def std(self) -> float:
+        return math.sqrt(self.variance)
+
+    def extend(self, values):
+        for value in values:
+            self.add(value)
+        return self
+
+def sample_abstentions(samples: dict, detector: AbstainDetector) -> list:
+    """Returns whether each sample of a task abstained.
+
+    Sectioned runs store the parse status of every sample; otherwise the
+    `output` text of each sample is screened with `detector`.
+    """
+    if "status" in samples:
+        return [status == PARSE_ABSTAINED for status in samples["status"]]
+    return [detector(output or "") for output in samples["output"]]
+
+def topic_stats(record: dict, detector: AbstainDetector) -> dict:
+    """Returns the per-field length mean and variance and the abstention rate of one task."""
+    samples = record["samples"]
+    abstained = sample_abstentions(samples, detector)
+    stats = {"index": record.get("index"), "topic": record.get("topic"), "samples": len(abstained),
+             "abstention_rate": sum(abstained) / len(abstained) if abstained else 0.0}
+    for field in LENGTH_FIELDS:
+        texts = [text for text in samples.get(field) or [] if text]
+        if texts:
+            lengths = Welford().extend(len(text.split()) for text in texts)
+            stats[field] = {"n": lengths.n, "mean_words": lengths.mean, "var_words": lengths.variance}
+    return stats
+
+def run_variance(path: str, detector: AbstainDetector, topic_file=None) -> dict:
+    """Streams one output file and aggregates the per-topic statistics of its samples.
+
+    If `topic_file` is given, the statistics of every topic are written to it as
+    JSON lines along the way.
+    """
+    abstention = Welford()
+    mixed = 0
+    within_std, topic_means = {}, {}
+    for record in jsonlines_iter(path):
+        if not record.get("samples"):
+            continue
+        stats = topic_stats(record, detector)
+        abstention.add(stats["abstention_rate"])
+        mixed += 0 < stats["abstention_rate"] < 1
+        for field in LENGTH_FIELDS:
+            if field in stats:
+                within_std.setdefault(field, Welford()).add(math.sqrt(stats[field]["var_words"]))
+                topic_means.setdefault(field, Welford()).add(stats[field]["mean_words"])
+        if topic_file is not None:
+            stats["path"] = path
+            topic_file.write(json.dumps(stats) + "\n")
+
+    report = {
+        "topics": abstention.n,
+        "abstention_rate": abstention.mean,
+        "abstention_rate_std": abstention.std,
+        "mixed_abstention_topics": mixed / abstention.n if abstention.n else 0.0,
+        "fields": {},
+    }
+    for field, std in within_std.items():
+        report["fields"][field] = {
+            "mean_words": topic_means[field].mean,
+            "within_topic_std": std.mean,
+            "between_topic_std": topic_means[field].std,
+        }
+    return report
+
+def main(args):
+    detector = AbstainDetector.from_file(args.patterns, args.family)
+    paths = sorted({path for pattern in args.input_paths for path in glob.glob(pattern)
+                    if path.endswith('.jsonl')})
+    topic_file = open(args.topic_path, 'w') if args.topic_path else None
+    report = {}
+    try:
+        for path in paths:
+            result = run_variance(path, detector, topic_file)
+            if not result["topics"]:
+                continue
+            result["params"] = read_run_params(path)
+            report[path] = result
+            print(f"{path}: {result['topics']} topics, abstention {result['abstention_rate']:.1%} "
+                  f"(+-{result['abstention_rate_std']:.1%} across topics, "
+                  f"{result['mixed_abstention_topics']:.1%} of topics abstain in only some samples)")
+            for field, stats in result["fields"].items():
+                print(f"  {field}: mean {stats['mean_words']:.0f} words, std {stats['within_topic_std']:.1f} "
+                      f"within topics, {stats['between_topic_std']:.1f} between topics")
+    finally:
+        if topic_file is not None:
+            topic_file.close()
+
+    if args.output_path:
+        with open(args.output_path, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Report the per-topic variance of length and abstention across samples")
+    parser.add_argument('--input_paths', type=str, nargs='+', required=True,
+                        help="Output JSONL files generated with --samples, or glob patterns")
+    parser.add_argument('--patterns', type=str, default=ABSTAIN_PATTERN_PATH,
+                        help="JSON file of abstention patterns per model family")
+    parser.add_argument('--family', type=str, default=None,
+                        help="Model family whose patterns extend the defaults, e.g. 'llama'")
+    parser.add_argument('--topic_path', type=str, default=None,
+                        help="Optional path to write the statistics of every topic as JSONL")
+    parser.add_argument('--output_path', type=str, default=None,
+                        help="Optional path to write the report as JSON")
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,288 @@
+"""This file splits the tasks of a run over several worker processes or hosts.
+
+With `--num-shards N --shard-id i`, worker i runs the tasks whose `index` is i
+modulo N. With `--queue_path`, workers instead pull tasks one at a time from a
+SQLite work queue, which may live on a filesystem shared by several hosts: every
+claim holds a lease of `--queue_lease` seconds, tasks are marked done once their
+records are committed, and the tasks of a worker that died are claimed again by
+the others after their lease expired. The queue also records which process runs
+each `--shard-id`, so two live workers never write the same shard file.
+
+Every worker writes its own `<output>.shard<i>.jsonl` with its own manifest, so
+`--resume` works per shard. Once all workers are done,
+    python scripts/shards.py --input_paths "output/length_bias/*.shard*.jsonl"
+merges the shards of each experiment cell into its usual output file, ordered by
+`index` and without duplicates.
+"""
+import argparse
+import glob
+import logging
+import os
+import re
+import socket
+import sqlite3
+import time
+
+from tools import *
+from checkpoint import RunWriter, committed_records, read_run_params, rewrite_run
+
+_SHARD_PATTERN = re.compile(r'^(.*)\.shard(\d+)\.jsonl$')
+
+################################################################################
+#                                  WORK QUEUE                                  #
+################################################################################
+
+class TaskQueue:
+    """A SQLite queue of task indices, shared by the workers of one or more runs.
+
+    Each run (cell) is registered by every worker that starts it; registering is
+    idempotent, so the workers do not need to be started in any order. A worker
+    owns its shard ID for as long as it keeps claiming tasks, and for
+    `lease_seconds` after that.
+    """
+
+    def __init__(self, path: str, worker: str, lease_seconds: float = 1800):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.worker = worker
+        self.lease_seconds = lease_seconds
+        # no WAL: its shared-memory index does not work across the hosts of a network filesystem
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS tasks (
+            cell TEXT,
+            idx INTEGER,
+            state TEXT,
+            worker TEXT,
+            expires REAL,
+            PRIMARY KEY (cell, idx))''')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS workers (
+            shard_id INTEGER PRIMARY KEY,
+            owner TEXT,
+            expires REAL)''')
+
+    @classmethod
+    def from_args(cls, args):
+        if args.queue_path is None:
+            return None
+        return cls(args.queue_path, f'{socket.gethostname()}-{os.getpid()}', args.queue_lease)
+
+    def register(self, shard_id: int):
+        """Takes ownership of `shard_id`, unless another live worker holds it."""
+        now = time.time()
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = self.conn.execute('SELECT owner, expires FROM workers WHERE shard_id = ?', (shard_id,)).fetchone()
+            if row is not None and row[0] != self.worker and row[1] >= now:
+                raise RuntimeError(f'--shard_id {shard_id} is in use by worker {row[0]}. Give every worker of the '
+                                   f'queue its own --shard_id; the ID of a worker that stopped is free again '
+                                   f'{row[1] - now:.0f}s from now.')
+            self.conn.execute('INSERT OR REPLACE INTO workers VALUES (?, ?, ?)',
+                              (shard_id, self.worker, now + self.lease_seconds))
+        finally:
+            self.conn.execute('COMMIT')
+
+    def add(self, cell: str, indices: list):
+        self.conn.execute('BEGIN IMMEDIATE')
+        self.conn.executemany("INSERT OR IGNORE INTO tasks VALUES (?, ?, 'pending', NULL, 0)",
+                              [(cell, index) for index in indices])
+        self.conn.execute('COMMIT')
+
+    def claim(self, cell: str):
+        """Returns the lowest pending (or abandoned) index of `cell`, or None once there is none."""
+        now = time.time()
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = self.conn.execute('''SELECT idx FROM tasks WHERE cell = ?
+                AND (state = 'pending' OR (state = 'claimed' AND expires < ?))
+                ORDER BY idx LIMIT 1''', (cell, now)).fetchone()
+            if row is not None:
+                self.conn.execute("UPDATE tasks SET state = 'claimed', worker = ?, expires = ? WHERE cell = ? AND idx = ?",
+                                  (self.worker, now + self.lease_seconds, cell, row[0]))
+            # every claim renews the worker's shard ID and the tasks it still holds, e.g. behind a slower one
+            self.conn.execute('UPDATE workers SET expires = ? WHERE owner = ?', (now + self.lease_seconds, self.worker))
+            self.conn.execute("UPDATE tasks SET expires = ? WHERE state = 'claimed' AND worker = ?",
+                              (now + self.lease_seconds, self.worker))
+        finally:
+            self.conn.execute('COMMIT')
+        return row[0] if row is not None else None
+
+    def complete(self, cell: str, indices: list):
+        self.conn.execute('BEGIN IMMEDIATE')
+        self.conn.executemany("UPDATE tasks SET state = 'done', expires = 0 WHERE cell = ? AND idx = ?",
+                              [(cell, index) for index in indices])
+        self.conn.execute('COMMIT')
+
+    def tasks(self, cell: str, tasks, completed=()):
+        """Registers `tasks` under `cell` and returns a lazy iterator over the ones this worker claims.
+
+        Tasks in `completed` (committed by an earlier run of this worker) are marked
+        done first, in case the worker stopped before it could do so.
+        """
+        by_index = {task['index']: task for task in tasks}
+        self.add(cell, list(by_index))
+        self.complete(cell, [index for index in by_index if index in completed])
+        return self._claimed(cell, by_index)
+
+    def _claimed(self, cell: str, by_index: dict):
+        while True:
+            index = self.claim(cell)
+            if index is None:
+                return
+            yield by_index[index]
+
+    def claimable(self, cell: str) -> int:
+        """Counts the tasks of `cell` that are pending or whose lease expired."""
+        row = self.conn.execute('''SELECT COUNT(*) FROM tasks WHERE cell = ?
+            AND (state = 'pending' OR (state = 'claimed' AND expires < ?))''', (cell, time.time())).fetchone()
+        return row[0]
+
+    def progress(self, cell_prefix: str) -> dict:
+        """Counts the tasks per state over all cells starting with `cell_prefix`."""
+        rows = self.conn.execute('SELECT state, COUNT(*) FROM tasks WHERE substr(cell, 1, ?) = ? GROUP BY state',
+                                 (len(cell_prefix), cell_prefix))
+        return dict(rows.fetchall())
+
+    def close(self):
+        self.conn.execute('DELETE FROM workers WHERE owner = ?', (self.worker,))
+        self.conn.close()
+
+################################################################################
+#                                SHARDED RUNS                                  #
+################################################################################
+
+def shard_output_path(output_path: str, args) -> str:
+    """Returns the output file of this worker; the run's own file when the run is not sharded."""
+    if args.num_shards == 1 and args.queue_path is None:
+        return output_path
+    return f'{output_path[:-len(".jsonl")]}.shard{args.shard_id}.jsonl'
+
+class ShardedRun:
+    """The share of one worker in a run: a `RunWriter` over its own output file,
+    and the tasks it has to run. Without sharding this is a plain `RunWriter`."""
+
+    def __init__(self, output_path: str, params: dict, args):
+        if args.queue_path is None and not 0 <= args.shard_id < args.num_shards:
+            raise ValueError(f'--shard_id must be in [0, {args.num_shards}), got {args.shard_id}')
+        self.num_shards, self.shard_id = args.num_shards, args.shard_id
+        self.queue = TaskQueue.from_args(args)
+        if self.queue is not None:
+            self.queue.register(args.shard_id)
+        # workers only share the tasks of the same cell and the same --start/--end window
+        self.cell = f'{os.path.basename(output_path)}:{args.start}:{args.end}'
+        self.output_path = shard_output_path(output_path, args)
+        try:
+            self.writer = RunWriter(self.output_path, params, resume=args.resume,
+                                    on_flush=self._committed if self.queue is not None else None)
+        except Exception:
+            if self.queue is not None:
+                self.queue.close()
+            raise
+
+    def _committed(self, indices: list):
+        self.queue.complete(self.cell, indices)
+
+    def pending(self, tasks):
+        """Lazily yields the tasks of this worker that are not committed yet."""
+        if self.queue is not None:
+            return self.queue.tasks(self.cell, tasks, self.writer.completed)
+        tasks = self.writer.pending(tasks)
+        if self.num_shards > 1:
+            tasks = (task for task in tasks if task['index'] % self.num_shards == self.shard_id)
+        return tasks
+
+    def remaining(self, n_tasks: int) -> int:
+        """Estimates how many of the `n_tasks` tasks of the run this worker still has to run.
+
+        With a work queue, this is the number of tasks left to claim once `pending`
+        registered them, some of which other workers will take.
+        """
+        if self.queue is not None:
+            return self.queue.claimable(self.cell)
+        share = len(range(self.shard_id, n_tasks, self.num_shards))
+        return max(share - len(self.writer.completed), 0)
+
+    def write(self, record: dict):
+        self.writer.write(record)
+
+    def close(self):
+        self.writer.close()
+        if self.queue is not None:
+            self.queue.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def add_shard_args(parser):
+    """Adds the sharding arguments of the generator scripts."""
+    parser.add_argument('--num-shards', '--num_shards', dest='num_shards', type=int, default=1,
+                        help="Split the tasks over this many workers; worker --shard_id runs the tasks whose index is shard_id modulo num_shards")
+    parser.add_argument('--shard-id', '--shard_id', dest='shard_id', type=int, default=0,
+                        help="ID of this worker; it writes its records to <output>.shard<id>.jsonl")
+    parser.add_argument('--queue_path', type=str, default=None,
+                        help="SQLite work queue shared by the workers (e.g. on a shared filesystem); workers then pull tasks dynamically instead of by index")
+    parser.add_argument('--queue_lease', type=float, default=1800,
+                        help="Seconds after which a task claimed from the queue by a worker that stopped is claimed again")
+    return parser
+
+################################################################################
+#                                    MERGE                                     #
+################################################################################
+
+def merge_shards(output_path: str, shard_paths: list) -> dict:
+    """Merges the committed records of `shard_paths` (and of `output_path` itself, if it
+    has any) into `output_path`, ordered by `index` and without duplicates."""
+    params = read_run_params(shard_paths[0])
+    sources = list(shard_paths)
+    if os.path.exists(output_path + '.manifest'):
+        sources.insert(0, output_path)
+    records = {}
+    total = 0
+    for path in sources:
+        if read_run_params(path) != params:
+            raise ValueError(f'{path} was written with different parameters than {shard_paths[0]}')
+        for record in committed_records(path):
+            total += 1
+            records.setdefault(record['index'], record)
+    rewrite_run(output_path, params, (records[index] for index in sorted(records)))
+    return {"shards": len(shard_paths), "records": len(records), "duplicates": total - len(records)}
+
+def main(args):
+    cells = {}
+    for pattern in args.input_paths:
+        for path in glob.glob(pattern):
+            match = _SHARD_PATTERN.match(path)
+            if match and os.path.exists(path + '.manifest'):
+                cells.setdefault(match.group(1) + '.jsonl', []).append(path)
+    queue = TaskQueue(args.queue_path, 'merge') if args.queue_path else None
+
+    for output_path, shard_paths in sorted(cells.items()):
+        stats = merge_shards(output_path, sorted(shard_paths))
+        logging.info(f"Merged {stats['shards']} shards into {output_path}: {stats['records']} records, "
+                     f"{stats['duplicates']} duplicates dropped")
+        if queue is not None:
+            progress = queue.progress(os.path.basename(output_path) + ':')
+            unfinished = sum(count for state, count in progress.items() if state != 'done')
+            if unfinished:
+                logging.warning(f"{output_path}: {unfinished} tasks of the queue are not done yet ({progress})")
+        if args.remove_shards:
+            for path in shard_paths:
+                os.remove(path)
+                os.remove(path + '.manifest')
+    if queue is not None:
+        queue.close()
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Merge the per-shard outputs of sharded runs")
+    parser.add_argument('--input_paths', type=str, nargs='+', required=True,
+                        help="Shard files or glob patterns, e.g. 'output/length_bias/*.shard*.jsonl'")
+    parser.add_argument('--queue_path', type=str, default=None,
+                        help="Work queue of the run, to warn about cells whose tasks are not all done")
+    parser.add_argument('--remove_shards', action='store_true',
+                        help="Delete the shard files once they are merged")
+
+    args = parser.parse_args()
+    main(args)
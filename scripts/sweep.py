@@ -0,0 +1,140 @@
+"""This file runs a whole grid of experiment settings in one process.
+
+The grid spec is a JSON or YAML file, e.g.
+{
+    "experiments": [
+        {"script": "length_bias",
+         "params": {"input_path": "../data/dataset/biography_generation.jsonl"},
+         "grid": {"model": ["gpt-4o", "gpt-4o-mini"], "length": [100, 200, 400, 800]}},
+        {"script": "long_context",
+         "grid": {"topic1,topic2": [["early life", "career"], ["personal life", "career"]],
+                  "context_length": [200, 400], "evaluation_length": [200]}}
+    ]
+}
+`params` are fixed for all cells of an experiment, and every combination of the
+`grid` values becomes one cell. A grid key joining several arguments with commas
+varies them together instead of crossing them.
+"""
+import argparse
+import importlib
+import itertools
+import json
+import logging
+from contextlib import ExitStack
+
+from tools import *
+from engine import build_client, run_generation, add_engine_args
+from shards import ShardedRun, add_shard_args
+from prompts import prefix_key
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+SCRIPTS = {
+    "length_bias": "length_bias",
+    "long_context": "long_context",
+    "facts_exhaustion": "facts_exhaustion",
+    "autocorrelation": "error_propagation.autocorrelation_response_gen",
+}
+
+def load_spec(path: str) -> dict:
+    with open(path, 'r') as f:
+        if path.endswith(('.yaml', '.yml')):
+            if yaml is None:
+                raise ImportError('PyYAML is required for YAML grid specs: pip install pyyaml')
+            spec = yaml.safe_load(f)
+        else:
+            spec = json.load(f)
+    # a spec with a single experiment does not need the `experiments` list
+    return spec if "experiments" in spec else {"experiments": [spec]}
+
+def expand_grid(grid: dict) -> list:
+    """Returns one dict of argument values per combination of the grid axes."""
+    axes = []
+    for key, values in grid.items():
+        names = [name.strip() for name in key.split(',')]
+        if len(names) == 1:
+            axes.append([{names[0]: value} for value in values])
+        else:
+            axes.append([dict(zip(names, value)) for value in values])
+    return [{k: v for combo in cell for k, v in combo.items()} for cell in itertools.product(*axes)]
+
+def build_cells(spec: dict, args) -> list:
+    """Expands the spec into (module, cell args) pairs, one per grid cell."""
+    cells = []
+    for experiment in spec["experiments"]:
+        module = importlib.import_module(SCRIPTS[experiment["script"]])
+        for values in expand_grid(experiment.get("grid", {})):
+            cell_args = module.build_parser().parse_args([])
+            for key, value in {**experiment.get("params", {}), **values}.items():
+                if not hasattr(cell_args, key):
+                    raise ValueError(f'Unknown argument `{key}` for {experiment["script"]}')
+                setattr(cell_args, key, value)
+            # the engine settings of the sweep apply to every cell
+            for key in ('api_key', 'concurrency', 'max_in_flight', 'resume', 'reformat_model',
+                        'backend', 'base_url', 'local_engine', 'local_model',
+                        'num_shards', 'shard_id', 'queue_path', 'queue_lease'):
+                setattr(cell_args, key, getattr(args, key))
+            cells.append((module, cell_args))
+    return cells
+
+def cell_items(worker, writer, tasks):
+    """Lazily pairs the tasks of one cell with its worker and writer."""
+    # tasks are filled in place, so each cell gets its own copies
+    return ((worker, writer, dict(task)) for task in tasks)
+
+def main(args):
+    spec = load_spec(args.spec)
+    cells = build_cells(spec, args)
+    client = build_client(args)
+
+    datasets = {}
+    queue = []
+    n_tasks = 0
+    prefixes = set()
+    with ExitStack() as stack:
+        for cell_id, (module, cell_args) in enumerate(cells):
+            if cell_args.input_path not in datasets:
+                datasets[cell_args.input_path] = jsonlines_load(cell_args.input_path)
+            run = module.prepare_run(cell_args, datasets[cell_args.input_path])
+            if run is None:
+                raise ValueError(f'Could not prepare cell {cell_id}: {vars(cell_args)}')
+            tasks, output_path, params, worker = run
+            writer = stack.enter_context(ShardedRun(output_path, params, cell_args))
+            if writer.queue is None:
+                pending = list(writer.pending(tasks))
+                queue.append(cell_items(worker, writer, pending))
+                n_pending = len(pending)
+            else:
+                # tasks are only claimed from the work queue when the engine is ready to run them
+                pending = tasks
+                queue.append(cell_items(worker, writer, writer.pending(tasks)))
+                n_pending = writer.remaining(len(tasks))
+            n_tasks += n_pending
+            prefixes.update(prefix_key(module.system_prompt(cell_args, task)) for task in pending)
+            logging.info(f"Cell {cell_id}: {n_pending} tasks -> {writer.output_path}")
+        # requests sharing a system prompt share a prefix that provider-side prompt caching can reuse
+        logging.info(f"{n_tasks} tasks over {len(prefixes)} distinct system prompt prefixes")
+
+        async def run_item(item):
+            worker, writer, task = item
+            return writer, await worker(client, task)
+
+        run_generation(client, run_item, itertools.chain(*queue), args,
+                       callback=lambda result: result[0].write(result[1]), total=n_tasks)
+
+    logging.info(f"All {len(cells)} cells completed.")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run a grid of experiment settings in one process")
+    parser.add_argument('--spec', type=str, required=True,
+                        help="Path to the JSON or YAML grid spec")
+    parser.add_argument('--api_key', type=str, default=None,
+                        help="OpenAI API key, needed with the openai backend")
+    add_engine_args(parser)
+    add_shard_args(parser)
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,283 @@
+"""This file records per-request telemetry (latency, token usage, retries, cost) of the
+chat client, attaches it to the output records and summarizes it for the whole run."""
+import contextvars
+import functools
+import json
+import logging
+import os
+import time
+from array import array
+from dataclasses import dataclass
+
+try:
+    from opentelemetry import metrics as otel_metrics
+except ImportError:
+    otel_metrics = None
+
+# USD per 1M (prompt, completion) tokens; models are matched by their longest prefix
+MODEL_PRICES = {
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4.1": (2.00, 8.00),
+    "gpt-4.1-mini": (0.40, 1.60),
+    "gpt-4.1-nano": (0.10, 0.40),
+    "gpt-4-turbo": (10.00, 30.00),
+    "gpt-4": (30.00, 60.00),
+    "gpt-3.5-turbo": (0.50, 1.50),
+}
+
+def model_price(model: str, prices: dict = None):
+    """Returns the (prompt, completion) price of `model`, or None if it is unknown."""
+    prices = MODEL_PRICES if prices is None else prices
+    matches = [name for name in prices if model.startswith(name)]
+    return prices[max(matches, key=len)] if matches else None
+
+def estimate_cost(model: str, prompt_tokens: int, completion_tokens: int, prices: dict = None):
+    price = model_price(model, prices)
+    if price is None:
+        return None
+    return (prompt_tokens * price[0] + completion_tokens * price[1]) / 1e6
+
+################################################################################
+#                                 REQUEST STATS                                #
+################################################################################
+
+@dataclass
+class RequestStats:
+    """Telemetry of one `ChatClient.complete` call.
+
+    `latency` is the time the attempt that succeeded spent in the request itself,
+    without waiting for the rate limiter (None for responses of Batch API jobs),
+    `total_latency` also includes failed attempts and backoff, and `retries` counts
+    the failed attempts.
+    """
+    model: str
+    latency: float = 0.0
+    total_latency: float = 0.0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    retries: int = 0
+    finish_reason: str = None
+    cached: bool = False
+    coalesced: bool = False
+    failed: bool = False
+
+    def record_usage(self, usage, finish_reason=None):
+        """Stores the usage of a completion, given as an SDK object or a dict."""
+        if usage is not None:
+            if isinstance(usage, dict):
+                self.prompt_tokens = usage.get('prompt_tokens') or 0
+                self.completion_tokens = usage.get('completion_tokens') or 0
+            else:
+                self.prompt_tokens = usage.prompt_tokens or 0
+                self.completion_tokens = usage.completion_tokens or 0
+        self.finish_reason = finish_reason
+
+# the calls of the task currently run by this asyncio task, set by `instrument`
+_task_calls = contextvars.ContextVar('task_calls', default=None)
+
+def record_call(call: RequestStats):
+    calls = _task_calls.get()
+    if calls is not None:
+        calls.append(call)
+
+def summarize_calls(calls: list, prices: dict = None) -> dict:
+    """Aggregates the calls made for one task into the `telemetry` field of its record."""
+    timed = [call.latency for call in calls if call.latency is not None]
+    summary = {
+        "requests": len(calls),
+        "cached": sum(call.cached for call in calls),
+        "coalesced": sum(call.coalesced for call in calls),
+        "latency": round(sum(timed), 4) if timed else None,
+        "total_latency": round(sum(call.total_latency for call in calls), 4),
+        "prompt_tokens": sum(call.prompt_tokens for call in calls),
+        "completion_tokens": sum(call.completion_tokens for call in calls),
+        "retries": sum(call.retries for call in calls),
+        "finish_reason": calls[-1].finish_reason,
+    }
+    costs = [estimate_cost(call.model, call.prompt_tokens, call.completion_tokens, prices) for call in calls]
+    summary["cost"] = sum(costs) if None not in costs else None
+    return summary
+
+def instrument(worker, key: str = 'telemetry'):
+    """Wraps an async task worker so that the record it returns gets the telemetry
+    of all chat calls it made under `key`."""
+    @functools.wraps(worker)
+    async def run(*args, **kwargs):
+        calls = []
+        token = _task_calls.set(calls)
+        try:
+            result = await worker(*args, **kwargs)
+        finally:
+            _task_calls.reset(token)
+        if isinstance(result, dict) and calls:
+            result[key] = summarize_calls(calls)
+        return result
+    return run
+
+################################################################################
+#                                  RUN METRICS                                 #
+################################################################################
+
+def _percentile(sorted_values, q: float) -> float:
+    if not sorted_values:
+        return None
+    return sorted_values[min(int(q * len(sorted_values)), len(sorted_values) - 1)]
+
+class _ModelMetrics:
+    def __init__(self):
+        self.latencies = array('d')
+        self.requests = self.cached = self.coalesced = self.failed = self.retries = 0
+        self.prompt_tokens = self.completion_tokens = 0
+        # completion tokens of the requests in `latencies`, for the per-request decoding speed
+        self.timed_completion_tokens = 0
+        self.finish_reasons = {}
+
+class Telemetry:
+    """Collects the `RequestStats` of a run and summarizes them per model.
+
+    The summary holds p50/p95 latency, token counts, output tokens per second and an
+    estimated cost. It is optionally exported as a Prometheus text file (rewritten
+    every `export_every` requests, for node_exporter's textfile collector) and to
+    OpenTelemetry, which reports to whatever meter provider the process configured.
+    """
+
+    def __init__(self, prices: dict = None, metrics_path: str = None, prometheus_path: str = None,
+                 export_every: int = 100, otel: bool = False):
+        self.prices = MODEL_PRICES if prices is None else prices
+        self.metrics_path = metrics_path
+        self.prometheus_path = prometheus_path
+        self.export_every = export_every
+        self.models = {}
+        self.started = time.time()
+        self._observed = 0
+        self._otel = None
+        if otel:
+            if otel_metrics is None:
+                raise ImportError('opentelemetry-api is required for --otel: pip install opentelemetry-api')
+            meter = otel_metrics.get_meter('length-bias-factuality')
+            self._otel = {
+                "latency": meter.create_histogram('llm.request.duration', unit='s'),
+                "tokens": meter.create_counter('llm.tokens', unit='{token}'),
+                "retries": meter.create_counter('llm.request.retries'),
+            }
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(metrics_path=args.metrics_path, prometheus_path=args.prometheus_path, otel=args.otel)
+
+    def observe(self, call: RequestStats):
+        metrics = self.models.setdefault(call.model, _ModelMetrics())
+        metrics.requests += 1
+        metrics.retries += call.retries
+        if call.failed:
+            metrics.failed += 1
+        elif call.cached:
+            metrics.cached += 1
+        elif call.coalesced:
+            metrics.coalesced += 1
+        else:
+            if call.latency is not None:
+                metrics.latencies.append(call.latency)
+                metrics.timed_completion_tokens += call.completion_tokens
+            metrics.prompt_tokens += call.prompt_tokens
+            metrics.completion_tokens += call.completion_tokens
+            metrics.finish_reasons[call.finish_reason] = metrics.finish_reasons.get(call.finish_reason, 0) + 1
+
+        if self._otel is not None and not (call.cached or call.coalesced or call.failed):
+            attributes = {"model": call.model}
+            if call.latency is not None:
+                self._otel["latency"].record(call.latency, attributes)
+            self._otel["tokens"].add(call.prompt_tokens, {**attributes, "type": "prompt"})
+            self._otel["tokens"].add(call.completion_tokens, {**attributes, "type": "completion"})
+            self._otel["retries"].add(call.retries, attributes)
+
+        self._observed += 1
+        if self.prometheus_path and self._observed % self.export_every == 0:
+            self.write_prometheus(self.prometheus_path)
+
+    def summary(self) -> dict:
+        """Run-level metrics per model."""
+        summary = {}
+        for model, metrics in self.models.items():
+            latencies = sorted(metrics.latencies)
+            summary[model] = {
+                "requests": metrics.requests,
+                "cached": metrics.cached,
+                "coalesced": metrics.coalesced,
+                "failed": metrics.failed,
+                "retries": metrics.retries,
+                "latency_p50": _percentile(latencies, 0.50),
+                "latency_p95": _percentile(latencies, 0.95),
+                "prompt_tokens": metrics.prompt_tokens,
+                "completion_tokens": metrics.completion_tokens,
+                # decoding speed of a single request, and overall throughput of the run
+                "output_tokens_per_s": metrics.timed_completion_tokens / sum(latencies) if latencies and sum(latencies) else None,
+                "run_tokens_per_s": metrics.completion_tokens / max(time.time() - self.started, 1e-9),
+                "finish_reasons": metrics.finish_reasons,
+                "cost": estimate_cost(model, metrics.prompt_tokens, metrics.completion_tokens, self.prices),
+            }
+        return summary
+
+    def write_prometheus(self, path: str):
+        """Writes the metrics in the Prometheus text format, atomically replacing `path`."""
+        summary = self.summary()
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f'# HELP factuality_{name} {help_text}')
+            lines.append(f'# TYPE factuality_{name} {kind}')
+            for labels, value in samples:
+                if value is None:
+                    continue
+                label_text = ','.join(f'{k}="{v}"' for k, v in labels.items())
+                lines.append(f'factuality_{name}{{{label_text}}} {value}')
+
+        models = list(summary.items())
+        metric('requests_total', 'counter', 'Chat requests, including cached ones.',
+               [({"model": m}, s["requests"]) for m, s in models])
+        metric('cached_requests_total', 'counter', 'Chat requests answered from the response cache.',
+               [({"model": m}, s["cached"]) for m, s in models])
+        metric('coalesced_requests_total', 'counter', 'Chat requests answered by an identical request in flight.',
+               [({"model": m}, s["coalesced"]) for m, s in models])
+        metric('failed_requests_total', 'counter', 'Chat requests that failed after all retries.',
+               [({"model": m}, s["failed"]) for m, s in models])
+        metric('retries_total', 'counter', 'Failed attempts that were retried.',
+               [({"model": m}, s["retries"]) for m, s in models])
+        metric('request_latency_seconds', 'gauge', 'Latency quantiles of successful requests.',
+               [({"model": m, "quantile": q}, s[f"latency_p{int(float(q) * 100)}"])
+                for m, s in models for q in ("0.5", "0.95")])
+        metric('tokens_total', 'counter', 'Tokens used by successful requests.',
+               [({"model": m, "type": t}, s[f"{t}_tokens"]) for m, s in models for t in ("prompt", "completion")])
+        metric('cost_dollars_total', 'counter', 'Estimated cost of the run.',
+               [({"model": m}, s["cost"]) for m, s in models])
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, path)
+
+    def close(self):
+        """Logs the summary and writes the configured exports."""
+        summary = self.summary()
+        if not summary:
+            return
+        for model, metrics in summary.items():
+            cost = f"${metrics['cost']:.4f}" if metrics['cost'] is not None else "unknown"
+            p50 = f"{metrics['latency_p50']:.2f}s" if metrics['latency_p50'] is not None else "-"
+            p95 = f"{metrics['latency_p95']:.2f}s" if metrics['latency_p95'] is not None else "-"
+            logging.info(f"Telemetry {model}: {metrics['requests']} requests ({metrics['cached']} cached, "
+                         f"{metrics['coalesced']} coalesced, {metrics['failed']} failed, {metrics['retries']} retries), latency p50 {p50} "
+                         f"p95 {p95}, {metrics['prompt_tokens']} prompt + {metrics['completion_tokens']} "
+                         f"completion tokens, cost {cost}")
+        if self.metrics_path:
+            directory = os.path.dirname(self.metrics_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.metrics_path, 'w') as f:
+                json.dump(summary, f, indent=2)
+        if self.prometheus_path:
+            self.write_prometheus(self.prometheus_path)
@@ -1,14 +1,79 @@
 import json
-from typing import Union
+from dataclasses import dataclass, field
+from typing import Union, Iterable, Iterator
+import collections
+import gzip
+import io
+import itertools
+import os
 import re
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 ################################################################################
 #                             JSON FILE OPERATION                              #
 ################################################################################
 
+def open_text(fname: str, mode: str = 'r'):
+    """Opens a text file, transparently (de)compressing `.gz` and `.zst` files."""
+    if fname.endswith('.gz'):
+        return gzip.open(fname, mode + 't', encoding='utf-8')
+    if fname.endswith('.zst'):
+        if zstandard is None:
+            raise ImportError('zstandard is required for .zst files: pip install zstandard')
+        if 'r' in mode:
+            stream = zstandard.ZstdDecompressor().stream_reader(open(fname, 'rb'))
+        else:
+            stream = zstandard.ZstdCompressor().stream_writer(open(fname, mode + 'b'))
+        return io.TextIOWrapper(stream, encoding='utf-8')
+    return open(fname, mode, encoding='utf-8')
+
+def json_loads(line: Union[str, bytes]):
+    return orjson.loads(line) if orjson is not None else json.loads(line)
+
+def json_dumps(data, use_orjson: bool = False) -> str:
+    """Serializes one record. orjson is faster, but writes compact separators."""
+    if use_orjson and orjson is not None:
+        return orjson.dumps(data).decode('utf-8')
+    return json.dumps(data)
+
+def _slice(records: Iterator, start: int = 0, end: int = None) -> Iterator:
+    """Lazily applies `records[start:end]` with list semantics."""
+    start = start or 0
+    if start >= 0 and (end is None or end >= 0):
+        yield from itertools.islice(records, start, end)
+    elif start >= 0:
+        # a negative end only needs a look-ahead of -end records
+        buffer = collections.deque()
+        for record in itertools.islice(records, start, None):
+            buffer.append(record)
+            if len(buffer) > -end:
+                yield buffer.popleft()
+    else:
+        # a negative start depends on the total length
+        yield from list(records)[start:end]
+
+def jsonlines_iter(fname: str, start: int = 0, end: int = None) -> Iterator[dict]:
+    """Lazily yields the records of a JSONL file, sliced like `records[start:end]`."""
+    with open_text(fname, 'r') as f:
+        yield from _slice((json_loads(line) for line in f if line.strip()), start, end)
+
+def jsonlines_count(fname: str, start: int = 0, end: int = None) -> int:
+    """Returns the number of records `jsonlines_iter` yields, without parsing them."""
+    with open_text(fname, 'r') as f:
+        n_records = sum(1 for line in f if line.strip())
+    return len(range(n_records)[start:end])
+
 def jsonlines_load(fname: str):
-    with open(fname, 'r') as f:
-        return [json.loads(line) for line in f]
+    return list(jsonlines_iter(fname))
 
 def jsonlines_dump(fname: str, data: Union[dict, list]):
     try:
@@ -23,15 +88,146 @@ def jsonlines_dump(fname: str, data: Union[dict, list]):
         print(f'Error: {e}')
         print(f'Could not write to {fname}')
 
+class JsonlinesWriter:
+    """Appends records to a JSONL file through one open handle, in buffered chunks.
+
+    Records are written every `buffer_size` records and on `flush`/`close`. With
+    `fsync=True` each flush is forced to disk.
+    """
+
+    def __init__(self, fname: str, mode: str = 'a', buffer_size: int = 100,
+                 use_orjson: bool = False, fsync: bool = False):
+        self.fname = fname
+        self.file = open_text(fname, mode)
+        self.buffer_size = buffer_size
+        self.use_orjson = use_orjson
+        self.fsync = fsync
+        self.buffer = []
+
+    def write(self, record: dict):
+        self.buffer.append(json_dumps(record, self.use_orjson) + '\n')
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def write_many(self, records: Iterable[dict]):
+        for record in records:
+            self.write(record)
+
+    def flush(self):
+        if self.buffer:
+            self.file.write(''.join(self.buffer))
+            self.buffer = []
+        self.file.flush()
+        if self.fsync and hasattr(self.file, 'fileno'):
+            os.fsync(self.file.fileno())
+
+    def tell(self) -> int:
+        return self.file.tell()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
 ################################################################################
 #                             ABSTENTION DETECTION                             #
 ################################################################################
+# Each pattern is (name, kind, phrase): `prefix` phrases must open the
+# generation, `contains` phrases may appear anywhere in it.
+ABSTAIN_PATTERN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                    '..', 'data', 'abstain_patterns.json')
+
+def load_abstain_patterns(path: str = ABSTAIN_PATTERN_PATH, family: str = None) -> list:
+    """Loads the `default` patterns of a JSON pattern file, extended by those of `family`.
+
+    The file maps family names to lists of `{"name", "prefix" | "contains"}` entries.
+    """
+    with open(path) as f:
+        spec = json.load(f)
+    entries = spec.get("default", []) + (spec.get(family, []) if family else [])
+    patterns = []
+    for entry in entries:
+        kind = "prefix" if "prefix" in entry else "contains"
+        phrase = entry[kind]
+        patterns.append((entry.get("name", phrase), kind, phrase))
+    return patterns
+
+class AbstainDetector:
+    """Detects abstentions with a single compiled regex over all patterns.
+
+    Every phrase becomes a named group of one alternation, so screening a
+    generation is one `search`, and the group that matched tells which pattern
+    fired. `match` counts in `counts` how often each pattern fired since the last
+    `reset`; `find` keeps no counts. Without `patterns`, the `default` ones of
+    `ABSTAIN_PATTERN_PATH` are used.
+    """
+
+    def __init__(self, patterns: list = None):
+        self.patterns = list(load_abstain_patterns() if patterns is None else patterns)
+        alternatives, self._names = [], {}
+        for i, (name, kind, phrase) in enumerate(self.patterns):
+            if kind not in ("prefix", "contains"):
+                raise ValueError(f"Unknown abstention pattern kind {kind!r} for {name!r}")
+            anchor = r'\A' if kind == "prefix" else ''
+            alternatives.append(f'(?P<p{i}>{anchor}{re.escape(phrase)})')
+            self._names[f'p{i}'] = name
+        # prefix patterns come first, so they win when several match at position 0
+        alternatives.sort(key=lambda a: r'\A' not in a)
+        self._regex = re.compile('|'.join(alternatives)) if alternatives else None
+        self.reset()
+
+    @classmethod
+    def from_file(cls, path: str, family: str = None):
+        """Builds a detector from the patterns `load_abstain_patterns` reads from `path`."""
+        return cls(load_abstain_patterns(path, family))
+
+    def reset(self):
+        self.counts = collections.Counter()
+        self.screened = 0
+
+    def find(self, generation: str) -> Union[str, None]:
+        """Returns the name of the pattern that fired, or None, without counting it."""
+        match = self._regex.search(generation) if self._regex else None
+        return self._names[match.lastgroup] if match is not None else None
+
+    def match(self, generation: str) -> Union[str, None]:
+        """Returns the name of the pattern that fired, or None, and counts it."""
+        self.screened += 1
+        name = self.find(generation)
+        if name is not None:
+            self.counts[name] += 1
+        return name
+
+    def __call__(self, generation: str) -> bool:
+        return self.match(generation) is not None
+
+    def detect_many(self, generations: Iterable[str]) -> list:
+        """Screens a batch of generations, one scan each."""
+        return [self.match(generation) is not None for generation in generations]
+
+    @property
+    def abstained(self) -> int:
+        return sum(self.counts.values())
+
+    def stats(self) -> dict:
+        """Abstention rate and per-pattern counts of everything screened so far."""
+        return {
+            "screened": self.screened,
+            "abstained": self.abstained,
+            "rate": self.abstained / self.screened if self.screened else 0.0,
+            "patterns": dict(self.counts.most_common()),
+        }
+
+_DEFAULT_ABSTAIN_DETECTOR = AbstainDetector()
+
 """Detects if the generation is an abstention response."""
 def generic_abstain_detect(generation):
-    return generation.startswith("I'm sorry") or generation.startswith("I apologize") \
-        or generation.startswith("Sorry") or "provide more" in generation or "couldn't find" in generation\
-        or generation.startswith("I'm not") or generation.startswith("I\u2019m sorry")\
-        or "no publicly available" in generation
+    return _DEFAULT_ABSTAIN_DETECTOR.find(generation) is not None
 
 ################################################################################
 #                             STRING MANIPULATION                              #
@@ -40,21 +236,85 @@ def strip_string(s: str) -> str:
   """Strips a string of newlines and spaces."""
   return s.strip(' \n')
 
+HASH_BLOCK_PATTERN = re.compile(r'###\s*(.*?)\s*###\n(.*?)(?=\n###|$)', re.DOTALL)
+_INLINE_HASH_HEADER_PATTERN = re.compile(r'^([ \t]*###[^\n]*?###)[ \t]*(?=\S)', re.MULTILINE)
+_HEADER_LINE_PATTERN = re.compile(
+    r'^[ \t]*(?:#{1,6}[ \t]*(?P<hash>[^\n#]+?)[ \t]*#*|\*\*(?P<bold>[^\n*]+?)\*\*:?)[ \t]*$', re.MULTILINE)
+
+PARSE_OK = 'ok'
+PARSE_ABSTAINED = 'abstained'
+PARSE_MALFORMED = 'malformed'
+
+@dataclass
+class SectionParse:
+    """The outcome of parsing a response made of hash blocks (### title ###).
+
+    `status` is one of `PARSE_OK`, `PARSE_ABSTAINED` or `PARSE_MALFORMED`, and
+    `blocks` holds the (title, content) pairs that were found, even when their
+    number is wrong. `repair` names the fix that made the response parseable.
+    """
+    status: str
+    blocks: list = field(default_factory=list)
+    repair: str = None
+
+    @property
+    def ok(self) -> bool:
+        return self.status == PARSE_OK
+
+    @property
+    def contents(self) -> list:
+        return [content for _, content in self.blocks]
+
+def _find_hash_blocks(input_string: str) -> list:
+    return [(title, strip_string(content)) for title, content in HASH_BLOCK_PATTERN.findall(input_string)]
+
+def repair_hash_blocks(input_string: str, titles: list = None) -> str:
+    """Rewrites common header slips into hash blocks.
+
+    Headers written as markdown headings or in bold become `### title ###`, and
+    content that starts on the header line is moved below it. When `titles` are
+    given, only headings matching one of them are rewritten.
+    """
+    wanted = {t.lower() for t in titles} if titles else None
+
+    def fix_header(match):
+        title = (match.group('hash') or match.group('bold')).strip()
+        if wanted is not None and title.lower() not in wanted:
+            return match.group(0)
+        if wanted is None and match.group('bold') is not None:
+            return match.group(0)
+        return f'### {title} ###'
+
+    repaired = input_string.replace('\r\n', '\n')
+    repaired = _INLINE_HASH_HEADER_PATTERN.sub(r'\1\n', repaired)
+    return _HEADER_LINE_PATTERN.sub(fix_header, repaired)
+
+def parse_hash_blocks(input_string: str, number_of_blocks: int, titles: list = None,
+                      abstain_detect=None) -> SectionParse:
+    """Parses a response into `number_of_blocks` hash blocks without raising.
+
+    Abstentions are reported as such. When the number of blocks is wrong, the local
+    repairs of `repair_hash_blocks` are tried before the response is reported as
+    malformed.
+    """
+    abstain_detect = abstain_detect or generic_abstain_detect
+    if abstain_detect(input_string):
+        return SectionParse(PARSE_ABSTAINED)
+    blocks = _find_hash_blocks(input_string)
+    if len(blocks) == number_of_blocks:
+        return SectionParse(PARSE_OK, blocks)
+    repaired = _find_hash_blocks(repair_hash_blocks(input_string, titles))
+    if len(repaired) == number_of_blocks:
+        return SectionParse(PARSE_OK, repaired, repair='local')
+    return SectionParse(PARSE_MALFORMED, blocks)
+
 def extract_hash_block(
     input_string: str, number_of_blocks: int
 ) -> str:
     """Extracts the contents of a string under the hash block (###)."""
-    pattern = re.compile(r'###\s*(.*?)\s*###\n(.*?)(?=\n###|$)', re.DOTALL)
-  
-  # search all the matched patterns
-    match = pattern.findall(input_string)
-   
-    if number_of_blocks == 1:
-        assert len(match) == 1, f'Error: {match}'
-        return strip_string(match[0][1])
-    elif number_of_blocks == 2:
-        assert len(match) == 2, f'Error: {match}'
-        return strip_string(match[0][1]), strip_string(match[1][1])
-    else:
+    if number_of_blocks not in (1, 2):
         raise ValueError(f'Not implemented. Error: {number_of_blocks}')
-
+    match = _find_hash_blocks(input_string)
+    if len(match) != number_of_blocks:
+        raise ValueError(f'Error: {match}')
+    return match[0][1] if number_of_blocks == 1 else (match[0][1], match[1][1])